@@ -0,0 +1,140 @@
+"""
+Requests/sec of the chats middleware chain under uvicorn, with the
+middleware sync-only (as before) and async-capable.
+
+    pip install uvicorn
+    python -m benchmarks.asgi_middleware --requests 5000 --concurrency 64
+
+Run from the project directory. Each chain gets its own uvicorn process
+(one worker) serving a throwaway database; a keep-alive load generator then
+sends session-authenticated GET /api/conversations/ requests. See
+benchmarks/chains.py for the two chains.
+"""
+import argparse
+import asyncio
+import collections
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+PATH = "/api/conversations/"
+SETTINGS = "benchmarks.asgi_settings"
+
+
+def prepare(bench_dir):
+    """Migrate the throwaway database and return a logged-in session cookie."""
+    os.environ["CHATS_BENCH_DIR"] = bench_dir
+    os.environ["DJANGO_SETTINGS_MODULE"] = SETTINGS
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+    from django.contrib.sessions.backends.db import SessionStore
+    from django.core.management import call_command
+
+    from chats.models import User
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create(username="bench", email="bench@example.com", password_hash="x")
+    session = SessionStore()
+    session[SESSION_KEY] = str(user.pk)
+    session[BACKEND_SESSION_KEY] = "django.contrib.auth.backends.ModelBackend"
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.create()
+    return f"{settings.SESSION_COOKIE_NAME}={session.session_key}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(chain, bench_dir, port):
+    env = dict(os.environ, CHATS_BENCH_CHAIN=chain, CHATS_BENCH_DIR=bench_dir,
+               DJANGO_SETTINGS_MODULE=SETTINGS)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "messaging_app.asgi:application",
+         "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        env=env,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"uvicorn did not start for the {chain} chain")
+
+
+async def fetch(reader, writer, request):
+    writer.write(request)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    await reader.readexactly(length)
+    return status
+
+
+async def load(port, cookie, total, concurrency):
+    request = (
+        f"GET {PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nCookie: {cookie}\r\n\r\n"
+    ).encode("latin-1")
+    remaining = iter(range(total))
+    statuses = collections.Counter()
+
+    async def client():
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            for _ in remaining:
+                statuses[await fetch(reader, writer, request)] += 1
+        finally:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return total / (time.perf_counter() - start), statuses
+
+
+def run(chain, bench_dir, cookie, args):
+    port = free_port()
+    server = start_server(chain, bench_dir, port)
+    try:
+        asyncio.run(load(port, cookie, args.warmup, args.concurrency))
+        return asyncio.run(load(port, cookie, args.requests, args.concurrency))
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--warmup", type=int, default=500)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bench_dir:
+        cookie = prepare(bench_dir)
+        results = {chain: run(chain, bench_dir, cookie, args) for chain in ("sync", "async")}
+
+    for chain, (rps, statuses) in results.items():
+        counts = ", ".join(f"{status}: {n}" for status, n in sorted(statuses.items()))
+        print(f"{chain:>5} chain: {rps:8.1f} req/s  ({counts})")
+    print(f"speedup: {results['async'][0] / results['sync'][0]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Settings for benchmarks/asgi_middleware.py: the project settings with a
+throwaway database, request log and rate-limit file, and an access policy
+that requires a logged-in user but no time window, so requests reach the
+view at any hour. The chats middleware is replaced by the CHATS_BENCH_CHAIN
+("sync" or "async") variants from benchmarks.chains.
+"""
+import os
+
+from messaging_app.settings import *  # noqa: F401,F403
+from messaging_app.settings import CHATS_REQUEST_LOG, MIDDLEWARE
+
+BENCH_DIR = os.environ["CHATS_BENCH_DIR"]
+
+DEBUG = False
+ALLOWED_HOSTS = ["127.0.0.1", "localhost"]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": os.path.join(BENCH_DIR, "db.sqlite3"),
+        # Concurrent writers (benchmarks.sync_contention) wait for the write
+        # lock up front instead of failing to upgrade a read transaction
+        "OPTIONS": {"transaction_mode": "IMMEDIATE", "timeout": 20},
+    }
+}
+
+CHATS_REQUEST_LOG = {**CHATS_REQUEST_LOG, "PATH": os.path.join(BENCH_DIR, "requests.log")}
+CHATS_RATE_LIMIT_BACKEND = {
+    "BACKEND": "chats.ratelimit.SQLiteBackend",
+    "OPTIONS": {"path": os.path.join(BENCH_DIR, "ratelimit.sqlite3")},
+}
+CHATS_ACCESS_POLICY = {"RULES": [{"path": "/api/", "authenticated": True}]}
+
+# The middleware benchmarks.chains has variants of (the opt-in timing and
+# metrics middleware stay as they are: disabled unless their env var is set)
+VARIANTS = {"ReplicaRoutingMiddleware", "RequestLoggingMiddleware", "AccessPolicyMiddleware"}
+
+CHAIN = os.environ.get("CHATS_BENCH_CHAIN", "async").title()
+MIDDLEWARE = [
+    f"benchmarks.chains.{CHAIN}{path.rsplit('.', 1)[1]}" if path.rsplit(".", 1)[1] in VARIANTS else path
+    for path in MIDDLEWARE
+]
@@ -0,0 +1,25 @@
+"""
+The two middleware chains compared by benchmarks/asgi_middleware.py.
+
+The "sync" variants are marked sync-only, as all chats middleware was
+before async support: under ASGI Django then runs them, and everything
+outside them, in a worker thread.
+"""
+from chats import db_routers, middleware
+
+
+def variant(middleware_class, chain):
+    attrs = {"__module__": __name__}
+    if chain == "sync":
+        attrs["async_capable"] = False
+    return type(f"{chain.title()}{middleware_class.__name__}", (middleware_class,), attrs)
+
+
+for _chain in ("sync", "async"):
+    for _class in (
+        db_routers.ReplicaRoutingMiddleware,
+        middleware.RequestLoggingMiddleware,
+        middleware.AccessPolicyMiddleware,
+    ):
+        _variant = variant(_class, _chain)
+        globals()[_variant.__name__] = _variant
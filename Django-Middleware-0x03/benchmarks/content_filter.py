@@ -0,0 +1,72 @@
+"""
+Cost of chats.content_filter as the word list grows.
+
+    python -m benchmarks.content_filter --messages 20000
+
+Builds filters from random word lists of increasing size (a fifth of the
+terms are two- or three-word phrases) and scans the same random messages
+with each. Reports the build time and the mean cost per message; the
+latter should stay flat as the list grows.
+"""
+import argparse
+import random
+import string
+import time
+
+SIZES = (100, 1000, 10000, 100000)
+
+
+def random_word(rng):
+    return "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+
+
+def random_terms(rng, count):
+    terms = []
+    for _ in range(count):
+        length = 1 if rng.random() < 0.8 else rng.randint(2, 3)
+        action = rng.choice(("mask", "mask", "flag", "block"))
+        terms.append((" ".join(random_word(rng) for _ in range(length)), action))
+    return terms
+
+
+def random_messages(rng, count, vocabulary):
+    # Mostly ordinary words, with the occasional listed one mixed in
+    messages = []
+    for _ in range(count):
+        words = [
+            rng.choice(vocabulary) if rng.random() < 0.02 else random_word(rng)
+            for _ in range(rng.randint(5, 40))
+        ]
+        messages.append(" ".join(words) + ".")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from chats.content_filter import ContentFilter
+
+    rng = random.Random(args.seed)
+    all_terms = random_terms(rng, max(SIZES))
+    vocabulary = [term.split()[0] for term, _ in all_terms[:100]]
+    messages = random_messages(rng, args.messages, vocabulary)
+    mean_words = sum(len(m.split()) for m in messages) / len(messages)
+
+    print(f"{len(messages)} messages, {mean_words:.1f} words on average")
+    print(f"{'terms':>8} {'build ms':>10} {'us/message':>11} {'matched':>8}")
+    for size in SIZES:
+        start = time.perf_counter()
+        content_filter = ContentFilter(all_terms[:size])
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        matched = sum(1 for message in messages if content_filter.scan(message).action)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>8} {build * 1000:>10.1f} {elapsed / len(messages) * 1e6:>11.2f} {matched:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+DRF serializers and JSONRenderer vs chats.fastpath and ORJSONRenderer on
+the message and inbox list pages.
+
+    python -m benchmarks.fast_lists --repeat 50
+
+Fills a throwaway database (benchmarks.asgi_settings) with one user in
+1000 conversations of 1000 messages in all, then times building pages of
+20, 100 and 1000 rows both ways: fetching and serializing (the queries
+included: the participants prefetch, or its fastpath equivalent, for the
+inbox), then rendering to JSON. Both ways produce the same bytes; the
+script checks that as it goes.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+SIZES = (20, 100, 1000)
+
+
+def setup(bench_dir, conversations):
+    os.environ["CHATS_BENCH_DIR"] = bench_dir
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.asgi_settings"
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+
+    from chats.models import Conversation, Message, User
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create(username="bench", email="bench@example.com", password_hash="x")
+    others = User.objects.bulk_create(
+        User(username=f"u{i}", email=f"u{i}@example.com", password_hash="x", first_name="Zoë")
+        for i in range(50)
+    )
+    Through = Conversation.participants.through
+    for i in range(conversations):
+        conversation = Conversation.objects.create()
+        Through.objects.bulk_create([
+            Through(conversation=conversation, user=user),
+            Through(conversation=conversation, user=others[i % len(others)]),
+        ])
+        Message.objects.create(
+            sender=user, conversation=conversation, message_body=f"message {i} — with some text",
+        )
+    return user
+
+
+def best(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bench_dir:
+        user = setup(bench_dir, max(SIZES))
+
+        from rest_framework.renderers import JSONRenderer
+
+        from chats import fastpath
+        from chats.models import Conversation, Message
+        from chats.renderers import ORJSONRenderer
+        from chats.serializers import ConversationSummarySerializer, MessageSerializer
+        from chats.views import ConversationViewSet, participants_prefetch
+
+        messages = Message.objects.filter(conversation__participants=user).select_related("sender")
+        messages = messages.order_by("-sent_at", "-id")
+        inbox = ConversationViewSet.annotate_summary(
+            Conversation.objects.filter(participants=user)
+        ).prefetch_related(participants_prefetch())
+        endpoints = [
+            ("messages", messages, MessageSerializer),
+            ("conversations", inbox, ConversationSummarySerializer),
+        ]
+
+        print(f"{'list':<14} {'rows':>5} {'':>9} {'fetch+serialize ms':>19} {'render ms':>10} {'total ms':>9}")
+        for name, queryset, serializer_class in endpoints:
+            plan = fastpath.plan_for(serializer_class)
+            for size in SIZES:
+                slow_build, slow_data = best(
+                    lambda: serializer_class(list(queryset[:size]), many=True).data, args.repeat
+                )
+                slow_render, slow_body = best(lambda: JSONRenderer().render(slow_data), args.repeat)
+                fast_build, fast_data = best(
+                    lambda: plan.build_many(list(plan.rows(queryset)[:size])), args.repeat
+                )
+                fast_render, fast_body = best(lambda: ORJSONRenderer().render(fast_data), args.repeat)
+                assert fast_body == slow_body, f"{name}: output differs at {size} rows"
+                for label, build, render in (
+                    ("drf", slow_build, slow_render), ("fastpath", fast_build, fast_render),
+                ):
+                    print(f"{name:<14} {size:>5} {label:>9} {build:>19.2f} {render:>10.2f} {build + render:>9.2f}")
+                print(f"{'':<14} {'':>5} {'speedup':>9} {slow_build / fast_build:>18.1f}x "
+                      f"{slow_render / fast_render:>9.1f}x {(slow_build + slow_render) / (fast_build + fast_render):>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Throughput of `manage.py analyze_requests_log` on a synthetic request log.
+
+    python -m benchmarks.requests_log --megabytes 1000 --format json
+
+Writes a log of roughly the requested size (text or JSON lines, as
+RequestLoggingMiddleware does) to a temporary directory, optionally gzips a
+copy, and times chats.logstats.analyze over it.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+ROUTES = [
+    ("/api/conversations/", "conversations-list"),
+    ("/api/conversations/{id}/messages/", "conversations-messages"),
+    ("/api/messages/", "messages-list"),
+    ("/api/messages/{id}/", "messages-detail"),
+    ("/api/messages/search/", "messages-search"),
+    ("/api/token/", "token_obtain_pair"),
+]
+
+
+def write_log(path, megabytes, fmt, seed=0):
+    rng = random.Random(seed)
+    users = [f"user{i}@example.com" for i in range(5000)] + ["Anonymous"] * 500
+    ids = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(2000)]
+    started = datetime(2026, 1, 1)
+    target = megabytes * 1024 * 1024
+    written = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while written < target:
+            lines = []
+            for _ in range(10000):
+                template, route = rng.choice(ROUTES)
+                path_ = template.replace("{id}", rng.choice(ids))
+                when = started + timedelta(seconds=written / 200)
+                user = rng.choice(users)
+                if fmt == "json":
+                    lines.append(json.dumps({
+                        "time": when.isoformat(), "method": "GET", "path": path_, "route": route,
+                        "status": 200, "duration_ms": round(rng.lognormvariate(1.5, 0.8), 3),
+                        "db_queries": 3, "db_time_ms": 0.8, "response_bytes": 2048,
+                        "user": None if user == "Anonymous" else str(uuid.UUID(int=hash(user) % 2**128)),
+                    }, separators=(",", ":")) + "\n")
+                else:
+                    lines.append(f"{when} - User: {user} - Path: {path_}\n")
+            chunk = "".join(lines)
+            f.write(chunk)
+            written += len(chunk)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--megabytes", type=int, default=200)
+    parser.add_argument("--format", choices=["text", "json"], default="json")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--gzip", action="store_true", help="Also time a gzipped copy.")
+    args = parser.parse_args()
+
+    from chats import logstats
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "requests.log")
+        size = write_log(path, args.megabytes, args.format)
+        files = [path]
+        if args.gzip:
+            with open(path, "rb") as source, gzip.open(path + ".1.gz", "wb", compresslevel=1) as target:
+                shutil.copyfileobj(source, target)
+            files.append(path + ".1.gz")
+
+        for name in files:
+            start = time.perf_counter()
+            stats = logstats.analyze([name], jobs=args.jobs, capacity=10000)
+            elapsed = time.perf_counter() - start
+            print(
+                f"{os.path.basename(name)}: {size / 1e6:.0f} MB, {stats.parsed} requests, "
+                f"{elapsed:.2f}s with {args.jobs} job(s), {size / 1e6 / elapsed:.0f} MB/s, "
+                f"p99 {stats.latency.quantile(0.99) or 0:.2f} ms"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+What the global "messages" change counter (chats.sync) costs concurrent
+writers.
+
+    python -m benchmarks.sync_contention --messages 200
+
+Fills a throwaway database (benchmarks.asgi_settings) with one conversation
+per writer, then has 1, 4 and 16 threads each send messages to their own
+conversation, one transaction per message, as the API does. Every message
+takes the next number from the one ChangeSequence row and holds its lock
+until it commits, so writers to unrelated conversations queue behind each
+other. The same run with numbering switched off shows how much of the time
+that queue accounts for.
+
+On SQLite the database write lock already serializes every writer, so the
+counter only adds its two statements; on a server database the counter
+row is the point where writers to different conversations meet.
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+WRITERS = (1, 4, 16)
+
+
+def setup(bench_dir, conversations):
+    os.environ["CHATS_BENCH_DIR"] = bench_dir
+    os.environ["DJANGO_SETTINGS_MODULE"] = "benchmarks.asgi_settings"
+    import django
+    django.setup()
+
+    from django.core.management import call_command
+
+    from chats.models import Conversation, User
+
+    call_command("migrate", verbosity=0)
+    user = User.objects.create(username="bench", email="bench@example.com", password_hash="x")
+    Through = Conversation.participants.through
+    conversations = [Conversation.objects.create() for _ in range(conversations)]
+    Through.objects.bulk_create(
+        Through(conversation=conversation, user=user) for conversation in conversations
+    )
+    return user, conversations
+
+
+def send(user, conversation, count, start, errors):
+    from django.db import connection
+
+    from chats.models import Message
+
+    start.wait()
+    try:
+        for i in range(count):
+            Message.objects.create(sender=user, conversation=conversation, message_body=f"message {i}")
+    except Exception as exc:  # reported, so a locked database does not pass as fast
+        errors.append(exc)
+    finally:
+        connection.close()
+
+
+def run(user, conversations, writers, count):
+    """Messages per second with `writers` threads sending `count` messages each."""
+    start, errors = threading.Barrier(writers + 1), []
+    threads = [
+        threading.Thread(target=send, args=(user, conversations[i], count, start, errors))
+        for i in range(writers)
+    ]
+    for thread in threads:
+        thread.start()
+    start.wait()
+    began = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - began
+    if errors:
+        raise errors[0]
+    return writers * count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--messages", type=int, default=200, help="messages per writer")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as bench_dir:
+        user, conversations = setup(bench_dir, max(WRITERS))
+
+        from chats.models import ChangeSequence
+
+        print(f"{'writers':>7} {'numbered msg/s':>15} {'unnumbered msg/s':>17} {'counter share':>14}")
+        for writers in WRITERS:
+            numbered = run(user, conversations, writers, args.messages)
+            with mock.patch.object(ChangeSequence, "take", return_value=0):
+                unnumbered = run(user, conversations, writers, args.messages)
+            share = 1 - numbered / unnumbered
+            print(f"{writers:>7} {numbered:>15.0f} {unnumbered:>17.0f} {share:>13.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Denormalized conversation activity.
+
+Conversation.last_message_at, last_message_id and message_count are kept in
+step with Message writes so the inbox can be sorted and counted without
+aggregating over the message table, along with the preview of the latest
+message (last_message_sender_id, last_message_body). Every update is a
+single UPDATE with F() expressions, so concurrent writers never lose an
+increment.
+
+Archived messages still belong to their conversation: they are counted,
+and the latest message may be an archived one. That is why the preview is
+stored rather than joined from the message table, which may no longer
+hold it (or be in the same database as the archive).
+
+Changes that leave no trace in those fields (message edits and deletes,
+participants joining, leaving or editing their profile) stamp changed_at,
+and the participant ones also bump participants_version, so chats.conditional
+can tell a list changed from the conversation rows alone.
+
+Code that removes messages without them really going away (archiving) wraps
+the deletes in `suspended()`.
+"""
+import contextvars
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
+from django.db.models import Count, DateTimeField, TextField, UUIDField
+from django.db.models.functions import Coalesce
+
+from .models import ArchivedMessage, Conversation, Message
+
+_tracking = contextvars.ContextVar("chats_activity_tracking", default=True)
+
+
+@contextmanager
+def suspended():
+    """Skip activity updates for message writes made inside the block."""
+    token = _tracking.set(False)
+    try:
+        yield
+    finally:
+        _tracking.reset(token)
+
+
+def is_tracking():
+    return _tracking.get()
+
+
+def _is_newer(sent_at, message_id):
+    return (
+        Q(last_message_at__isnull=True)
+        | Q(last_message_at__lt=sent_at)
+        | Q(last_message_at=sent_at, last_message_id__lt=message_id)
+    )
+
+
+def messages_created(conversation_id, messages):
+    """
+    Record newly inserted `messages` of one conversation: bump the count and
+    move the last-message pointer if the newest of them is more recent.
+    """
+    messages = list(messages)
+    if not messages:
+        return
+    newest = max(messages, key=lambda m: (m.sent_at, str(m.pk)))
+    newer = _is_newer(newest.sent_at, newest.pk)
+    latest = {
+        "last_message_at": Value(newest.sent_at, output_field=DateTimeField()),
+        "last_message_id": Value(newest.pk, output_field=UUIDField()),
+        "last_message_sender_id": Value(newest.sender_id, output_field=UUIDField()),
+        "last_message_body": Value(newest.message_body, output_field=TextField()),
+    }
+    Conversation.objects.filter(pk=conversation_id).update(
+        message_count=F("message_count") + len(messages),
+        **{name: Case(When(newer, then=value), default=F(name)) for name, value in latest.items()},
+    )
+
+
+def message_created(message):
+    messages_created(message.conversation_id, [message])
+
+
+def message_deleted(message):
+    """
+    Record a deleted message. If it was the conversation's latest one, the
+    pointer moves back to the newest remaining message, archived or not.
+    """
+    conversations = Conversation.objects.filter(pk=message.conversation_id)
+    conversations.update(
+        message_count=Case(
+            When(message_count__gt=0, then=F("message_count") - 1), default=Value(0),
+        ),
+        changed_at=timezone.now(),
+    )
+    if conversations.filter(last_message_id=message.pk).update(**_latest_hot(OuterRef("pk"))):
+        _fall_back_to_archive([message.conversation_id])
+
+
+def message_edited(message):
+    conversations = Conversation.objects.filter(pk=message.conversation_id)
+    conversations.filter(last_message_id=message.pk).update(
+        last_message_sender_id=message.sender_id, last_message_body=message.message_body,
+    )
+    conversations_changed(conversations)
+
+
+def conversations_changed(conversations, participants=False):
+    """
+    Stamp changed_at on `conversations` (a queryset), and bump
+    participants_version when their participants changed.
+    """
+    updates = {"changed_at": timezone.now()}
+    if participants:
+        updates["participants_version"] = F("participants_version") + 1
+    return conversations.update(**updates)
+
+
+def _latest_message(conversation):
+    return Message.objects.filter(conversation=conversation).order_by("-sent_at", "-id")
+
+
+def _latest_hot(conversation):
+    """Activity field updates pointing at the newest hot message, or None."""
+    latest = _latest_message(conversation)
+    return {
+        "last_message_at": Subquery(latest.values("sent_at")[:1]),
+        "last_message_id": Subquery(latest.values("id")[:1]),
+        "last_message_sender_id": Subquery(latest.values("sender_id")[:1]),
+        "last_message_body": Subquery(latest.values("message_body")[:1]),
+    }
+
+
+def _fall_back_to_archive(conversation_ids):
+    """
+    Point those of `conversation_ids` left without a latest hot message at
+    their newest archived one. Archived messages are all older than hot
+    ones, so this only matters once a conversation has no hot messages.
+    The archive may be another database: read it on its own, per
+    conversation.
+    """
+    empty = Conversation.objects.filter(pk__in=conversation_ids, last_message_id__isnull=True)
+    for conversation_id in empty.values_list("pk", flat=True):
+        newest = (
+            ArchivedMessage.objects.filter(conversation_id=conversation_id)
+            .order_by("-sent_at", "-id")
+            .values("id", "sent_at", "sender_id", "message_body")
+            .first()
+        )
+        if newest is not None:
+            Conversation.objects.filter(pk=conversation_id, last_message_id__isnull=True).update(
+                last_message_at=newest["sent_at"],
+                last_message_id=newest["id"],
+                last_message_sender_id=newest["sender_id"],
+                last_message_body=newest["message_body"],
+            )
+
+
+def rebuild(conversation_ids):
+    """
+    Recompute the activity fields of the given conversations from the
+    message table, in one UPDATE with correlated subqueries, then add what
+    is in the archive: archived messages are counted, and are the latest
+    of conversations without hot messages.
+    """
+    conversation_ids = list(conversation_ids)
+    counts = (
+        Message.objects.filter(conversation=OuterRef("pk"))
+        .order_by()
+        .values("conversation")
+        .annotate(total=Count("pk"))
+        .values("total")
+    )
+    updated = Conversation.objects.filter(pk__in=conversation_ids).update(
+        message_count=Coalesce(Subquery(counts), Value(0)),
+        **_latest_hot(OuterRef("pk")),
+    )
+    archived = (
+        ArchivedMessage.objects.filter(conversation_id__in=conversation_ids)
+        .order_by()
+        .values("conversation_id")
+        .annotate(total=Count("pk"))
+    )
+    for row in archived:
+        Conversation.objects.filter(pk=row["conversation_id"]).update(
+            message_count=F("message_count") + row["total"],
+        )
+    _fall_back_to_archive(conversation_ids)
+    return updated
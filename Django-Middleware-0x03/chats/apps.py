@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class ChatsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chats'
+
+    def ready(self):
+        from . import signals  # noqa: F401  (connects signal receivers)
+        from . import content_filter
+        content_filter.reload()  # build the word automaton once, up front
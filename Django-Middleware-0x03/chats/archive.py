@@ -0,0 +1,74 @@
+"""
+Hot/cold message storage.
+
+archive_messages moves messages older than CHATS_ARCHIVE_AFTER_DAYS from
+chats_message into ArchivedMessage, which lives in the database alias named
+by CHATS_ARCHIVE_DATABASE (see chats.db_routers.ArchiveRouter). Moving them
+keeps the hot table and its indexes small.
+
+Every archived row is older than every hot row of its conversation, so a
+history walk newest first only has to look in the archive once it reaches
+past the hot rows. Walking oldest first, it starts in the archive: the
+current cutoff is no bound on what was archived, since archive_messages
+--older-than-days and a later change of CHATS_ARCHIVE_AFTER_DAYS both move
+the line.
+"""
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import router, transaction
+from django.utils import timezone
+
+from . import activity
+from .models import ArchivedMessage, Message, User
+
+
+def archive_after():
+    return timedelta(days=getattr(settings, "CHATS_ARCHIVE_AFTER_DAYS", 180))
+
+
+def cutoff(now=None):
+    """Messages sent before this moment belong in the archive."""
+    return (now or timezone.now()) - archive_after()
+
+
+def archive_batch(before, batch_size):
+    """
+    Move up to `batch_size` of the oldest hot messages sent before `before`
+    into the archive. Returns the number of messages moved.
+
+    The archive copy is written first and skips rows already there, so a
+    batch interrupted between the two steps is finished by the next run.
+    """
+    rows = list(
+        Message.objects.filter(sent_at__lt=before)
+        .order_by("sent_at", "id")
+        .values("id", "sender_id", "conversation_id", "message_body", "sent_at")[:batch_size]
+    )
+    if not rows:
+        return 0
+
+    archive_db = router.db_for_write(ArchivedMessage)
+    with transaction.atomic(using=archive_db):
+        ArchivedMessage.objects.using(archive_db).bulk_create(
+            [ArchivedMessage(**row) for row in rows], ignore_conflicts=True
+        )
+
+    # Archived messages still belong to their conversation's history, so
+    # the denormalized activity fields, preview included, are left alone
+    # (chats.activity counts them too).
+    with transaction.atomic(using=router.db_for_write(Message)), activity.suspended():
+        Message.objects.filter(pk__in=[row["id"] for row in rows]).delete()
+    return len(rows)
+
+
+def as_messages(archived):
+    """
+    Turn ArchivedMessage rows into unsaved Message instances with their
+    senders attached (one query), so they serialize like hot messages.
+    """
+    messages = [row.as_message() for row in archived]
+    senders = User.objects.in_bulk({m.sender_id for m in messages})
+    for message in messages:
+        message.sender = senders.get(message.sender_id)
+    return messages
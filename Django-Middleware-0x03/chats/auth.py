@@ -1,8 +1,213 @@
-from rest_framework_simplejwt.tokens import RefreshToken
+"""
+JWT tokens that carry what access checks need.
+
+Tokens minted here (get_tokens_for_user and the token endpoints) carry, on
+top of simplejwt's claims:
+- role: User.role
+- username, email
+- conversations: ids of the conversations the user participates in, left
+  out when there are more than CHATS_JWT_CLAIMS["MAX_CONVERSATIONS"]
+- claims_version: CHATS_JWT_CLAIMS["VERSION"] at minting time
+
+ClaimsJWTAuthentication and the chats middleware turn a token into a
+lightweight user without touching the database: a User instance holding
+the id, username, email and role from the claims, every other field
+deferred (loaded on first access). A token falls back to loading the user
+row, as plain simplejwt does, when:
+- it has no claims, or a claims_version below the configured VERSION
+- it was issued before its user was revoked: chats.signals revokes a user
+  whose role, name, email or is_active changes, or who is deleted, by
+  recording the time in the REVOCATION_CACHE, so a deactivated user is
+  rejected on their next request
+- the REVOCATION_CACHE is not shared by all workers (LocMemCache), since a
+  revocation recorded by one worker would go unseen by the others
+
+The conversations claim only ever denies: chats.membership answers False
+for a conversation missing from it, and confirms the others against the
+participants table, so a removal takes effect at once. Conversations
+joined after the token was minted are allowed once it is refreshed.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.serializers import TokenObtainPairSerializer, TokenRefreshSerializer
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from . import caching
+from .models import User
+
+DEFAULTS = {
+    "VERSION": 1,
+    "MAX_CONVERSATIONS": 200,
+    # Cache alias of the revocation times; must be shared by all workers
+    "REVOCATION_CACHE": "default",
+}
+
+REQUEST_ATTR = "_chats_token_user"
+REVOKED_KEY = "chats:claims-revoked:{}"
+
+
+def claims_settings():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, "CHATS_JWT_CLAIMS", {}))
+    return options
+
+
+def add_claims(token, user):
+    """Add the chats claims for `user` to `token` and return it."""
+    options = claims_settings()
+    token["role"] = user.role
+    token["username"] = user.username
+    token["email"] = user.email
+    token["claims_version"] = options["VERSION"]
+    conversation_ids = list(
+        user.conversations.values_list("pk", flat=True)[:options["MAX_CONVERSATIONS"] + 1]
+    )
+    if len(conversation_ids) <= options["MAX_CONVERSATIONS"]:
+        token["conversations"] = [str(pk) for pk in conversation_ids]
+    return token
+
 
 def get_tokens_for_user(user):
-    refresh = RefreshToken.for_user(user)
+    refresh = add_claims(RefreshToken.for_user(user), user)
     return {
         'refresh': str(refresh),
         'access': str(refresh.access_token),
     }
+
+
+def revoke(user_ids):
+    """Make the tokens issued to `user_ids` until now reload their user."""
+    revoked_at = int(time.time())
+    # Nothing issued before now outlives the longest token lifetime
+    timeout = int(max(api_settings.ACCESS_TOKEN_LIFETIME, api_settings.REFRESH_TOKEN_LIFETIME).total_seconds())
+    caches[claims_settings()["REVOCATION_CACHE"]].set_many(
+        {REVOKED_KEY.format(user_id): revoked_at for user_id in set(user_ids)}, timeout=timeout,
+    )
+
+
+def is_revoked(token):
+    revoked_at = caches[claims_settings()["REVOCATION_CACHE"]].get(
+        REVOKED_KEY.format(token[api_settings.USER_ID_CLAIM])
+    )
+    # Seconds resolution: a token issued in the second of the revocation goes too
+    return revoked_at is not None and token.get("iat", 0) <= revoked_at
+
+
+def has_current_claims(token):
+    options = claims_settings()
+    return (
+        "role" in token
+        and token.get("claims_version", 0) >= options["VERSION"]
+        and caching.is_shared(options["REVOCATION_CACHE"])
+        and not is_revoked(token)
+    )
+
+
+def user_from_claims(token):
+    """
+    A User built from the token's claims, with every other field deferred.
+    Only for tokens with current claims: those of a user deactivated since
+    were revoked, so is_active holds.
+    """
+    values = {
+        "id": User._meta.pk.to_python(token[api_settings.USER_ID_CLAIM]),
+        "username": token.get("username", ""),
+        "email": token.get("email", ""),
+        "role": token["role"],
+        "is_active": True,
+    }
+    fields = [f.attname for f in User._meta.concrete_fields if f.attname in values]
+    user = User.from_db(DEFAULT_DB_ALIAS, fields, [values[name] for name in fields])
+    scope = token.get("conversations")
+    user.token_conversations = frozenset(scope) if scope is not None else None
+    return user
+
+
+def load_user(token):
+    """The user row of `token`, or None if it is gone or inactive."""
+    user_id = token[api_settings.USER_ID_CLAIM]
+    user = User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).first()
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+async def aload_user(token):
+    user_id = token[api_settings.USER_ID_CLAIM]
+    user = await User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}).afirst()
+    if user is None or not user.is_active:
+        return None
+    return user
+
+
+def bearer_token(request):
+    """The validated access token sent with `request`, or None."""
+    header = request.META.get("HTTP_AUTHORIZATION", "")
+    scheme, _, raw = header.partition(" ")
+    if scheme not in api_settings.AUTH_HEADER_TYPES or not raw:
+        return None
+    try:
+        return AccessToken(raw.strip())
+    except TokenError:
+        return None
+
+
+def token_user(request):
+    """
+    The user of the bearer token on `request`, or None without a valid one.
+    Built from the claims when they are current, loaded from the database
+    otherwise. Remembered on the request.
+    """
+    if hasattr(request, REQUEST_ATTR):
+        return getattr(request, REQUEST_ATTR)
+    token = bearer_token(request)
+    user = None
+    if token is not None:
+        user = user_from_claims(token) if has_current_claims(token) else load_user(token)
+    setattr(request, REQUEST_ATTR, user)
+    return user
+
+
+async def atoken_user(request):
+    if hasattr(request, REQUEST_ATTR):
+        return getattr(request, REQUEST_ATTR)
+    token = bearer_token(request)
+    user = None
+    if token is not None:
+        user = user_from_claims(token) if has_current_claims(token) else await aload_user(token)
+    setattr(request, REQUEST_ATTR, user)
+    return user
+
+
+class ClaimsJWTAuthentication(JWTAuthentication):
+    """JWTAuthentication that answers from the token's claims when it can."""
+
+    def get_user(self, validated_token):
+        if has_current_claims(validated_token):
+            return user_from_claims(validated_token)
+        return super().get_user(validated_token)
+
+
+class ChatsTokenObtainPairSerializer(TokenObtainPairSerializer):
+
+    @classmethod
+    def get_token(cls, user):
+        return add_claims(super().get_token(user), user)
+
+
+class ChatsTokenRefreshSerializer(TokenRefreshSerializer):
+    """Re-read the claims from the user row whenever a token is refreshed."""
+
+    def validate(self, attrs):
+        refresh = self.token_class(attrs["refresh"])
+        user = load_user(refresh)
+        if user is not None:
+            add_claims(refresh, user)
+        attrs = dict(attrs, refresh=str(refresh))
+        return super().validate(attrs)
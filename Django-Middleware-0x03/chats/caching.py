@@ -0,0 +1,17 @@
+"""
+Helpers for features that rely on Django's cache being shared by workers.
+"""
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+# Backends that keep their entries in one process (or nowhere)
+PROCESS_LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+
+def is_shared(alias):
+    """
+    Whether what one worker writes to the cache `alias` is seen by the
+    others, so it can carry invalidations and revocations between them.
+    """
+    return not isinstance(caches[alias], PROCESS_LOCAL_BACKENDS)
@@ -0,0 +1,83 @@
+"""
+Conditional GETs for the conversation and message lists.
+
+Polling clients send back the ETag (If-None-Match) or Last-Modified
+(If-Modified-Since) of their last response and get a 304 when nothing
+changed. The validators come from one aggregate query over the user's
+conversations (or the one conversation of /conversations/<id>/messages/),
+run before any list query or serializer:
+- how many conversations there are and their total message count
+- the newest last_message_at, and for a single conversation last_message_id
+- the newest changed_at and the sum of participants_version, which
+  chats.activity bumps on edits, deletes and participant changes
+Every write that changes one of these lists moves one of them.
+
+The ETag also covers the user, the full path with its query string and the
+Accept header, so pages, filters and formats each validate on their own.
+Last-Modified has a one-second resolution: it is only sent once its second
+is over, so a change later in the same second cannot hide behind it, and it
+cannot see a conversation the user was removed from. Clients should prefer
+the ETag.
+"""
+import hashlib
+import time
+
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+
+def validators(request, conversations, single=False):
+    """
+    (etag, last_modified timestamp or None) for a list drawn from
+    `conversations`, or None when `single` and the conversation is not
+    there (the view then answers as usual, with its 404).
+    """
+    columns = {
+        "conversations": Count("pk"),
+        "messages": Sum("message_count"),
+        "last_message_at": Max("last_message_at"),
+        "changed_at": Max("changed_at"),
+        "created_at": Max("created_at"),
+        "participants_version": Sum("participants_version"),
+    }
+    if single:
+        columns["last_message_id"] = Max("last_message_id")
+    row = conversations.order_by().aggregate(**columns)
+    if single and not row["conversations"]:
+        return None
+
+    key = repr((
+        str(request.user.pk), request.get_full_path(), request.META.get("HTTP_ACCEPT", ""),
+        sorted((name, str(value)) for name, value in row.items()),
+    ))
+    etag = 'W/"%s"' % hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    stamps = [row[name] for name in ("last_message_at", "changed_at", "created_at") if row[name]]
+    last_modified = int(max(stamps).timestamp()) if stamps else None
+    if last_modified is not None and last_modified >= int(time.time()):
+        last_modified = None
+    return etag, last_modified
+
+
+def conditional_response(request, conversations, respond, single=False):
+    """
+    A 304 when the request's If-None-Match / If-Modified-Since still match
+    the validators of `conversations`, else respond(). Either way the
+    response carries the validators.
+    """
+    current = validators(request, conversations, single)
+    if current is None:
+        return respond()
+    etag, last_modified = current
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = respond()
+        if response.status_code != 200:
+            return response
+    response.headers["ETag"] = etag
+    if last_modified is not None:
+        response.headers["Last-Modified"] = http_date(last_modified)
+    # Per-user validators: only the client may store these, and must revalidate
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
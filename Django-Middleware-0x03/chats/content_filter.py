@@ -0,0 +1,231 @@
+"""
+Offensive-language filter for message bodies.
+
+Terms (single words or phrases) are compiled into an Aho-Corasick automaton
+whose alphabet is whole words: a message is split into words once, and each
+word is one dict lookup plus, on a partial phrase match, a few failure-link
+hops. The cost per message depends on its length, not on the size of the
+word list, and terms only ever match whole words ("ass" does not match
+"class").
+
+Each term has an action:
+- block: the message is rejected
+- mask: the matched words are replaced by MASK_CHAR
+- flag: the message is stored as is, with Message.flagged_at set
+
+Terms come from CHATS_CONTENT_FILTER["TERMS"] (default ACTION) and from the
+WORDLIST file: one term per line, "#" comments, and "[block]", "[mask]" or
+"[flag]" lines that set the action of the terms below them. The automaton
+is built at startup and rebuilt when the word list file changes (checked at
+most every CHECK_INTERVAL seconds) or when reload() is called.
+"""
+import logging
+import os
+import re
+import time
+from collections import deque, namedtuple
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "WORDLIST": None,
+    "TERMS": [],
+    "ACTION": "mask",
+    "MASK_CHAR": "*",
+    "CHECK_INTERVAL": 1.0,
+}
+
+# Stronger actions win when a message matches terms with different actions
+ACTIONS = {"flag": 1, "mask": 2, "block": 3}
+
+_WORD = re.compile(r"\w+")
+_SECTION = re.compile(r"^\[(\w+)\]$")
+
+Verdict = namedtuple("Verdict", "action text terms")
+
+
+def filter_settings():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, "CHATS_CONTENT_FILTER", {}))
+    return options
+
+
+def words(text):
+    return [word.casefold() for word in _WORD.findall(text)]
+
+
+def read_wordlist(path, default_action):
+    """Yield (term, action) pairs from a word list file."""
+    action = default_action
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            section = _SECTION.match(line)
+            if section:
+                action = section.group(1).lower()
+                if action not in ACTIONS:
+                    raise ValueError(f"Unknown content filter action {action!r} in {path}.")
+                continue
+            yield line, action
+
+
+class ContentFilter:
+    """An Aho-Corasick automaton over words, built from (term, action) pairs."""
+
+    source = None
+    source_mtime = None
+    check_interval = DEFAULTS["CHECK_INTERVAL"]
+
+    def __init__(self, terms=(), mask_char="*"):
+        self.mask_char = mask_char
+        # State 0 is the root. goto[s] maps a word to the next state; out[s]
+        # lists (length in words, action, term) for every term ending in s.
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        self.size = 0
+        for term, action in terms:
+            self.add(term, action)
+        self.link()
+
+    def add(self, term, action):
+        if action not in ACTIONS:
+            raise ValueError(f"Unknown content filter action {action!r}.")
+        sequence = words(term)
+        if not sequence:
+            return
+        state = 0
+        for word in sequence:
+            next_state = self.goto[state].get(word)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][word] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = next_state
+        self.out[state] += ((len(sequence), action, term),)
+        self.size += 1
+
+    def link(self):
+        """Compute failure links breadth first and merge their outputs."""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for word, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and word not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(word, 0)
+                self.out[child] += self.out[self.fail[child]]
+
+    def scan(self, text):
+        """
+        Return a Verdict: the strongest action matched (None if clean), the
+        text with masked terms replaced, and the matched terms.
+        """
+        goto, fail, out = self.goto, self.fail, self.out
+        root = goto[0]
+        state = 0
+        spans = []
+        hits = []
+        for match in _WORD.finditer(text):
+            word = match.group().casefold()
+            spans.append(match.span())
+            if state == 0:
+                # Fast path: most words of most messages start no term
+                state = root.get(word, 0)
+            else:
+                while state and word not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(word, 0)
+            if out[state]:
+                end = len(spans)
+                for length, action, term in out[state]:
+                    hits.append((spans[end - length][0], spans[end - 1][1], action, term))
+
+        if not hits:
+            return Verdict(None, text, [])
+        action = max((hit[2] for hit in hits), key=ACTIONS.__getitem__)
+        masked = [(start, end) for start, end, hit_action, _ in hits if hit_action == "mask"]
+        if masked and action != "block":
+            text = self.mask(text, masked)
+        return Verdict(action, text, [hit[3] for hit in hits])
+
+    def mask(self, text, spans):
+        chars = list(text)
+        for start, end in spans:
+            for i in range(start, end):
+                if chars[i].isalnum() or chars[i] == "_":
+                    chars[i] = self.mask_char
+        return "".join(chars)
+
+    def __len__(self):
+        return self.size
+
+
+_filter = None
+_checked_at = 0.0
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def reload():
+    """Rebuild the automaton from settings and the word list file now."""
+    global _filter, _checked_at
+    options = filter_settings()
+    terms = [(term, options["ACTION"]) for term in options["TERMS"]]
+    wordlist = options["WORDLIST"]
+    mtime = None
+    if wordlist:
+        mtime = _mtime(wordlist)
+        terms.extend(read_wordlist(wordlist, options["ACTION"]))
+    content_filter = ContentFilter(terms, mask_char=options["MASK_CHAR"])
+    content_filter.source = wordlist and str(wordlist)
+    content_filter.source_mtime = mtime
+    content_filter.check_interval = options["CHECK_INTERVAL"]
+    _filter, _checked_at = content_filter, time.monotonic()
+    return content_filter
+
+
+def current():
+    """
+    The active filter. A word list that changed on disk is picked up here;
+    if it cannot be read, the filter built from the previous version stays.
+    """
+    global _checked_at
+    content_filter = _filter
+    if content_filter is None:
+        return reload()
+    source = content_filter.source
+    if source and time.monotonic() - _checked_at >= content_filter.check_interval:
+        _checked_at = time.monotonic()
+        if _mtime(source) != content_filter.source_mtime:
+            try:
+                return reload()
+            except (OSError, ValueError):
+                logger.exception("Could not reload the content filter word list %s", source)
+    return content_filter
+
+
+def scan(text):
+    return current().scan(text)
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    global _filter
+    if setting == "CHATS_CONTENT_FILTER":
+        _filter = None
@@ -0,0 +1,227 @@
+"""
+Primary/replica database routing.
+
+Writes always go to the primary ("default"). Reads go to one of the aliases
+in settings.CHATS_READ_REPLICAS, but only while ReplicaRoutingMiddleware has
+marked the current request as replica-safe: a GET/HEAD/OPTIONS request from a
+client that has not written in the last CHATS_REPLICA_STICKY_SECONDS.
+Everything else (unsafe methods, management commands, tests, shell) reads
+from the primary. Without replicas the middleware is not loaded.
+
+The read-your-writes window travels with the client as a signed cookie,
+so every worker honours it without shared state. Clients that drop
+cookies (most API clients) are also remembered in the
+CHATS_REPLICA_STICKY_CACHE cache, by user id when the session or a JWT
+bearer token (see chats.auth) identifies the user and by a hash of the
+Authorization header otherwise, but only when that cache is shared by the
+workers: a per-process cache would only pin the one worker that saw the
+write.
+
+Locally, two SQLite files can stand in for the pair: copy db.sqlite3 to
+replica.sqlite3 and start the server with CHATS_REPLICA_DB=replica.sqlite3.
+"""
+import contextvars
+import hashlib
+import random
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import caching
+from .middleware import SyncAsyncMiddleware, get_user, request_user
+
+PRIMARY = "default"
+STICKY_KEY = "chats:db-sticky:{}"
+STICKY_COOKIE = "chats_primary_reads"
+STICKY_SALT = "chats.db_routers.sticky"
+
+_routing = contextvars.ContextVar("chats_db_routing", default=None)
+
+
+class RoutingState:
+    __slots__ = ("use_replica", "wrote")
+
+    def __init__(self, use_replica):
+        self.use_replica = use_replica
+        self.wrote = False
+
+
+def read_replicas():
+    return getattr(settings, "CHATS_READ_REPLICAS", [])
+
+
+def sticky_seconds():
+    return getattr(settings, "CHATS_REPLICA_STICKY_SECONDS", 5)
+
+
+def sticky_cache_alias():
+    return getattr(settings, "CHATS_REPLICA_STICKY_CACHE", "default")
+
+
+@contextmanager
+def primary_reads():
+    """
+    Read from the primary inside the block, e.g. to fill a cache that must
+    not be filled from a lagging replica.
+    """
+    outer = _routing.get()
+    state = RoutingState(False)
+    token = _routing.set(state)
+    try:
+        yield
+    finally:
+        _routing.reset(token)
+        if outer is not None and state.wrote:
+            outer.wrote = True
+
+
+class PrimaryReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _routing.get()
+        replicas = read_replicas()
+        if state is None or not state.use_replica or not replicas:
+            return PRIMARY
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _routing.get()
+        if state is not None:
+            state.wrote = True
+        return PRIMARY
+
+    def allow_relation(self, obj1, obj2, **hints):
+        pool = {PRIMARY, *read_replicas()}
+        if obj1._state.db in pool and obj2._state.db in pool:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas receive their schema from the primary
+        if db in read_replicas():
+            return False
+        return None
+
+
+class ArchiveRouter:
+    """
+    Keep ArchivedMessage in the CHATS_ARCHIVE_DATABASE alias ("default"
+    unless a separate archive database is configured), and keep every other
+    model out of that alias. List it before PrimaryReplicaRouter.
+    """
+
+    @staticmethod
+    def archive_db():
+        return getattr(settings, "CHATS_ARCHIVE_DATABASE", PRIMARY)
+
+    @staticmethod
+    def is_archive(model):
+        return model._meta.app_label == "chats" and model._meta.model_name == "archivedmessage"
+
+    def db_for_read(self, model, **hints):
+        if self.is_archive(model):
+            return self.archive_db()
+        return None
+
+    def db_for_write(self, model, **hints):
+        if self.is_archive(model):
+            return self.archive_db()
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        archive_db = self.archive_db()
+        if archive_db == PRIMARY:
+            return None
+        if app_label == "chats" and model_name == "archivedmessage":
+            return db == archive_db
+        if db == archive_db:
+            return False
+        return None
+
+
+class ReplicaRoutingMiddleware(SyncAsyncMiddleware):
+    """
+    Decide per request whether reads may use a replica, and start the
+    read-your-writes window for clients that wrote. Not loaded unless
+    CHATS_READ_REPLICAS names at least one replica.
+
+    The routing state is a context variable, so concurrent requests on one
+    event loop or thread pool never see each other's decision; it is copied
+    into the thread that runs a sync view.
+    """
+
+    SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+    def __init__(self, get_response):
+        if not read_replicas():
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        alias = sticky_cache_alias()
+        self.cache = caches[alias] if caching.is_shared(alias) else None
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        client = self.client_key(request, request_user(request)) if self.cache else None
+        use_replica = self.may_use_replica(request) and not self.has_sticky_cookie(request)
+        if use_replica and client:
+            use_replica = not self.cache.get(STICKY_KEY.format(client))
+        state = RoutingState(use_replica)
+        token = _routing.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+        if state.wrote:
+            self.set_sticky_cookie(response)
+            if client:
+                self.cache.set(STICKY_KEY.format(client), True, timeout=sticky_seconds())
+        return response
+
+    async def __acall__(self, request):
+        client = self.client_key(request, await get_user(request)) if self.cache else None
+        use_replica = self.may_use_replica(request) and not self.has_sticky_cookie(request)
+        if use_replica and client:
+            use_replica = not await self.cache.aget(STICKY_KEY.format(client))
+        state = RoutingState(use_replica)
+        token = _routing.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _routing.reset(token)
+
+        if state.wrote:
+            self.set_sticky_cookie(response)
+            if client:
+                await self.cache.aset(STICKY_KEY.format(client), True, timeout=sticky_seconds())
+        return response
+
+    def may_use_replica(self, request):
+        return request.method in self.SAFE_METHODS
+
+    @staticmethod
+    def has_sticky_cookie(request):
+        return request.get_signed_cookie(
+            STICKY_COOKIE, default=None, salt=STICKY_SALT, max_age=sticky_seconds(),
+        ) is not None
+
+    @staticmethod
+    def set_sticky_cookie(response):
+        response.set_signed_cookie(
+            STICKY_COOKIE, "1", salt=STICKY_SALT, max_age=sticky_seconds(),
+            httponly=True, samesite="Lax",
+        )
+
+    @staticmethod
+    def client_key(request, user=None):
+        if user is None:
+            user = getattr(request, "user", None)
+        if user is not None and user.is_authenticated:
+            return f"user:{user.pk}"
+        authorization = request.META.get("HTTP_AUTHORIZATION")
+        if authorization:
+            return "auth:" + hashlib.sha256(authorization.encode()).hexdigest()
+        return None
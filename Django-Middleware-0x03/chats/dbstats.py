@@ -0,0 +1,75 @@
+"""
+Per-request database statistics.
+
+track_queries() counts the queries run inside the block and the time spent
+in them:
+
+    with track_queries() as stats:
+        response = get_response(request)
+    stats.count, stats.duration
+
+Every database connection carries one connection.execute_wrapper that
+reports to the stats of the current context, if any. The active stats live
+in a context variable, so they follow the request into the thread where
+Django runs a sync view under ASGI, and concurrent requests never count
+each other's queries. Blocks nest: a query counts towards every enclosing
+track_queries() block.
+"""
+import contextvars
+import time
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+_active = contextvars.ContextVar("chats_query_stats", default=None)
+
+
+class QueryStats:
+    __slots__ = ("count", "duration", "parent")
+
+    def __init__(self, parent=None):
+        self.count = 0
+        self.duration = 0.0
+        self.parent = parent
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            stats = self
+            while stats is not None:
+                stats.count += 1
+                stats.duration += duration
+                stats = stats.parent
+
+
+def _report(execute, sql, params, many, context):
+    stats = _active.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def _install(connection, **kwargs):
+    # First in the list: connection.execute_wrapper() blocks pop the last one
+    if _report not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, _report)
+
+
+connection_created.connect(_install)
+
+
+@contextmanager
+def track_queries():
+    stats = QueryStats(parent=_active.get())
+    # Connections opened before this module was imported
+    for connection in connections.all(initialized_only=True):
+        _install(connection)
+    token = _active.set(stats)
+    try:
+        yield stats
+    finally:
+        _active.reset(token)
@@ -0,0 +1,64 @@
+"""
+Streaming NDJSON export of a conversation's message history.
+
+Rows are read with QuerySet.iterator() over a values_list() projection and
+encoded one at a time, so memory stays flat however long the conversation
+is. The archived messages come first: they are all older than the hot ones
+(see chats.archive), and may live in another database, so their senders'
+emails are looked up a chunk at a time. Each line is one message, oldest
+first:
+
+    {"id": ..., "conversation": ..., "sender": ..., "sender_email": ...,
+     "message_body": ..., "sent_at": ...}
+"""
+import json
+from itertools import islice
+
+from .models import ArchivedMessage, Message, User
+
+EXPORT_COLUMNS = ("id", "conversation_id", "sender_id", "sender__email", "message_body", "sent_at")
+ARCHIVE_COLUMNS = ("id", "conversation_id", "sender_id", "message_body", "sent_at")
+DEFAULT_CHUNK_SIZE = 2000
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+
+def encode_row(row):
+    """Encode one EXPORT_COLUMNS tuple as an NDJSON line."""
+    message_id, conversation_id, sender_id, sender_email, body, sent_at = row
+    return _encode({
+        "id": str(message_id),
+        "conversation": str(conversation_id),
+        "sender": str(sender_id),
+        "sender_email": sender_email,
+        "message_body": body,
+        "sent_at": sent_at.isoformat(),
+    }) + "\n"
+
+
+def iter_archived_rows(conversation_id, chunk_size=DEFAULT_CHUNK_SIZE):
+    """The archived messages of a conversation as EXPORT_COLUMNS tuples, oldest first."""
+    rows = (
+        ArchivedMessage.objects.filter(conversation_id=conversation_id)
+        .order_by("sent_at", "id")
+        .values_list(*ARCHIVE_COLUMNS)
+        .iterator(chunk_size=chunk_size)
+    )
+    while chunk := list(islice(rows, chunk_size)):
+        emails = dict(User.objects.filter(pk__in={row[2] for row in chunk}).values_list("pk", "email"))
+        for message_id, conversation_id, sender_id, body, sent_at in chunk:
+            yield message_id, conversation_id, sender_id, emails.get(sender_id), body, sent_at
+
+
+def iter_conversation_ndjson(conversation_id, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the NDJSON lines of a conversation, oldest message first, archived ones included."""
+    for row in iter_archived_rows(conversation_id, chunk_size):
+        yield encode_row(row)
+    rows = (
+        Message.objects.filter(conversation_id=conversation_id)
+        .order_by("sent_at", "id")
+        .values_list(*EXPORT_COLUMNS)
+        .iterator(chunk_size=chunk_size)
+    )
+    for row in rows:
+        yield encode_row(row)
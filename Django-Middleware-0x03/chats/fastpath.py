@@ -0,0 +1,222 @@
+"""
+Fast read path for list endpoints.
+
+DRF builds each item of a list response field by field through the
+serializer machinery, from model instances. For the read-only shapes of
+list pages the same output can be produced from plain database tuples:
+plan_for(serializer_class) compiles the serializer's fields once into a
+Plan, the columns to fetch with values_list() and a generated function
+turning one row into the representation dict. rows() and build_many() then
+replace queryset iteration and serializer.data.
+
+The output is the serializer's own: fields, order and values (datetimes in
+DRF's ISO 8601 form, in the current time zone). Fields without a
+plain-value equivalent are converted with the field's to_representation().
+What a plan supports:
+- plain fields, including dotted sources and primary keys of relations
+- nested serializers over non-null foreign keys (joined in the same query)
+- nested many=True serializers, or primary keys, over a many-to-many field
+  (one query per page)
+- SerializerMethodFields that the serializer maps to a nested serializer
+  over the same row in `fast_plan_fields`
+Any other field makes plan_for() return None, and the view serializes as
+usual. settings.CHATS_FAST_LISTS = False turns the fast path off. Plans are
+compiled per chats.fieldsets FieldSpec too, from the pruned fields.
+"""
+import functools
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.settings import ISO_8601, api_settings
+
+# Converter marker, bound to the current time zone at build time
+DATETIME = object()
+
+# Fields whose to_representation() returns database values unchanged
+_IDENTITY_FIELDS = (
+    serializers.CharField,
+    serializers.IntegerField,
+    serializers.BooleanField,
+    serializers.PrimaryKeyRelatedField,
+)
+
+
+class Unsupported(Exception):
+    pass
+
+
+def iso_datetime(value, tz):
+    """DateTimeField.to_representation() with the ISO 8601 format."""
+    if tz is not None:
+        value = value.astimezone(tz)
+    value = value.isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+class Plan:
+    """The columns and row builder for one serializer class."""
+
+    def __init__(self, serializer_class, spec=None):
+        serializer = serializer_class()
+        serializer.field_spec = spec
+        self.model = serializer.Meta.model
+        self.columns = ["pk"]
+        self.converters = []
+        self.to_many = []
+        expression = self.compile(serializer, "", self.model)
+        self.source = f"def build(row, c):\n    return {expression}\n"
+        namespace = {}
+        exec(self.source, namespace)
+        self.build = namespace["build"]
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns.append(name)
+        return self.columns.index(name)
+
+    def converter(self, function):
+        if function not in self.converters:
+            self.converters.append(function)
+        return self.converters.index(function)
+
+    def compile(self, serializer, prefix, model):
+        """A dict display expression building `serializer`'s representation."""
+        hints = getattr(serializer, "fast_plan_fields", {})
+        items = []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            items.append(f"{name!r}: {self.field_expression(name, field, hints, prefix, model)}")
+        return "{" + ", ".join(items) + "}"
+
+    def field_expression(self, name, field, hints, prefix, model):
+        if isinstance(field, serializers.SerializerMethodField):
+            if name not in hints:
+                raise Unsupported(name)
+            nested_class, guard = hints[name]
+            nested = self.compile(nested_class(), prefix, model)
+            return f"(None if row[{self.column(prefix + guard)}] is None else {nested})"
+
+        if field.source == "*":
+            raise Unsupported(name)
+
+        if isinstance(field, serializers.ManyRelatedField):
+            relation = model._meta.get_field(field.source)
+            child = field.child_relation
+            if not relation.many_to_many or prefix or not isinstance(child, serializers.PrimaryKeyRelatedField):
+                raise Unsupported(name)
+            if child.pk_field is not None:
+                raise Unsupported(name)
+            self.to_many.append((name, relation.related_model, relation.related_query_name()))
+            return "None"
+
+        if isinstance(field, serializers.ListSerializer):
+            relation = model._meta.get_field(field.source)
+            child = field.child
+            if not relation.many_to_many or prefix or not isinstance(child, serializers.ModelSerializer):
+                raise Unsupported(name)
+            spec = getattr(child, "field_spec", None)
+            self.to_many.append((name, Plan(type(child), spec), relation.related_query_name()))
+            return "None"
+
+        if isinstance(field, serializers.BaseSerializer):
+            relation = model._meta.get_field(field.source)
+            if not relation.many_to_one or relation.null:
+                raise Unsupported(name)
+            return self.compile(field, prefix + field.source + "__", relation.related_model)
+
+        index = self.column(prefix + "__".join(field.source_attrs))
+        if isinstance(field, serializers.UUIDField) and field.uuid_format == "hex_verbose":
+            convert = str
+        elif isinstance(field, serializers.DateTimeField) and self.plain_datetime(field):
+            convert = DATETIME
+        elif isinstance(field, serializers.ChoiceField) and all(
+            key == value for key, value in field.choice_strings_to_values.items()
+        ):
+            convert = None
+        elif isinstance(field, _IDENTITY_FIELDS) and not isinstance(field, serializers.ChoiceField):
+            convert = None
+        else:
+            convert = field.to_representation
+        if convert is None:
+            return f"row[{index}]"
+        return f"(None if row[{index}] is None else c[{self.converter(convert)}](row[{index}]))"
+
+    @staticmethod
+    def plain_datetime(field):
+        output_format = getattr(field, "format", api_settings.DATETIME_FORMAT)
+        return (
+            output_format is not None
+            and output_format.lower() == ISO_8601
+            and not hasattr(field, "timezone")
+        )
+
+    def rows(self, queryset, also=()):
+        """
+        `queryset` as named tuples of this plan's columns, and of the `also`
+        columns the view needs itself (e.g. the pagination key).
+        """
+        columns = self.columns + [name for name in also if name not in self.columns]
+        return queryset.prefetch_related(None).values_list(*columns, named=True)
+
+    def bound_converters(self):
+        tz = timezone.get_current_timezone() if settings.USE_TZ else None
+        return tuple(
+            functools.partial(iso_datetime, tz=tz) if function is DATETIME else function
+            for function in self.converters
+        )
+
+    def build_many(self, rows, fallback=None):
+        """
+        Representations of `rows`. Rows that are not tuples (model instances
+        mixed in, e.g. from the archive) go through `fallback`.
+        """
+        build, converters = self.build, self.bound_converters()
+        if fallback is None:
+            data = [build(row, converters) for row in rows]
+        else:
+            data = [
+                build(row, converters) if isinstance(row, tuple) else fallback(row)
+                for row in rows
+            ]
+        for name, child, related_query_name in self.to_many:
+            self.fill_to_many(data, rows, name, child, related_query_name)
+        return data
+
+    def fill_to_many(self, data, rows, name, child, related_query_name):
+        """Set `name` of every item: `child` Plan dicts, or a model's primary keys."""
+        pks = [row.pk for row in rows]
+        children = {pk: [] for pk in pks}
+        if isinstance(child, Plan):
+            queryset = child.model.objects.filter(**{f"{related_query_name}__in": pks})
+            converters = child.bound_converters()
+            for row in queryset.values_list(*child.columns, related_query_name):
+                children[row[-1]].append(child.build(row, converters))
+        else:
+            queryset = child.objects.filter(**{f"{related_query_name}__in": pks})
+            for pk, parent in queryset.values_list("pk", related_query_name):
+                children[parent].append(pk)
+        for item, pk in zip(data, pks):
+            item[name] = children[pk]
+
+
+# Bounded: specs come from query strings
+@functools.lru_cache(maxsize=256)
+def compiled_plan(serializer_class, spec=None):
+    try:
+        return Plan(serializer_class, spec)
+    except Unsupported:
+        return None
+
+
+def plan_for(serializer_class, spec=None):
+    """
+    The Plan for `serializer_class` pruned to `spec` (a chats.fieldsets
+    FieldSpec), or None to serialize as usual.
+    """
+    if not getattr(settings, "CHATS_FAST_LISTS", True):
+        return None
+    return compiled_plan(serializer_class, spec)
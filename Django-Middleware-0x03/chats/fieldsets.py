@@ -0,0 +1,215 @@
+"""
+Sparse fieldsets (?fields=) and opt-in expansion (?expand=) for GET responses.
+
+    ?fields=id,message_body,sender.email   only these fields; dotted paths
+                                           select fields of nested objects
+    ?expand=sender,messages.sender         embed only these relations; the
+                                           others render as primary keys
+
+Without ?expand= every relation is embedded as before; naming a nested field
+in ?fields= (sender.email) expands it. Unknown names are ignored. Only safe
+methods are affected, so writes validate against the full serializer.
+
+The parameters are parsed into a FieldSpec tree. SparseFieldsetMixin applies
+it to a serializer's fields (the root reads the request from its context and
+hands every nested serializer its branch); prune() cuts a queryset down to
+what the pruned serializer renders: only() its columns, select_related() its
+nested foreign keys and prefetch its to-many relations, nothing else.
+chats.fastpath compiles its plans from the same pruned fields.
+"""
+from collections import namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from rest_framework import serializers
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+_MISSING = object()
+
+
+class FieldSpec(namedtuple("FieldSpec", "fields expand children")):
+    """
+    One level of the tree: `fields` and `expand` are frozensets of names, or
+    None for all; `children` is a sorted tuple of (name, FieldSpec).
+    """
+    __slots__ = ()
+
+    def child(self, name):
+        for child_name, spec in self.children:
+            if child_name == name:
+                return spec
+        return FieldSpec(None, None if self.expand is None else frozenset(), ())
+
+
+def _paths(value):
+    if value is None:
+        return None
+    return [tuple(part.split(".")) for part in value.split(",") if part.strip()]
+
+
+def _build(fields, expand):
+    nested = {path[0] for path in (fields or []) + (expand or []) if len(path) > 1}
+    top_expand = None
+    if expand is not None:
+        top_expand = frozenset(path[0] for path in expand) | frozenset(
+            path[0] for path in fields or [] if len(path) > 1
+        )
+    children = []
+    for name in sorted(nested):
+        sub_fields = None
+        if fields is not None and (name,) not in fields:
+            sub_fields = [path[1:] for path in fields if path[0] == name and len(path) > 1] or None
+        sub_expand = None
+        if expand is not None:
+            sub_expand = [path[1:] for path in expand if path[0] == name and len(path) > 1]
+        children.append((name, _build(sub_fields, sub_expand)))
+    top_fields = None if fields is None else frozenset(path[0] for path in fields)
+    return FieldSpec(top_fields, top_expand, tuple(children))
+
+
+def parse(query_params):
+    """The FieldSpec of ?fields= and ?expand=, or None when neither is given."""
+    fields, expand = query_params.get("fields"), query_params.get("expand")
+    if fields is None and expand is None:
+        return None
+    return _build(_paths(fields), _paths(expand))
+
+
+def spec_for(serializer):
+    """The FieldSpec `serializer` renders with, or None for all of its fields."""
+    spec = getattr(serializer, "field_spec", _MISSING)
+    if spec is not _MISSING:
+        return spec
+    parent = serializer.parent
+    if isinstance(parent, serializers.ListSerializer):
+        parent = parent.parent
+    if parent is not None:
+        return None  # nested in a serializer that was not given a spec
+    request = serializer.context.get("request")
+    if request is None or request.method not in SAFE_METHODS:
+        return None
+    return parse(getattr(request, "query_params", request.GET))
+
+
+def apply(spec, fields):
+    """Prune `fields` (a serializer's get_fields()) to `spec`."""
+    if spec.fields is not None:
+        fields = {name: field for name, field in fields.items() if name in spec.fields}
+    for name, field in list(fields.items()):
+        many = isinstance(field, serializers.ListSerializer)
+        nested = field.child if many else field
+        if not isinstance(nested, serializers.BaseSerializer):
+            continue
+        if spec.expand is not None and name not in spec.expand:
+            fields[name] = serializers.PrimaryKeyRelatedField(source=field.source, many=many, read_only=True)
+        else:
+            nested.field_spec = spec.child(name)
+    return fields
+
+
+class SparseFieldsetMixin:
+    """Apply ?fields= and ?expand= to this serializer (see chats.fieldsets)."""
+
+    def get_fields(self):
+        fields = super().get_fields()
+        spec = spec_for(self)
+        if spec is None:
+            return fields
+        return apply(spec, fields)
+
+
+def prune(queryset, serializer, also=()):
+    """
+    `queryset` cut down to what `serializer` renders under its FieldSpec,
+    plus the `also` fields the view needs itself (e.g. the pagination key).
+    Unchanged when the request asked for no fieldset.
+    """
+    if spec_for(serializer) is None:
+        return queryset
+    loads = _Loads(set(queryset.query.annotations))
+    loads.walk(serializer, "", queryset.model)
+    for name in also:
+        loads.need("", queryset.model, name)
+    queryset = queryset.select_related(None).prefetch_related(None)
+    if loads.joins:
+        queryset = queryset.select_related(*loads.joins)
+    if loads.prefetches:
+        queryset = queryset.prefetch_related(*loads.prefetches)
+    if loads.only is not None:
+        queryset = queryset.only(*loads.only)
+    return queryset
+
+
+class _Loads:
+    """The columns, joins and prefetches a serializer needs."""
+
+    def __init__(self, annotations=()):
+        self.only = []  # None once some field needs what only() cannot tell
+        self.joins = []
+        self.prefetches = []
+        self.annotations = annotations
+
+    def need(self, path, model, name):
+        if name in self.annotations and not path:
+            return
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            self.only = None
+            return
+        if not field.concrete:
+            self.only = None
+        elif self.only is not None:
+            self.only.append(path + name)
+
+    def walk(self, serializer, prefix, model):
+        hints = getattr(serializer, "fast_plan_fields", {})
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.SerializerMethodField):
+                if name not in hints:
+                    self.only = None
+                    continue
+                nested_class, guard = hints[name]
+                self.need(prefix, model, guard)
+                self.walk(nested_class(), prefix, model)
+                continue
+            if field.source == "*":
+                self.only = None
+                continue
+
+            many = isinstance(field, (serializers.ListSerializer, serializers.ManyRelatedField))
+            nested = field.child if isinstance(field, serializers.ListSerializer) else field
+            if many:
+                relation = model._meta.get_field(field.source)
+                related = relation.related_model
+                if isinstance(nested, serializers.BaseSerializer):
+                    loads = _Loads()
+                    loads.walk(nested, "", related)
+                    queryset = related._default_manager.all()
+                    if loads.joins:
+                        queryset = queryset.select_related(*loads.joins)
+                    if loads.only is not None:
+                        if relation.one_to_many:
+                            loads.only.append(relation.field.name)  # matches rows to parents
+                        queryset = queryset.only(*loads.only)
+                elif relation.one_to_many:
+                    queryset = related._default_manager.only("pk", relation.field.name)
+                else:
+                    queryset = related._default_manager.only("pk")
+                self.prefetches.append(Prefetch(prefix + field.source, queryset=queryset))
+                continue
+
+            if isinstance(field, serializers.BaseSerializer):
+                relation = model._meta.get_field(field.source)
+                self.joins.append(prefix + field.source)
+                self.need(prefix, model, field.source)
+                self.walk(field, prefix + field.source + "__", relation.related_model)
+                continue
+
+            if len(field.source_attrs) > 1:
+                self.only = None
+                continue
+            self.need(prefix, model, field.source_attrs[0])
@@ -5,13 +5,17 @@ from .models import Message
 class MessageFilter(django_filters.FilterSet):
     """
     Filter messages by:
+    - conversation
     - user (sender)
     - timestamp range (start_time, end_time)
+    - flagged by the content filter (flagged=true/false)
     """
-    start_time = django_filters.DateTimeFilter(field_name="timestamp", lookup_expr="gte")
-    end_time = django_filters.DateTimeFilter(field_name="timestamp", lookup_expr="lte")
-    user = django_filters.NumberFilter(field_name="user__id")
+    conversation = django_filters.UUIDFilter(field_name="conversation_id")
+    start_time = django_filters.DateTimeFilter(field_name="sent_at", lookup_expr="gte")
+    end_time = django_filters.DateTimeFilter(field_name="sent_at", lookup_expr="lte")
+    user = django_filters.UUIDFilter(field_name="sender_id")
+    flagged = django_filters.BooleanFilter(field_name="flagged_at", lookup_expr="isnull", exclude=True)
 
     class Meta:
         model = Message
-        fields = ["user", "start_time", "end_time"]
+        fields = ["conversation", "user", "start_time", "end_time", "flagged"]
@@ -0,0 +1,146 @@
+"""
+Per-user cache of the inbox (GET /api/conversations/).
+
+The inbox of a user only changes when a message in one of their
+conversations is written or deleted, or when participants change, so the
+list data is kept in Django's cache and served without touching the
+database. A hit costs two cache reads and whatever authentication costs;
+a matching If-None-Match is answered with a 304 from the cached ETag.
+
+Keys are versioned per user: every entry of a user (one per page, query
+string and host) lives under chats:inbox:<user>:<version>:..., with the
+version in chats:inbox-version:<user>. Invalidating a user deletes that
+version key, so the next request starts a fresh random version and the old
+entries are never read again (they expire after TIMEOUT). chats.signals
+invalidates the participants affected by each write, once when it happens
+and again when its transaction commits, so a request that read the old rows
+in between cannot leave them cached. Misses are filled from the primary
+database, never from a lagging replica.
+
+The cache backend must be shared by all workers (Redis, Memcached, the
+database backend) for invalidations to reach them, so the cache is off
+unless enabled; the project settings enable it with Redis. Enabling it on
+a per-process LocMemCache is only safe with a single worker.
+
+Entries vary with the absolute URI and the negotiated media type, like the
+ETag they carry, so a browsable API page never answers a JSON client.
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import setting_changed
+from django.db import transaction
+from django.dispatch import receiver
+from django.utils.cache import get_conditional_response
+from django.utils.http import parse_http_date_safe
+from rest_framework.response import Response
+
+from . import db_routers
+from .membership import Participant
+
+DEFAULTS = {
+    # Only with a CACHE shared by all workers
+    "ENABLED": False,
+    "CACHE": "default",
+    # Seconds an entry lives; invalidation does not wait for it
+    "TIMEOUT": 300,
+}
+
+VERSION_KEY = "chats:inbox-version:{}"
+ENTRY_KEY = "chats:inbox:{}:{}:{}"
+
+# Response headers stored with the data and sent again on hits
+HEADERS = ("ETag", "Last-Modified", "Cache-Control")
+
+_options = None
+
+
+def inbox_cache_settings():
+    global _options
+    if _options is None:
+        options = dict(DEFAULTS)
+        options.update(getattr(settings, "CHATS_INBOX_CACHE", {}))
+        _options = options
+    return _options
+
+
+def _cache():
+    return caches[inbox_cache_settings()["CACHE"]]
+
+
+def user_version(user_id):
+    """The current cache version of `user_id`, starting a new one if needed."""
+    cache = _cache()
+    key = VERSION_KEY.format(user_id)
+    version = cache.get(key)
+    if version is None:
+        # Random, so an evicted version can never come back with old entries
+        cache.add(key, uuid.uuid4().hex, timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def entry_key(request, version):
+    variant = f"{request.build_absolute_uri()}|{request.accepted_media_type}"
+    variant = hashlib.sha256(variant.encode()).hexdigest()[:32]
+    return ENTRY_KEY.format(request.user.pk, version, variant)
+
+
+def cached_list(request, respond):
+    """
+    The inbox response for `request`: from the cache, or respond() stored
+    in the cache when it is a 200.
+    """
+    options = inbox_cache_settings()
+    if not options["ENABLED"]:
+        return respond()
+    cache = _cache()
+    key = entry_key(request, user_version(request.user.pk))
+    entry = cache.get(key)
+    if entry is not None:
+        data, headers = entry
+        last_modified = parse_http_date_safe(headers.get("Last-Modified", ""))
+        response = get_conditional_response(request, etag=headers.get("ETag"), last_modified=last_modified)
+        if response is None:
+            response = Response(data)
+        for name, value in headers.items():
+            response.headers[name] = value
+        return response
+
+    with db_routers.primary_reads():
+        response = respond()
+    if response.status_code == 200 and isinstance(response, Response):
+        headers = {name: response[name] for name in HEADERS if name in response}
+        cache.set(key, (response.data, headers), timeout=options["TIMEOUT"])
+    return response
+
+
+def invalidate(user_ids):
+    """Drop the cached inboxes of `user_ids`, now and when the transaction commits."""
+    keys = [VERSION_KEY.format(user_id) for user_id in set(user_ids)]
+    if not keys or not inbox_cache_settings()["ENABLED"]:
+        return
+    cache = _cache()
+    cache.delete_many(keys)
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: cache.delete_many(keys))
+
+
+def invalidate_conversations(conversations, also=()):
+    """
+    Drop the cached inboxes of every participant of `conversations` (ids or
+    a queryset), and of the users in `also`.
+    """
+    if not inbox_cache_settings()["ENABLED"]:
+        return
+    participants = Participant.objects.filter(conversation__in=conversations)
+    invalidate([*participants.values_list("user_id", flat=True), *also])
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    global _options
+    if setting == "CHATS_INBOX_CACHE":
+        _options = None
@@ -0,0 +1,322 @@
+"""
+Streaming analysis of the request log (requests.log and its rotations).
+
+Reads both line formats RequestLoggingMiddleware writes (text and JSON,
+even mixed in one file) and aggregates requests per path, per user and per
+time bucket, status codes, and, for JSON records, latency percentiles
+overall and per route. Memory stays bounded however large the log is:
+- paths and users go through TopK, which keeps the heaviest `capacity`
+  keys and a bound on the error of their counts
+- latencies go into QuantileSketch, logarithmic buckets whose count
+  depends on the range of values, not on how many there are
+- paths are normalized (/api/conversations/<uuid>/ -> /api/conversations/{id}/)
+
+Plain files are memory-mapped and cut into chunks at line boundaries;
+gzipped rotations are decompressed as a stream. Each chunk is scanned with
+one compiled regex per format, so the per-line work happens in C, and
+chunks can be analyzed in parallel worker processes: every aggregate
+merges.
+"""
+import gzip
+import json
+import math
+import mmap
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from operator import itemgetter
+
+CHUNK_SIZE = 32 * 1024 * 1024
+
+# Length of a "2026-01-31 14:05" timestamp prefix kept per bucket size
+BUCKETS = {"minute": 16, "hour": 13, "day": 10}
+
+# 2026-01-31 14:05:09.123456 - User: alice@example.com - Path: /api/messages/
+TEXT_LINE = re.compile(
+    rb"^(\d{4}-\d\d-\d\d[ T]\d\d:\d\d)[:.\d]* - User: (.*) - Path: (.*)$", re.M
+)
+# {"time":"...","method":"GET","path":"...","route":"...","status":200,"duration_ms":1.2,...,"user":"..."}
+# Starts with a literal, which lets the regex engine skip ahead to each record
+_JSON_STRING = rb'"([^"\\\n]*(?:\\.[^"\\\n]*)*)"'
+JSON_LINE = re.compile(
+    rb'\{"time":"(\d{4}-\d\d-\d\d[ T]\d\d:\d\d)[^"]*","method":' + _JSON_STRING
+    + rb',"path":' + _JSON_STRING
+    + rb',"route":(?:null|' + _JSON_STRING + rb'),"status":(\d+),"duration_ms":([0-9.eE+-]+)'
+    + rb'[^\n]*"user":(?:null|' + _JSON_STRING + rb')\}$',
+    re.M,
+)
+DROPPED_LINE = re.compile(rb" - request log dropped (\d+) records")
+
+_UUID_SEGMENT = re.compile(r"/[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}(?=/|$)")
+_NUMBER_SEGMENT = re.compile(r"/\d+(?=/|$)")
+
+ANONYMOUS = "Anonymous"
+
+
+def decode(raw):
+    """A JSON string body (without quotes) or a text field, as str."""
+    if b"\\" in raw:
+        return json.loads(b'"' + raw + b'"')
+    return raw.decode("utf-8", "replace")
+
+
+def normalize_path(path):
+    return _NUMBER_SEGMENT.sub("/{n}", _UUID_SEGMENT.sub("/{id}", path))
+
+
+class TopK:
+    """
+    Approximate request counts of the heaviest keys in bounded memory.
+
+    Counts are exact until more than 2 * capacity keys are seen; then only
+    the top `capacity` are kept and the largest count dropped becomes the
+    error bound: every reported count is at most `error` below the truth.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.error = 0
+
+    def update(self, counts):
+        own = self.counts
+        for key, n in counts.items():
+            own[key] = own.get(key, 0) + n
+        if len(own) > 2 * self.capacity:
+            self.prune()
+
+    def prune(self):
+        ranked = sorted(self.counts.items(), key=itemgetter(1), reverse=True)
+        if len(ranked) > self.capacity:
+            self.error = max(self.error, ranked[self.capacity][1])
+        self.counts = dict(ranked[:self.capacity])
+
+    def merge(self, other):
+        self.update(other.counts)
+        self.error += other.error
+
+    def top(self, n):
+        return sorted(self.counts.items(), key=itemgetter(1), reverse=True)[:n]
+
+
+class QuantileSketch:
+    """
+    Quantiles with at most `accuracy` relative error (DDSketch): values go
+    into logarithmically sized buckets, about 1000 for everything between
+    1 microsecond and 20 minutes at 1%. Values below MIN_VALUE count as
+    MIN_VALUE.
+    """
+
+    MIN_VALUE = 1e-3
+
+    def __init__(self, accuracy=0.01):
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.bins = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def indexes(self, values):
+        """The bucket index of each of `values` (computed in C, via map)."""
+        clamped = map(max, values, repeat(self.MIN_VALUE))
+        return map(math.ceil, map(math.log, clamped, repeat(self.gamma)))
+
+    def add(self, value, n=1):
+        self.add_bins({next(self.indexes([value])): n}, value * n, value)
+
+    def add_bins(self, bins, total, maximum):
+        """Add already bucketed values: {index: count}, their sum and max."""
+        self.bins.update(bins)
+        self.count += sum(bins.values())
+        self.total += total
+        self.max = max(self.max, maximum)
+
+    def merge(self, other):
+        self.add_bins(other.bins, other.total, other.max)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if rank < seen:
+                return min(2 * self.gamma ** index / (self.gamma + 1), self.max)
+        return self.max
+
+
+class LogStats:
+    """Aggregates of one or more chunks of request log."""
+
+    def __init__(self, capacity=1000, bucket="hour"):
+        self.capacity = capacity
+        self.bucket = bucket
+        self.bytes = 0
+        self.lines = 0
+        self.parsed = 0
+        self.dropped = 0
+        self.paths = TopK(capacity)
+        self.users = TopK(capacity)
+        self.buckets = Counter()
+        self.statuses = Counter()
+        self.latency = QuantileSketch()
+        self.routes = {}
+
+    def scan(self, data):
+        """Add every record in `data`, a bytes buffer of whole lines."""
+        self.bytes += len(data)
+        self.lines += data.count(b"\n") + (1 if data and not data.endswith(b"\n") else 0)
+        if b" - request log dropped " in data:
+            self.dropped += sum(int(n) for n in DROPPED_LINE.findall(data))
+        if b" - User: " in data:
+            records = TEXT_LINE.findall(data)
+            if records:
+                self.add(records, 0, 1, 2)
+        if b'{"time":' in data:
+            records = JSON_LINE.findall(data)
+            if records:
+                self.add(records, 0, 6, 2)
+                self.add_latencies(records, 3, 4, 5)
+
+    def add(self, records, time_column, user_column, path_column):
+        # Count the raw values first (in C); decoding and normalizing then
+        # only happens once per distinct value
+        self.parsed += len(records)
+        width = BUCKETS[self.bucket]
+        for minute, n in Counter(map(itemgetter(time_column), records)).items():
+            self.buckets[minute[:width].decode().replace("T", " ")] += n
+        self.users.update({
+            decode(user) if user else ANONYMOUS: n
+            for user, n in Counter(map(itemgetter(user_column), records)).items()
+        })
+        paths = Counter()
+        for path, n in Counter(map(itemgetter(path_column), records)).items():
+            paths[normalize_path(decode(path))] += n
+        self.paths.update(paths)
+
+    def add_latencies(self, records, route_column, status_column, duration_column):
+        for status, n in Counter(map(itemgetter(status_column), records)).items():
+            self.statuses[int(status)] += n
+        routes = list(map(itemgetter(route_column), records))
+        durations = list(map(float, map(itemgetter(duration_column), records)))
+        indexes = list(self.latency.indexes(durations))
+        self.latency.add_bins(Counter(indexes), sum(durations), max(durations))
+
+        # Per route: bucket counts in C, sums and maxima in one pass
+        bins = Counter(zip(routes, indexes))
+        totals = dict.fromkeys(set(routes), 0.0)
+        maxima = dict.fromkeys(totals, 0.0)
+        for route, duration in zip(routes, durations):
+            totals[route] += duration
+            if duration > maxima[route]:
+                maxima[route] = duration
+        for raw in totals:
+            route = decode(raw) if raw else "-"
+            sketch = self.routes.get(route)
+            if sketch is None:
+                sketch = self.routes[route] = QuantileSketch()
+            sketch.add_bins(
+                {index: n for (r, index), n in bins.items() if r == raw},
+                totals[raw], maxima[raw],
+            )
+
+    def merge(self, other):
+        self.bytes += other.bytes
+        self.lines += other.lines
+        self.parsed += other.parsed
+        self.dropped += other.dropped
+        self.paths.merge(other.paths)
+        self.users.merge(other.users)
+        self.buckets.update(other.buckets)
+        self.statuses.update(other.statuses)
+        self.latency.merge(other.latency)
+        for route, sketch in other.routes.items():
+            if route in self.routes:
+                self.routes[route].merge(sketch)
+            else:
+                self.routes[route] = sketch
+        return self
+
+
+def _line_start(mm, offset):
+    """The start of the first line beginning at or after `offset`."""
+    if offset == 0:
+        return 0
+    newline = mm.find(b"\n", offset - 1)
+    return len(mm) if newline == -1 else newline + 1
+
+
+def analyze_chunk(path, start, end, capacity=1000, bucket="hour"):
+    """Analyze the lines of a plain file that begin in [start, end)."""
+    stats = LogStats(capacity, bucket)
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start, end = _line_start(mm, start), _line_start(mm, min(end, len(mm)))
+        if start < end:
+            stats.scan(mm[start:end])
+    return stats
+
+
+def analyze_gzip(path, capacity=1000, bucket="hour", chunk_size=CHUNK_SIZE):
+    """Analyze a gzipped file, decompressing it one chunk at a time."""
+    stats = LogStats(capacity, bucket)
+    carry = b""
+    with gzip.open(path, "rb") as f:
+        while True:
+            block = f.read(chunk_size)
+            if not block:
+                break
+            data = carry + block
+            cut = data.rfind(b"\n") + 1
+            stats.scan(data[:cut])
+            carry = data[cut:]
+    if carry:
+        stats.scan(carry)
+    return stats
+
+
+def tasks(paths, chunk_size=CHUNK_SIZE):
+    """(function, args) units of work covering every file in `paths`."""
+    for path in paths:
+        path = str(path)
+        if path.endswith(".gz"):
+            yield analyze_gzip, (path,)
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, size, chunk_size):
+            yield analyze_chunk, (path, start, start + chunk_size)
+
+
+def _run(task):
+    function, args, capacity, bucket = task
+    return function(*args, capacity=capacity, bucket=bucket)
+
+
+def analyze(paths, jobs=1, capacity=1000, bucket="hour", chunk_size=CHUNK_SIZE):
+    """Analyze the log files in `paths`, with `jobs` worker processes."""
+    work = [(function, args, capacity, bucket) for function, args in tasks(paths, chunk_size)]
+    stats = LogStats(capacity, bucket)
+    if jobs > 1 and len(work) > 1:
+        with ProcessPoolExecutor(max_workers=min(jobs, len(work))) as pool:
+            for result in pool.map(_run, work):
+                stats.merge(result)
+    else:
+        for task in work:
+            stats.merge(_run(task))
+    return stats
+
+
+def rotated_files(path):
+    """`path` and its rotations (path.1, path.2.gz, ...) that exist."""
+    path = str(path)
+    directory, name = os.path.split(path)
+    rotation = re.compile(re.escape(name) + r"\.(\d+)(\.gz)?$")
+    found = [path] if os.path.exists(path) else []
+    rotations = []
+    for entry in os.listdir(directory or "."):
+        match = rotation.match(entry)
+        if match:
+            rotations.append((int(match.group(1)), os.path.join(directory, entry)))
+    return found + [p for _, p in sorted(rotations)]
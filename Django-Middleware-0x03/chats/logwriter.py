@@ -0,0 +1,200 @@
+"""
+Non-blocking, batched log file writer.
+
+Request threads only put a line on a bounded queue. A background thread
+drains it and appends whole batches to the file, when BATCH_SIZE lines are
+waiting or FLUSH_INTERVAL seconds have passed. When the queue is full the
+line is dropped and counted instead of blocking the request; the count is
+written to the log with the next batch.
+
+The file is rotated by size (requests.log -> requests.log.1 -> ...). Several
+worker processes can share one file: each appends batches with O_APPEND and
+reopens the file when another process has rotated it.
+
+Pending lines are flushed at interpreter exit.
+"""
+import atexit
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+
+DEFAULTS = {
+    "PATH": None,  # settings.BASE_DIR / "requests.log"
+    "FORMAT": "text",  # or "json" (structured access log)
+    "BATCH_SIZE": 200,
+    "FLUSH_INTERVAL": 1.0,
+    "QUEUE_SIZE": 10000,
+    "MAX_BYTES": 50 * 1024 * 1024,
+    "BACKUP_COUNT": 5,
+}
+
+_STOP = object()
+
+
+def log_settings():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, "CHATS_REQUEST_LOG", {}))
+    if options["PATH"] is None:
+        options["PATH"] = os.path.join(settings.BASE_DIR, "requests.log")
+    return options
+
+
+class BatchedLogWriter:
+
+    def __init__(self, path, batch_size=200, flush_interval=1.0, queue_size=10000,
+                 max_bytes=50 * 1024 * 1024, backup_count=5):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.queue_size = queue_size
+
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._start()
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name="chats-log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, line):
+        """Queue one line (including its newline). Never blocks."""
+        if self._pid != os.getpid():
+            # Forked after the writer started (e.g. gunicorn --preload):
+            # the thread did not survive, start a fresh one in this process
+            self._start()
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            with self._dropped_lock:
+                self.dropped += 1
+
+    def close(self, timeout=5.0):
+        """Flush everything queued so far and stop the writer thread."""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    # Writer thread
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            stop = item is _STOP
+            if item is not None and not stop:
+                batch.append(item)
+
+            if stop or len(batch) >= self.batch_size or time.monotonic() >= deadline:
+                self._flush(batch)
+                batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if stop:
+                self._close_file()
+                return
+
+    def _flush(self, batch):
+        dropped = self.dropped - self._reported_dropped
+        if dropped:
+            self._reported_dropped += dropped
+            batch.append(f"{datetime.now()} - request log dropped {dropped} records (queue full)\n")
+        if not batch:
+            return
+        try:
+            self._open()
+            self._file.write("".join(batch))
+            self._file.flush()
+            if self._file.tell() >= self.max_bytes:
+                if self._rotated_elsewhere():
+                    self._close_file()
+                else:
+                    self._rotate()
+        except OSError:
+            # Never let a full disk or a permissions problem kill the thread
+            with self._dropped_lock:
+                self.dropped += len(batch)
+            self._close_file()
+
+    def _rotated_elsewhere(self):
+        """True if the open file is no longer the one at self.path."""
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def _open(self):
+        if self._file is not None:
+            if not self._rotated_elsewhere():
+                return
+            self._close_file()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _rotate(self):
+        self._close_file()
+        if self.backup_count <= 0:
+            os.truncate(self.path, 0)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(path=None):
+    """
+    Return the writer for `path` (default: the configured request log),
+    starting it on first use.
+    """
+    options = log_settings()
+    path = str(path or options["PATH"])
+    with _writers_lock:
+        writer = _writers.get(path)
+        if writer is None:
+            writer = BatchedLogWriter(
+                path,
+                batch_size=options["BATCH_SIZE"],
+                flush_interval=options["FLUSH_INTERVAL"],
+                queue_size=options["QUEUE_SIZE"],
+                max_bytes=options["MAX_BYTES"],
+                backup_count=options["BACKUP_COUNT"],
+            )
+            _writers[path] = writer
+        return writer
+
+
+@atexit.register
+def close_all():
+    with _writers_lock:
+        writers = list(_writers.values())
+    for writer in writers:
+        if writer._pid == os.getpid():
+            writer.close()
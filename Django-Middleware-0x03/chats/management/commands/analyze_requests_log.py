@@ -0,0 +1,123 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chats import logstats
+from chats.logwriter import log_settings
+
+
+class Command(BaseCommand):
+    help = (
+        "Summarize the request log: hot paths, heavy users, requests over time "
+        "and, for JSON records, latency percentiles. Reads rotated and gzipped files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths", nargs="*",
+            help="Log files to read (default: the configured request log and its rotations).",
+        )
+        parser.add_argument("--top", type=int, default=20, help="Rows per table (default: 20).")
+        parser.add_argument(
+            "--bucket", choices=sorted(logstats.BUCKETS), default="hour",
+            help="Time bucket for request counts (default: hour).",
+        )
+        parser.add_argument(
+            "--jobs", type=int, default=os.cpu_count() or 1,
+            help="Worker processes (default: one per CPU).",
+        )
+        parser.add_argument(
+            "--capacity", type=int, default=10000,
+            help="Distinct paths and users tracked exactly before counts become "
+                 "approximate (default: 10000).",
+        )
+        parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+
+    def handle(self, *args, **options):
+        paths = options["paths"] or logstats.rotated_files(log_settings()["PATH"])
+        missing = [path for path in paths if not os.path.exists(path)]
+        if missing:
+            raise CommandError(f"No such file: {', '.join(missing)}")
+        if not paths:
+            raise CommandError("No request log found.")
+
+        start = time.perf_counter()
+        stats = logstats.analyze(
+            paths, jobs=options["jobs"], capacity=options["capacity"], bucket=options["bucket"]
+        )
+        elapsed = time.perf_counter() - start
+        report = self.report(stats, options["top"], paths, elapsed)
+
+        if options["json"]:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_text(report)
+
+    def report(self, stats, top, paths, elapsed):
+        def latency(sketch):
+            return {
+                "count": sketch.count,
+                "mean_ms": round(sketch.total / sketch.count, 3) if sketch.count else None,
+                **{
+                    f"p{int(q * 100)}_ms": None if value is None else round(value, 3)
+                    for q, value in ((q, sketch.quantile(q)) for q in (0.5, 0.9, 0.99))
+                },
+                "max_ms": round(sketch.max, 3),
+            }
+
+        routes = sorted(stats.routes.items(), key=lambda item: item[1].count, reverse=True)
+        return {
+            "files": [str(path) for path in paths],
+            "bytes": stats.bytes,
+            "lines": stats.lines,
+            "requests": stats.parsed,
+            "unparsed_lines": stats.lines - stats.parsed,
+            "dropped_records": stats.dropped,
+            "seconds": round(elapsed, 3),
+            "paths": {"error": stats.paths.error, "top": stats.paths.top(top)},
+            "users": {"error": stats.users.error, "top": stats.users.top(top)},
+            "requests_per_" + stats.bucket: dict(sorted(stats.buckets.items())),
+            "statuses": dict(sorted(stats.statuses.items())),
+            "latency": latency(stats.latency) if stats.latency.count else None,
+            "routes": {route: latency(sketch) for route, sketch in routes[:top]},
+        }
+
+    def write_text(self, report):
+        write = self.stdout.write
+        megabytes = report["bytes"] / 1e6
+        write(
+            f"{report['requests']} requests in {len(report['files'])} file(s), "
+            f"{megabytes:.1f} MB in {report['seconds']:.2f}s "
+            f"({megabytes / max(report['seconds'], 1e-9):.0f} MB/s)"
+        )
+        if report["unparsed_lines"] or report["dropped_records"]:
+            write(
+                f"{report['unparsed_lines']} unparsed lines, "
+                f"{report['dropped_records']} records dropped by the writer"
+            )
+
+        for title in ("paths", "users"):
+            table = report[title]
+            note = f" (counts up to {table['error']} low)" if table["error"] else ""
+            write(f"\nTop {title}{note}:")
+            for key, count in table["top"]:
+                write(f"  {count:>10}  {key}")
+
+        bucket_key = next(key for key in report if key.startswith("requests_per_"))
+        write(f"\nRequests per {bucket_key[len('requests_per_'):]}:")
+        for bucket, count in report[bucket_key].items():
+            write(f"  {bucket:<16}  {count:>10}")
+
+        if report["statuses"]:
+            write("\nStatuses: " + ", ".join(f"{s}: {n}" for s, n in report["statuses"].items()))
+
+        if report["latency"]:
+            write(f"\n{'Latency (ms)':<40} {'count':>9} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+            rows = [("all", report["latency"])] + list(report["routes"].items())
+            for name, row in rows:
+                write(
+                    f"{name[:40]:<40} {row['count']:>9} {row['p50_ms']:>9.2f} "
+                    f"{row['p90_ms']:>9.2f} {row['p99_ms']:>9.2f} {row['max_ms']:>9.2f}"
+                )
@@ -0,0 +1,37 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chats import archive
+
+
+class Command(BaseCommand):
+    help = "Move messages older than the archive age from the hot message table to the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days", type=int,
+            help="Archive messages older than this many days "
+                 "(default: settings.CHATS_ARCHIVE_AFTER_DAYS).",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1000,
+            help="Messages moved per transaction (default: 1000).",
+        )
+
+    def handle(self, *args, **options):
+        if options["older_than_days"] is not None:
+            before = timezone.now() - timedelta(days=options["older_than_days"])
+        else:
+            before = archive.cutoff()
+
+        moved = 0
+        while True:
+            count = archive.archive_batch(before, options["batch_size"])
+            if not count:
+                break
+            moved += count
+            self.stdout.write(f"{moved} messages archived")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {moved} messages archived (sent before {before:%Y-%m-%d %H:%M})."))
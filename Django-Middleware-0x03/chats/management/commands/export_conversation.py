@@ -0,0 +1,42 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from chats.export import DEFAULT_CHUNK_SIZE, iter_conversation_ndjson
+from chats.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Export a conversation's full message history as NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument("conversation_id")
+        parser.add_argument(
+            "-o", "--output",
+            help="File to write to (default: stdout).",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+            help=f"Rows fetched from the database per round trip (default: {DEFAULT_CHUNK_SIZE}).",
+        )
+
+    def handle(self, *args, **options):
+        conversation_id = options["conversation_id"]
+        try:
+            exists = Conversation.objects.filter(pk=conversation_id).exists()
+        except ValidationError:
+            exists = False
+        if not exists:
+            raise CommandError(f"Conversation {conversation_id} not found.")
+
+        lines = iter_conversation_ndjson(conversation_id, chunk_size=options["chunk_size"])
+        if not options["output"]:
+            for line in lines:
+                self.stdout.write(line, ending="")
+            return
+
+        count = 0
+        with open(options["output"], "w", encoding="utf-8") as f:
+            for line in lines:
+                f.write(line)
+                count += 1
+        self.stderr.write(self.style.SUCCESS(f"Exported {count} messages to {options['output']}."))
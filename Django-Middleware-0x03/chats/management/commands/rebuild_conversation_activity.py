@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chats import activity
+from chats.models import Conversation
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute message_count and the latest message fields of every conversation, "
+        "archived messages included."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Number of conversations updated per transaction (default: 500).",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options["batch_size"]
+        ids = Conversation.objects.order_by("pk").values_list("pk", flat=True)
+        last_pk = None
+        updated = 0
+
+        while True:
+            batch = ids.filter(pk__gt=last_pk) if last_pk else ids
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            with transaction.atomic():
+                updated += activity.rebuild(batch)
+            last_pk = batch[-1]
+            self.stdout.write(f"{updated} conversations rebuilt")
+
+        self.stdout.write(self.style.SUCCESS(f"Done: {updated} conversations rebuilt."))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from chats import search
+
+
+class Command(BaseCommand):
+    help = (
+        "Reinstall the FTS5 message search table and triggers and reindex every "
+        "message. Run after VACUUM or a migration that rebuilds chats_message."
+    )
+
+    def handle(self, *args, **options):
+        if not search.fts_supported():
+            raise CommandError("Full-text search needs the SQLite backend.")
+        with transaction.atomic():
+            search.install()
+        self.stdout.write(self.style.SUCCESS("Message search index rebuilt."))
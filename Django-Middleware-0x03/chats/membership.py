@@ -0,0 +1,180 @@
+"""
+Conversation membership service.
+
+Answers "is user U a participant of conversation C" with an EXISTS query on
+the (conversation, user) unique index of the participants table instead of
+loading every participant row.
+
+Lookups go through two caches:
+- a per-request memo, so one request never asks the database twice
+- a process-level LRU with a short TTL, shared by all requests of a worker
+
+Both are invalidated by m2m_changed on Conversation.participants (see
+chats.signals). Other worker processes only see a change once their LRU
+entry expires, which is what CHATS_MEMBERSHIP_CACHE_TTL bounds.
+
+Users authenticated from JWT claims (chats.auth) carry the conversations
+they were in when the token was minted. Any other conversation is denied
+without a query; those in the claim are still checked as above, so a user
+removed since does not keep access until the token expires.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import Conversation
+
+Participant = Conversation.participants.through
+
+REQUEST_MEMO_ATTR = "_chats_membership_memo"
+
+
+class MembershipCache:
+    """Thread-safe LRU of (conversation_id, user_id) -> bool with a TTL."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+cache = MembershipCache(
+    maxsize=getattr(settings, "CHATS_MEMBERSHIP_CACHE_SIZE", 10000),
+    ttl=getattr(settings, "CHATS_MEMBERSHIP_CACHE_TTL", 30),
+)
+
+
+def _key(conversation_id, user_id):
+    return str(conversation_id), str(user_id)
+
+
+def _request_memo(request):
+    """
+    Return the memo dict of a request, dropping it if the process cache was
+    invalidated since it was created.
+    """
+    if request is None:
+        return None
+    request = getattr(request, "_request", request)  # unwrap DRF Request
+    memo = getattr(request, REQUEST_MEMO_ATTR, None)
+    if memo is None or memo["generation"] != cache.generation:
+        memo = {"generation": cache.generation, "entries": {}}
+        setattr(request, REQUEST_MEMO_ATTR, memo)
+    return memo["entries"]
+
+
+def is_participant(user, conversation_id, request=None):
+    """
+    Return True if `user` participates in the conversation `conversation_id`.
+    Pass the current request to memoize the answer for its lifetime.
+    """
+    if user is None or not user.is_authenticated:
+        return False
+
+    # The token's conversations can only deny: removals since it was minted
+    # are confirmed below
+    scope = getattr(user, "token_conversations", None)
+    if scope is not None and str(conversation_id) not in scope:
+        return False
+
+    key = _key(conversation_id, user.pk)
+    memo = _request_memo(request)
+    if memo is not None and key in memo:
+        return memo[key]
+
+    result = cache.get(key)
+    if result is None:
+        result = Participant.objects.filter(
+            conversation_id=conversation_id, user_id=user.pk
+        ).exists()
+        cache.set(key, result)
+
+    if memo is not None:
+        memo[key] = result
+    return result
+
+
+def participant_conversation_ids(user, conversation_ids, request=None):
+    """
+    Return the subset of `conversation_ids` (as strings) that `user`
+    participates in, with one query for all the ids not already cached.
+    """
+    if user is None or not user.is_authenticated:
+        return set()
+
+    memo = _request_memo(request)
+    scope = getattr(user, "token_conversations", None)
+    allowed, missing = set(), []
+    for conversation_id in {str(c) for c in conversation_ids}:
+        if scope is not None and conversation_id not in scope:
+            continue
+        key = _key(conversation_id, user.pk)
+        result = memo.get(key) if memo is not None else None
+        if result is None:
+            result = cache.get(key)
+        if result is None:
+            missing.append(conversation_id)
+        elif result:
+            allowed.add(conversation_id)
+
+    if missing:
+        found = {
+            str(c) for c in Participant.objects.filter(
+                user_id=user.pk, conversation_id__in=missing
+            ).values_list("conversation_id", flat=True)
+        }
+        for conversation_id in missing:
+            key = _key(conversation_id, user.pk)
+            result = conversation_id in found
+            cache.set(key, result)
+            if memo is not None:
+                memo[key] = result
+        allowed |= found
+    return allowed
+
+
+def invalidate(conversation_ids, user_ids):
+    """Forget cached answers for every (conversation, user) pair given."""
+    cache.discard(
+        _key(conversation_id, user_id)
+        for conversation_id in conversation_ids
+        for user_id in user_ids
+    )
+
+
+def invalidate_all():
+    cache.clear()
@@ -0,0 +1,287 @@
+"""
+Prometheus metrics, correct across worker processes.
+
+Every process writes its counters to its own memory-mapped file in
+CHATS_METRICS["DIR"] (chats-<pid>.db): an update is a few bytes written
+into this process's mapping, with no lock or I/O shared with other
+processes. A scrape of /metrics reads every file in the directory and adds
+them up, so the numbers cover all gunicorn workers whichever one answers.
+Files of exited workers stay and keep counting towards the totals; empty
+the directory when the service (not a worker) restarts.
+
+File layout: an 8-byte header holding the number of bytes in use, then
+entries of [4-byte key length][key, padded to 8 bytes][8-byte double],
+the key being the JSON of [sample name, label values]. New entries are
+written before the header is bumped, so a concurrent reader never sees a
+half-written one.
+
+Metrics are declared below (Counter, Histogram) and updated with
+inc()/observe(); chats.middleware.MetricsMiddleware records the
+per-request ones and serves the exposition at CHATS_METRICS["PATH"].
+"""
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+DEFAULTS = {
+    "ENABLED": False,
+    "DIR": None,  # settings.BASE_DIR / "metrics"
+    "PATH": "/metrics",
+    # REMOTE_ADDRs allowed to scrape; None allows everyone
+    "ALLOWED_IPS": ["127.0.0.1", "::1"],
+}
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_HEADER = struct.Struct("Q")
+_LENGTH = struct.Struct("I")
+_VALUE = struct.Struct("d")
+_INITIAL_SIZE = 64 * 1024
+
+_options = None
+
+
+def metrics_settings():
+    global _options
+    if _options is None:
+        options = dict(DEFAULTS)
+        options.update(getattr(settings, "CHATS_METRICS", {}))
+        if options["DIR"] is None:
+            options["DIR"] = os.path.join(settings.BASE_DIR, "metrics")
+        options["DIR"] = str(options["DIR"])
+        _options = options
+    return _options
+
+
+class MmapValues:
+    """One process's sample values, in a memory-mapped file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.positions = {}
+        exists = os.path.exists(path)
+        self.file = open(path, "a+b")
+        if not exists or os.path.getsize(path) < _INITIAL_SIZE:
+            self.file.truncate(_INITIAL_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.used = _HEADER.unpack_from(self.map, 0)[0] or _HEADER.size
+        # A reused pid: carry on from the entries already in the file
+        for key, _, position in read_entries(self.map, self.used):
+            self.positions[key] = position
+
+    def position(self, key):
+        position = self.positions.get(key)
+        if position is None:
+            raw = json.dumps(key).encode()
+            padded = len(raw) + (-(len(raw) + _LENGTH.size) % 8)
+            size = _LENGTH.size + padded + _VALUE.size
+            if self.used + size > len(self.map):
+                self.grow(self.used + size)
+            offset = self.used
+            _LENGTH.pack_into(self.map, offset, len(raw))
+            self.map[offset + _LENGTH.size:offset + _LENGTH.size + len(raw)] = raw
+            position = offset + _LENGTH.size + padded
+            _VALUE.pack_into(self.map, position, 0.0)
+            self.used += size
+            _HEADER.pack_into(self.map, 0, self.used)
+            self.positions[key] = position
+        return position
+
+    def grow(self, needed):
+        size = len(self.map)
+        while size < needed:
+            size *= 2
+        self.map.close()
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+    def add(self, key, amount):
+        with self.lock:
+            position = self.position(key)
+            value = _VALUE.unpack_from(self.map, position)[0]
+            _VALUE.pack_into(self.map, position, value + amount)
+
+
+def read_entries(buffer, used=None):
+    """Yield (key, value, position) for the entries of a values file."""
+    if used is None:
+        used = _HEADER.unpack_from(buffer, 0)[0]
+    offset = _HEADER.size
+    while offset < used:
+        length = _LENGTH.unpack_from(buffer, offset)[0]
+        start = offset + _LENGTH.size
+        raw = bytes(buffer[start:start + length])
+        position = start + length + (-(length + _LENGTH.size) % 8)
+        key = json.loads(raw)
+        yield (key[0], tuple(key[1])), _VALUE.unpack_from(buffer, position)[0], position
+        offset = position + _VALUE.size
+
+
+_values = None
+_values_lock = threading.Lock()
+
+
+def process_values():
+    """This process's values file, or None when metrics are disabled."""
+    global _values
+    values = _values
+    if values is not None and values.pid == os.getpid():
+        return values
+    options = metrics_settings()
+    if not options["ENABLED"]:
+        return None
+    with _values_lock:
+        if _values is None or _values.pid != os.getpid():
+            # First use, or a worker forked from a process that had one
+            os.makedirs(options["DIR"], exist_ok=True)
+            values = MmapValues(os.path.join(options["DIR"], f"chats-{os.getpid()}.db"))
+            values.pid = os.getpid()
+            _values = values
+        return _values
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def samples(self, values):
+        """Exposition lines from {(sample name, labels): value} of this metric."""
+        for (name, labels), value in sorted(values.items()):
+            yield sample_line(name, zip(self.labelnames, labels), value)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        values = process_values()
+        if values is not None:
+            values.add((self.name, labels), amount)
+
+
+class Histogram(Metric):
+    """
+    Bucket counts are stored per bucket and only made cumulative at scrape
+    time, so an observation is three writes whatever the number of buckets.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(float(b) for b in buckets)
+
+    def observe(self, value, *labels):
+        values = process_values()
+        if values is None:
+            return
+        index = bisect_left(self.buckets, value)
+        le = format_value(self.buckets[index]) if index < len(self.buckets) else "+Inf"
+        values.add((self.name + "_bucket", labels + (le,)), 1)
+        values.add((self.name + "_sum", labels), value)
+        values.add((self.name + "_count", labels), 1)
+
+    def samples(self, values):
+        series = {}
+        for (name, labels), value in values.items():
+            if name == self.name + "_bucket":
+                series.setdefault(labels[:-1], {})[labels[-1]] = value
+        les = [format_value(b) for b in self.buckets] + ["+Inf"]
+        for labels in sorted(series):
+            named = list(zip(self.labelnames, labels))
+            cumulative = 0.0
+            for le in les:
+                cumulative += series[labels].get(le, 0.0)
+                yield sample_line(self.name + "_bucket", named + [("le", le)], cumulative)
+            yield sample_line(self.name + "_sum", named, values.get((self.name + "_sum", labels), 0.0))
+            yield sample_line(self.name + "_count", named, cumulative)
+
+
+def format_value(value):
+    if math.isfinite(value) and value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def sample_line(name, labels, value):
+    labels = ",".join(f'{key}="{escape(label)}"' for key, label in labels)
+    return f"{name}{{{labels}}} {format_value(value)}" if labels else f"{name} {format_value(value)}"
+
+
+REGISTRY = []
+
+REQUEST_DURATION = Histogram(
+    "chats_request_duration_seconds", "Request latency by route.", ["route", "method"],
+)
+REQUESTS = Counter(
+    "chats_requests_total", "Requests by route and response status.", ["route", "method", "status"],
+)
+DB_QUERIES = Counter("chats_db_queries_total", "Database queries run by requests, by route.", ["route"])
+RATE_LIMITED = Counter("chats_rate_limit_rejections_total", "Requests rejected by a rate limit.", ["limit"])
+MESSAGES_CREATED = Counter("chats_messages_created_total", "Messages created.")
+AUTH_FAILURES = Counter(
+    "chats_auth_failures_total", "Requests answered 401 (missing or invalid credentials).", ["route"],
+)
+
+
+def collect(directory=None):
+    """Sum the values files of every process: {(sample name, labels): value}."""
+    directory = directory or metrics_settings()["DIR"]
+    totals = {}
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return totals
+    for name in names:
+        if not (name.startswith("chats-") and name.endswith(".db")):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            data = f.read()
+        if len(data) < _HEADER.size:
+            continue
+        for key, value, _ in read_entries(data):
+            totals[key] = totals.get(key, 0.0) + value
+    return totals
+
+
+def exposition(values=None):
+    """The text exposition format of every registered metric."""
+    values = collect() if values is None else values
+    by_metric = {}
+    for (name, labels), value in values.items():
+        by_metric.setdefault(name, {})[(name, labels)] = value
+    lines = []
+    for metric in REGISTRY:
+        own = {}
+        for suffix in ("", "_bucket", "_sum", "_count"):
+            own.update(by_metric.get(metric.name + suffix, {}))
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples(own))
+    return "\n".join(lines) + "\n"
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    global _options, _values
+    if setting == "CHATS_METRICS":
+        _options = None
+        _values = None
@@ -1,55 +1,228 @@
 # chats/middleware.py
 from datetime import datetime
-from django.conf import settings
-import os
+import json
 import time
-from django.http import JsonResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse
 from django.http import HttpResponseForbidden
+from django.utils.functional import SimpleLazyObject, empty
 
+from . import auth, metrics, policy, ratelimit
+from .dbstats import track_queries
+from .logwriter import get_writer, log_settings
+
+
+class SyncAsyncMiddleware:
+    """
+    Base for middleware that runs natively under both WSGI and ASGI.
+
+    Django hands over an async get_response when the rest of the chain is
+    async; the middleware then marks itself as a coroutine function and
+    __call__ hands each request to __acall__, which runs on the event loop
+    without a thread hop around it. Same switch as Django's MiddlewareMixin.
+    """
+
+    sync_capable = True
+    async_capable = True
 
-class RequestLoggingMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
-        self.log_file = os.path.join(settings.BASE_DIR, "requests.log")
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+def request_user(request):
+    """
+    The user of a JWT bearer token (built from its claims, see chats.auth),
+    else request.user. Middleware runs before DRF authenticates tokens.
+    """
+    return auth.token_user(request) or getattr(request, "user", None)
+
+
+async def get_user(request):
+    """
+    request_user() for async middleware. Evaluating the lazy request.user
+    queries the session and user tables, which is not allowed on the event
+    loop; do it in one thread hop, so the sync view that runs later finds
+    the user already loaded instead of querying again through auser().
+    """
+    user = await auth.atoken_user(request)
+    if user is not None:
+        return user
+    user = getattr(request, "user", None)
+    if user is None:
+        auser = getattr(request, "auser", None)
+        return await auser() if auser is not None else None
+    if isinstance(user, SimpleLazyObject) and user._wrapped is empty:
+        await sync_to_async(user._setup)()
+    return user
+
+
+class RequestLoggingMiddleware(SyncAsyncMiddleware):
+    """
+    Log every request to requests.log.
+    The line is only queued here; chats.logwriter writes it out in batches
+    from a background thread (see settings.CHATS_REQUEST_LOG).
+
+    With CHATS_REQUEST_LOG["FORMAT"] = "json" each line is a JSON object
+    written after the response, with its status, wall time, response size
+    and the number of database queries and time spent in them.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.writer = get_writer()
+        self.structured = log_settings()["FORMAT"] == "json"
 
     def __call__(self, request):
-        user = request.user if request.user.is_authenticated else "Anonymous"
-        log_line = f"{datetime.now()} - User: {user} - Path: {request.path}\n"
+        if self.async_mode:
+            return self.__acall__(request)
+        if self.structured:
+            return self.log_structured(request)
 
-        # Append to requests.log
-        with open(self.log_file, "a") as f:
-            f.write(log_line)
+        # Queue for requests.log
+        self.writer.write(self.log_line(request, request_user(request)))
 
         response = self.get_response(request)
         return response
 
+    async def __acall__(self, request):
+        if self.structured:
+            return await self.alog_structured(request)
+
+        self.writer.write(self.log_line(request, await get_user(request)))
+
+        response = await self.get_response(request)
+        return response
+
+    def log_line(self, request, user):
+        user = user if user.is_authenticated else "Anonymous"
+        return f"{datetime.now()} - User: {user} - Path: {request.path}\n"
+
+    def log_structured(self, request):
+        started_at = datetime.now()
+        start = time.perf_counter()
+        with track_queries() as queries:
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+        self.write_record(request, response, request_user(request), started_at, duration, queries)
+        return response
+
+    async def alog_structured(self, request):
+        started_at = datetime.now()
+        start = time.perf_counter()
+        with track_queries() as queries:
+            response = await self.get_response(request)
+        duration = time.perf_counter() - start
+        user = await get_user(request)
+        self.write_record(request, response, user, started_at, duration, queries)
+        return response
+
+    def write_record(self, request, response, user, started_at, duration, queries):
+        user = user if user.is_authenticated else None
+        match = request.resolver_match
+        record = {
+            "time": started_at.isoformat(),
+            "method": request.method,
+            "path": request.path,
+            "route": match.view_name if match else None,
+            "status": response.status_code,
+            "duration_ms": round(duration * 1000, 3),
+            "db_queries": queries.count,
+            "db_time_ms": round(queries.duration * 1000, 3),
+            "response_bytes": None if response.streaming else len(response.content),
+            "user": str(user.pk) if user else None,
+        }
+        self.writer.write(json.dumps(record, separators=(",", ":")) + "\n")
 
-class RestrictAccessByTimeMiddleware:
+
+class PolicyMiddleware(SyncAsyncMiddleware):
     """
-    Deny access to chat endpoints outside 6AM to 9PM.
+    Enforce one chats.policy.Policy: time windows, role requirements and
+    rate limits, looked up once per request by path. The user is only
+    resolved when a rule that applies needs it.
+
+    Subclasses say which policy in get_policy(), called per request.
     """
 
     def __init__(self, get_response):
-        self.get_response = get_response
+        super().__init__(get_response)
+        self.backend = ratelimit.get_backend()
+
+    def get_policy(self):
+        raise NotImplementedError
 
     def __call__(self, request):
-        current_hour = datetime.now().hour
-        # Allow access only between 6 AM and 9 PM
-        if not (6 <= current_hour < 21):
-            return HttpResponseForbidden("Chat access is restricted between 9PM and 6AM.")
+        if self.async_mode:
+            return self.__acall__(request)
+        match = self.get_policy().match(request.method, request.path)
+        if match is not None:
+            user = request_user(request) if match.needs_user else None
+            denied = match.check(request, user, self.backend)
+            if denied is not None:
+                return denied
+        return self.get_response(request)
 
-        response = self.get_response(request)
+    async def __acall__(self, request):
+        match = self.get_policy().match(request.method, request.path)
+        if match is not None:
+            user = await get_user(request) if match.needs_user else None
+            if match.limits and getattr(self.backend, "blocking", True):
+                denied = await sync_to_async(match.check, thread_sensitive=False)(
+                    request, user, self.backend
+                )
+            else:
+                denied = match.check(request, user, self.backend)
+            if denied is not None:
+                return denied
+        return await self.get_response(request)
 
-        return response
 
+class FixedPolicyMiddleware(PolicyMiddleware):
+    """A PolicyMiddleware whose policy is compiled once, by build_policy()."""
 
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.policy = self.build_policy()
 
+    def build_policy(self):
+        raise NotImplementedError
 
+    def get_policy(self):
+        return self.policy
 
-class OffensiveLanguageMiddleware:
+
+class RestrictAccessByTimeMiddleware(FixedPolicyMiddleware):
+    """
+    Deny access to chat endpoints outside 6AM to 9PM.
+
+    Superseded by AccessPolicyMiddleware ("hours" rules).
+    """
+
+    # access allowed from OPEN_HOUR (inclusive) to CLOSE_HOUR (exclusive)
+    OPEN_HOUR = 6
+    CLOSE_HOUR = 21
+
+    def build_policy(self):
+        return policy.Policy([policy.Rule(
+            "/",
+            hours=f"{self.OPEN_HOUR:02d}:00-{self.CLOSE_HOUR:02d}:00",
+            message="Chat access is restricted between 9PM and 6AM.",
+        )])
+
+
+class OffensiveLanguageMiddleware(FixedPolicyMiddleware):
     """
-    Middleware to limit number of chat messages sent by an IP address
+    Middleware to limit number of chat messages sent by a client
     within a defined time window (rate limiting).
+
+    Limits come from settings.CHATS_RATE_LIMITS (see chats.ratelimit); the
+    class attributes below are the default when none are configured. State
+    lives in the configured backend, so limits can hold across workers.
+
+    Superseded by AccessPolicyMiddleware, which enforces the same limits.
     """
 
     # max messages per window
@@ -57,72 +230,97 @@ class OffensiveLanguageMiddleware:
     # window in seconds (1 minute)
     TIME_WINDOW = 60
 
-    def __init__(self, get_response):
-        self.get_response = get_response
-        # store IP addresses with timestamps of POST requests
-        self.ip_requests = {}
+    def build_policy(self):
+        return policy.Policy(limits=ratelimit.configured_limits() or [
+            ratelimit.RateLimit(
+                name="messages",
+                path="/api/messages/",
+                methods=["POST"],
+                rate=f"{self.MESSAGE_LIMIT}/{self.TIME_WINDOW}s",
+                key="ip",
+            )
+        ])
 
-    def __call__(self, request):
-        if request.method == "POST" and request.path.startswith("/api/messages/"):
-            ip = self.get_client_ip(request)
-            now = time.time()
-            # remove old requests outside the time window
-            timestamps = self.ip_requests.get(ip, [])
-            timestamps = [t for t in timestamps if now - t < self.TIME_WINDOW]
-
-            if len(timestamps) >= self.MESSAGE_LIMIT:
-                return JsonResponse(
-                    {"error": "Rate limit exceeded. Max 5 messages per minute."},
-                    status=429,
-                )
 
-            timestamps.append(now)
-            self.ip_requests[ip] = timestamps
+class RolepermissionMiddleware(FixedPolicyMiddleware):
+    """
+    Middleware to enforce role-based access control.
+    Every request must be authenticated, and only users with 'admin' or
+    'moderator' role can reach /api/protected/.
 
-        response = self.get_response(request)
-        return response
+    Superseded by AccessPolicyMiddleware ("roles" rules).
+    """
 
-    def get_client_ip(self, request):
-        """
-        Retrieve client IP address from request.
-        Handles common reverse proxy headers.
-        """
-        x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
-        if x_forwarded_for:
-            ip = x_forwarded_for.split(",")[0]
-        else:
-            ip = request.META.get("REMOTE_ADDR")
-        return ip
+    # roles allowed to access protected routes
+    ALLOWED_ROLES = ["admin", "moderator"]
 
+    def build_policy(self):
+        return policy.Policy([
+            policy.Rule("/", authenticated=True),
+            policy.Rule("/api/protected/", roles=self.ALLOWED_ROLES),
+        ])
 
 
-class RolepermissionMiddleware:
+class AccessPolicyMiddleware(PolicyMiddleware):
     """
-    Middleware to enforce role-based access control.
-    Only users with 'admin' or 'moderator' role can proceed.
+    Enforce the access policy compiled by chats.policy from settings (or
+    the policy file, reloaded when it changes).
     """
 
-    # roles allowed to access protected routes
-    ALLOWED_ROLES = ["admin", "moderator"]
+    def get_policy(self):
+        return policy.current()
+
+
+class MetricsMiddleware(SyncAsyncMiddleware):
+    """
+    Record request metrics and serve CHATS_METRICS["PATH"]. Put it above
+    the access policy, so scrapes are not subject to its hours and limits.
+    Not loaded unless CHATS_METRICS["ENABLED"].
+    """
+
+    METHODS = frozenset(["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
 
     def __init__(self, get_response):
-        self.get_response = get_response
+        options = metrics.metrics_settings()
+        if not options["ENABLED"]:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.path = options["PATH"]
+        self.allowed_ips = options["ALLOWED_IPS"]
 
     def __call__(self, request):
-        # Ensure the user is authenticated first
-        user = getattr(request, "user", None)
-        if not user or not user.is_authenticated:
-            return JsonResponse(
-                {"error": "Authentication required."}, status=401
-            )
+        if self.async_mode:
+            return self.__acall__(request)
+        if request.path == self.path:
+            return self.scrape(request)
+        start = time.perf_counter()
+        with track_queries() as queries:
+            response = self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
 
-        # Check role for protected actions
-        if request.path.startswith("/api/protected/"):  # Adjust your endpoint
-            user_role = getattr(user, "role", None)  # assuming user model has 'role' field
-            if user_role not in self.ALLOWED_ROLES:
-                return JsonResponse(
-                    {"error": "Forbidden. Admin or moderator role required."}, status=403
-                )
+    async def __acall__(self, request):
+        if request.path == self.path:
+            return self.scrape(request)
+        start = time.perf_counter()
+        with track_queries() as queries:
+            response = await self.get_response(request)
+        self.record(request, response, time.perf_counter() - start, queries)
+        return response
 
-        response = self.get_response(request)
-        return response
\ No newline at end of file
+    def scrape(self, request):
+        if self.allowed_ips is not None and request.META.get("REMOTE_ADDR") not in self.allowed_ips:
+            return HttpResponseForbidden("Metrics are not available from this address.")
+        return HttpResponse(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+    def record(self, request, response, duration, queries):
+        # Label by URL name, not path, to keep the number of series bounded
+        match = request.resolver_match
+        route = (match.view_name or match.route) if match else "unmatched"
+        method = request.method if request.method in self.METHODS else "other"
+        metrics.REQUEST_DURATION.observe(duration, route, method)
+        metrics.REQUESTS.inc(route, method, str(response.status_code))
+        if queries.count:
+            metrics.DB_QUERIES.inc(route, amount=queries.count)
+        if response.status_code == 401:
+            metrics.AUTH_FAILURES.inc(route)
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def install_search(apps, schema_editor):
+    from chats import search
+
+    if search.fts_supported(schema_editor.connection):
+        search.install(schema_editor.connection)
+
+
+def uninstall_search(apps, schema_editor):
+    from chats import search
+
+    if search.fts_supported(schema_editor.connection):
+        search.uninstall(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0003_conversation_activity'),
+    ]
+
+    operations = [
+        migrations.RunPython(install_search, uninstall_search),
+    ]
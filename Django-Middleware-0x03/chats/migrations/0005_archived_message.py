@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0004_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('sender_id', models.UUIDField()),
+                ('conversation_id', models.UUIDField()),
+                ('message_body', models.TextField()),
+                ('sent_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['conversation_id', 'sent_at', 'id'], name='chats_archmsg_conv_sent_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 04:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0005_archived_message'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='flagged_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,61 @@
+# Generated by Django 5.2.8 on 2026-10-18 04:55
+
+from django.db import migrations, models
+
+
+def number_messages(apps, schema_editor):
+    """Give existing messages change numbers in the order they were sent."""
+    alias = schema_editor.connection.alias
+    ChangeSequence = apps.get_model('chats', 'ChangeSequence')
+    Message = apps.get_model('chats', 'Message')
+    batch = []
+    seq = 0
+    for pk in Message.objects.using(alias).order_by('sent_at', 'id').values_list('pk', flat=True).iterator():
+        seq += 1
+        batch.append(Message(pk=pk, change_seq=seq))
+        if len(batch) == 1000:
+            Message.objects.using(alias).bulk_update(batch, ['change_seq'])
+            batch = []
+    Message.objects.using(alias).bulk_update(batch, ['change_seq'])
+    ChangeSequence.objects.using(alias).create(name='messages', value=seq)
+
+
+def reinstall_search(apps, schema_editor):
+    # SQLite rebuilt chats_message to add change_seq, dropping the FTS triggers
+    from chats import search
+
+    if search.fts_supported(schema_editor.connection):
+        search.install(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0007_conversation_change_tracking'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('value', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='change_seq',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='edited_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'change_seq'], name='chats_msg_conv_change_idx'),
+        ),
+        migrations.RunPython(number_messages, migrations.RunPython.noop),
+        migrations.RunPython(reinstall_search, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.8 on 2026-10-18 05:03
+
+from django.db import migrations, models, router
+from django.db.models import OuterRef, Subquery
+
+
+def backfill_preview(apps, schema_editor):
+    alias = schema_editor.connection.alias
+    Conversation = apps.get_model('chats', 'Conversation')
+    for model_name in ('Message', 'ArchivedMessage'):
+        model = apps.get_model('chats', model_name)
+        if router.db_for_write(model) != alias:
+            # A separate archive database: run rebuild_conversation_activity
+            continue
+        latest = model.objects.filter(pk=OuterRef('last_message_id'))
+        Conversation.objects.using(alias).filter(
+            last_message_id__isnull=False, last_message_sender_id__isnull=True,
+        ).update(
+            last_message_sender_id=Subquery(latest.values('sender_id')[:1]),
+            last_message_body=Subquery(latest.values('message_body')[:1]),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chats', '0008_message_change_seq'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_body',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_sender_id',
+            field=models.UUIDField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_preview, migrations.RunPython.noop),
+    ]
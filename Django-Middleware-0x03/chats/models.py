@@ -1,6 +1,8 @@
 import uuid
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.contrib.auth.models import AbstractUser
+from django.utils import timezone
 
 
 class User(AbstractUser):
@@ -48,16 +50,79 @@ class Conversation(models.Model):
     - UUID primary key
     - Many-to-many participants
     - created_at timestamp
+    - last_message_at / last_message_id / message_count: denormalized
+      activity, maintained by chats.activity on message writes
+    - last_message_sender_id / last_message_body: the inbox preview of that
+      message, stored here so it survives the message being archived
+    - participants_version / changed_at: bumped by chats.activity when the
+      participants (or their profiles) change, and changed_at also on message
+      edits and deletes; with the activity fields they validate conditional GETs
     """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     participants = models.ManyToManyField(User, related_name='conversations')
     created_at = models.DateTimeField(auto_now_add=True)
 
+    last_message_at = models.DateTimeField(blank=True, null=True)
+    last_message_id = models.UUIDField(blank=True, null=True)
+    last_message_sender_id = models.UUIDField(blank=True, null=True)
+    last_message_body = models.TextField(blank=True, null=True)
+    message_count = models.PositiveIntegerField(default=0)
+    participants_version = models.PositiveIntegerField(default=0)
+    changed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            # "Most recent conversations" ordering for the inbox
+            models.Index(fields=['-last_message_at'], name='chats_conv_last_msg_idx'),
+        ]
+
     def __str__(self):
         return f"Conversation {self.id}"
 
 
+class ChangeSequence(models.Model):
+    """
+    Named counters handing out monotonic change numbers (see chats.sync).
+
+    take() increments the row inside the caller's transaction, which holds
+    the row lock until it commits: writers are numbered in commit order, so
+    a reader that has seen number N will never see a smaller one appear.
+    It also means writers of one counter take turns (see chats.sync).
+    """
+
+    name = models.CharField(primary_key=True, max_length=50)
+    value = models.BigIntegerField(default=0)
+
+    MESSAGES = 'messages'
+
+    @classmethod
+    def take(cls, name, count=1, using=None):
+        """Reserve `count` numbers of counter `name`; returns the first one."""
+        counters = cls.objects.db_manager(using).filter(pk=name)
+        with transaction.atomic(using=using, savepoint=False):
+            if not counters.update(value=F('value') + count):
+                cls.objects.db_manager(using).get_or_create(pk=name)
+                counters.update(value=F('value') + count)
+            return counters.values_list('value', flat=True).get() - count + 1
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def bulk_create(self, objs, *args, **kwargs):
+        # Number the batch in one go, like save() does for single messages
+        objs = list(objs)
+        with transaction.atomic(using=self.db, savepoint=False):
+            if objs:
+                first = ChangeSequence.take(ChangeSequence.MESSAGES, len(objs), using=self.db)
+                for offset, message in enumerate(objs):
+                    message.change_seq = first + offset
+            return super().bulk_create(objs, *args, **kwargs)
+
+
 class Message(models.Model):
     """
     Represents a message inside a conversation.
@@ -65,6 +130,10 @@ class Message(models.Model):
     - conversation → FK to Conversation
     - message_body
     - sent_at timestamp
+    - flagged_at: when the content filter flagged it, if it did
+    - edited_at: when it was last saved after being sent
+    - change_seq: taken from ChangeSequence on every create and edit,
+      so chats.sync can list what changed since a client last synced
     """
 
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -73,9 +142,74 @@ class Message(models.Model):
 
     message_body = models.TextField()
     sent_at = models.DateTimeField(auto_now_add=True)
+    # Set when the content filter flagged the body (see chats.content_filter)
+    flagged_at = models.DateTimeField(null=True, blank=True)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    change_seq = models.BigIntegerField(default=0, editable=False)
+
+    objects = MessageQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Backs keyset pagination over a conversation's history
+            models.Index(fields=['conversation', 'sent_at', 'id'], name='chats_msg_conv_sent_idx'),
+            # Backs "changed since" range scans per conversation (chats.sync)
+            models.Index(fields=['conversation', 'change_seq'], name='chats_msg_conv_change_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        # Keep the conversation activity update (post_save) and the change
+        # number in the same transaction
+        using = kwargs.get('using')
+        with transaction.atomic(using=using):
+            if not self._state.adding:
+                self.edited_at = timezone.now()
+            self.change_seq = ChangeSequence.take(ChangeSequence.MESSAGES, using=using)
+            if kwargs.get('update_fields') is not None:
+                kwargs['update_fields'] = {*kwargs['update_fields'], 'edited_at', 'change_seq'}
+            super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic(using=kwargs.get('using')):
+            return super().delete(*args, **kwargs)
 
     def __str__(self):
         return f"{self.sender.email}: {self.message_body[:30]}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    Cold copy of a Message, moved out of chats_message by archive_messages.
+    - sender_id / conversation_id are plain UUIDs, not foreign keys, so the
+      table can live in a separate archive database
+    - archived_at timestamp
+    """
+
+    id = models.UUIDField(primary_key=True, editable=False)
+    sender_id = models.UUIDField()
+    conversation_id = models.UUIDField()
+
+    message_body = models.TextField()
+    sent_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['conversation_id', 'sent_at', 'id'], name='chats_archmsg_conv_sent_idx'),
+        ]
+
+    def as_message(self):
+        """Unsaved Message carrying this row's data, for serialization."""
+        return Message(
+            id=self.id,
+            sender_id=self.sender_id,
+            conversation_id=self.conversation_id,
+            message_body=self.message_body,
+            sent_at=self.sent_at,
+        )
+
+    def __str__(self):
+        return f"Archived message {self.id}"
 from django.db import models
 
 # Create your models here.
@@ -1,5 +1,17 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import uuid
+from urllib import parse
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import archive
+
 
 class MessagePagination(PageNumberPagination):
     page_size = 20
@@ -15,3 +27,147 @@ class MessagePagination(PageNumberPagination):
             "previous": self.get_previous_link(),
             "results": data,
         })
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination over (sent_at, id), newest first.
+
+    - ?before=<cursor> returns the page of older messages
+    - ?after=<cursor> returns the page of newer messages
+    Cursors are opaque tokens built from the (sent_at, id) of a row, so
+    every page is a single range scan on the (conversation, sent_at, id)
+    index and never runs COUNT(*) or OFFSET.
+
+    If the view defines get_archive_queryset(), pages that reach past the
+    hot rows continue transparently into the archived messages.
+    """
+
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
+    before_query_param = "before"
+    after_query_param = "after"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.page_size = self.get_page_size(request)
+
+        before = self.decode_cursor(request, self.before_query_param)
+        after = self.decode_cursor(request, self.after_query_param)
+        limit = self.page_size + 1
+
+        # Views whose history can reach into cold storage expose it here
+        get_archive = getattr(view, "get_archive_queryset", None)
+        archived = get_archive() if get_archive is not None else None
+
+        if after is not None:
+            # Walk forward from the cursor, then flip back to newest first.
+            # Archived rows are all older than hot ones, so they come first.
+            # The archive is always asked: archive_messages --older-than-days
+            # can move rows newer than the configured cutoff, and past the
+            # newest archived row the range scan comes back empty.
+            rows = []
+            if archived is not None:
+                rows = self.fetch(archived, after, newest_first=False, limit=limit)
+                rows = archive.as_messages(rows)
+            if len(rows) < limit:
+                rows += self.fetch(queryset, after, newest_first=False, limit=limit - len(rows))
+            self.has_previous = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            rows.reverse()
+            self.has_next = bool(rows)
+        else:
+            rows = self.fetch(queryset, before, newest_first=True, limit=limit)
+            if archived is not None and len(rows) < limit:
+                # Past the end of the hot table: continue in the archive
+                key = (rows[-1].sent_at, rows[-1].pk) if rows else before
+                older = self.fetch(archived, key, newest_first=True, limit=limit - len(rows))
+                rows += archive.as_messages(older)
+            self.has_next = len(rows) > self.page_size
+            rows = rows[:self.page_size]
+            self.has_previous = before is not None and bool(rows)
+
+        self.page = rows
+        return rows
+
+    def fetch(self, queryset, key, newest_first, limit):
+        """Up to `limit` rows strictly past `key` in the given direction."""
+        if newest_first:
+            if key is not None:
+                queryset = queryset.filter(self.older_than(key))
+            queryset = queryset.order_by("-sent_at", "-id")
+        else:
+            queryset = queryset.filter(self.newer_than(key)).order_by("sent_at", "id")
+        return list(queryset[:limit])
+
+    def get_paginated_response(self, data):
+        return Response({
+            "next": self.get_next_link(),
+            "previous": self.get_previous_link(),
+            "results": data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = remove_query_param(self.base_url, self.after_query_param)
+        return replace_query_param(url, self.before_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        url = remove_query_param(self.base_url, self.before_query_param)
+        return replace_query_param(url, self.after_query_param, self.encode_cursor(self.page[0]))
+
+    @staticmethod
+    def older_than(key):
+        sent_at, pk = key
+        return Q(sent_at__lt=sent_at) | Q(sent_at=sent_at, id__lt=pk)
+
+    @staticmethod
+    def newer_than(key):
+        sent_at, pk = key
+        return Q(sent_at__gt=sent_at) | Q(sent_at=sent_at, id__gt=pk)
+
+    @staticmethod
+    def encode_cursor(message):
+        raw = f"{message.sent_at.isoformat()}|{message.pk}"
+        return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii")
+
+    def decode_cursor(self, request, param):
+        encoded = request.query_params.get(param)
+        if not encoded:
+            return None
+        try:
+            raw = base64.urlsafe_b64decode(parse.unquote(encoded).encode("ascii")).decode("ascii")
+            sent_at, pk = raw.split("|", 1)
+            sent_at = parse_datetime(sent_at)
+            pk = uuid.UUID(pk)
+        except (TypeError, ValueError, UnicodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if sent_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return sent_at, pk
@@ -0,0 +1,258 @@
+"""
+Access policy: time windows, role requirements and rate limits in one place.
+
+Rules come from settings.CHATS_ACCESS_POLICY["RULES"], rate limits from
+settings.CHATS_RATE_LIMITS. Both are compiled into a trie keyed by path
+segment, so a request does one walk down its path and gets exactly the
+rules whose prefix covers it; everything else is never looked at.
+
+A rule is a dict:
+- path: URL prefix, matched on whole segments ("/api/" covers "/api" and
+  "/api/messages/", not "/apix/")
+- methods: HTTP methods it applies to (all if empty)
+- hours: "HH:MM-HH:MM", local server time, the window in which access is
+  allowed; may wrap midnight ("22:00-06:00")
+- roles: the user must be authenticated and have one of these roles
+- authenticated: the user must be authenticated
+- message: text of the 403 returned outside `hours`
+
+With CHATS_ACCESS_POLICY["FILE"] set, RULES and RATE_LIMITS are read from
+that JSON file instead, and the policy is recompiled when the file changes
+(checked at most every CHECK_INTERVAL seconds), so every worker picks up
+an edit without a restart. reload() recompiles immediately.
+"""
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import HttpResponseForbidden, JsonResponse
+
+from . import metrics, ratelimit
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "RULES": [],
+    "FILE": None,
+    "CHECK_INTERVAL": 1.0,
+}
+
+
+def policy_settings():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, "CHATS_ACCESS_POLICY", {}))
+    return options
+
+
+def parse_hours(hours):
+    """Parse "06:00-21:00" into (start, end) minutes after midnight."""
+    try:
+        start, end = (
+            int(h) * 60 + int(m)
+            for h, m in (part.strip().split(":") for part in hours.split("-"))
+        )
+    except ValueError:
+        raise ValueError(f"Invalid hours {hours!r}; expected e.g. '06:00-21:00'.")
+    return start, end
+
+
+def split_path(path):
+    return [segment for segment in path.split("/") if segment]
+
+
+class Rule:
+
+    def __init__(self, path, methods=(), hours=None, roles=None, authenticated=False,
+                 message=None):
+        self.path = path
+        self.methods = frozenset(m.upper() for m in methods)
+        self.window = parse_hours(hours) if hours else None
+        self.roles = frozenset(roles) if roles else None
+        self.authenticated = authenticated or self.roles is not None
+        self.message = message or f"Access is restricted outside {hours}."
+
+    def applies_to(self, method):
+        return not self.methods or method in self.methods
+
+    def open_at(self, minute):
+        start, end = self.window
+        if start <= end:
+            return start <= minute < end
+        return minute >= start or minute < end
+
+
+class Node:
+    __slots__ = ("children", "rules", "limits")
+
+    def __init__(self):
+        self.children = {}
+        self.rules = ()
+        self.limits = ()
+
+
+class Match:
+    """The rules and rate limits that apply to one request."""
+
+    __slots__ = ("rules", "limits", "needs_user")
+
+    def __init__(self, rules, limits):
+        self.rules = rules
+        self.limits = limits
+        self.needs_user = bool(limits) or any(rule.authenticated for rule in rules)
+
+    def check(self, request, user, backend):
+        """Return the response denying the request, or None to let it through."""
+        minute = None
+        for rule in self.rules:
+            if rule.window is None:
+                continue
+            if minute is None:
+                now = datetime.now()
+                minute = now.hour * 60 + now.minute
+            if not rule.open_at(minute):
+                return HttpResponseForbidden(rule.message)
+
+        for rule in self.rules:
+            if not rule.authenticated:
+                continue
+            if not user or not user.is_authenticated:
+                return JsonResponse({"error": "Authentication required."}, status=401)
+            if rule.roles is not None and getattr(user, "role", None) not in rule.roles:
+                roles = " or ".join(sorted(rule.roles))
+                return JsonResponse(
+                    {"error": f"Forbidden. {roles} role required."}, status=403
+                )
+
+        if self.limits:
+            return self.check_limits(request, user, backend)
+        return None
+
+    def check_limits(self, request, user, backend):
+        user_id, role = ratelimit.client_user(request, user)
+        ip = ratelimit.client_ip(request)
+        for limit in self.limits:
+            decision = limit.check(backend, user_id, role, ip)
+            if decision is not None and not decision.allowed:
+                metrics.RATE_LIMITED.inc(limit.name)
+                response = JsonResponse(
+                    {"error": f"Rate limit exceeded. Max {limit.limit} requests "
+                              f"per {limit.window} seconds."},
+                    status=429,
+                )
+                response["Retry-After"] = str(max(1, math.ceil(decision.retry_after)))
+                return response
+        return None
+
+
+class Policy:
+    """Rules and rate limits compiled into a path-segment trie."""
+
+    source = None
+    source_mtime = None
+    check_interval = DEFAULTS["CHECK_INTERVAL"]
+
+    def __init__(self, rules=(), limits=()):
+        self.root = Node()
+        for rule in rules:
+            node = self.node(rule.path)
+            node.rules += (rule,)
+        for limit in limits:
+            node = self.node(limit.path)
+            node.limits += (limit,)
+
+    def node(self, path):
+        node = self.root
+        for segment in split_path(path):
+            node = node.children.setdefault(segment, Node())
+        return node
+
+    def match(self, method, path):
+        """Return the Match for a request, or None when nothing applies."""
+        node = self.root
+        rules, limits = list(node.rules), list(node.limits)
+        for segment in split_path(path):
+            node = node.children.get(segment)
+            if node is None:
+                break
+            rules.extend(node.rules)
+            limits.extend(node.limits)
+        rules = [rule for rule in rules if rule.applies_to(method)]
+        limits = [limit for limit in limits if not limit.methods or method in limit.methods]
+        if not rules and not limits:
+            return None
+        return Match(rules, limits)
+
+    @classmethod
+    def from_config(cls, rules, limits):
+        return cls(
+            [Rule(**options) for options in rules],
+            [ratelimit.RateLimit(**options) for options in limits],
+        )
+
+
+_policy = None
+_checked_at = 0.0
+
+
+def _file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def reload():
+    """Recompile the policy from settings (or the policy file) now."""
+    global _policy, _checked_at
+    options = policy_settings()
+    rules = options["RULES"]
+    limits = getattr(settings, "CHATS_RATE_LIMITS", [])
+    mtime = None
+    if options["FILE"]:
+        mtime = _file_mtime(options["FILE"])
+        with open(options["FILE"], encoding="utf-8") as f:
+            config = json.load(f)
+        rules = config.get("RULES", rules)
+        limits = config.get("RATE_LIMITS", limits)
+    policy = Policy.from_config(rules, limits)
+    policy.source = options["FILE"]
+    policy.source_mtime = mtime
+    policy.check_interval = options["CHECK_INTERVAL"]
+    # One assignment: concurrent requests see the old or the new policy
+    _policy, _checked_at = policy, time.monotonic()
+    return policy
+
+
+def current():
+    """
+    The compiled policy, recompiled first if the policy file changed. A file
+    that cannot be read or parsed leaves the last good policy in place until
+    the file changes again, so each broken edit is tried and logged once.
+    """
+    global _checked_at
+    policy = _policy
+    if policy is None:
+        return reload()
+    if policy.source and time.monotonic() - _checked_at >= policy.check_interval:
+        _checked_at = time.monotonic()
+        mtime = _file_mtime(policy.source)
+        if mtime != policy.source_mtime:
+            try:
+                return reload()
+            except (OSError, ValueError, TypeError):
+                policy.source_mtime = mtime
+                logger.exception("Could not reload the access policy from %s", policy.source)
+    return policy
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    global _policy
+    if setting in ("CHATS_ACCESS_POLICY", "CHATS_RATE_LIMITS"):
+        _policy = None
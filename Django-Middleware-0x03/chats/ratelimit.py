@@ -0,0 +1,352 @@
+"""
+Rate limiting.
+
+Two algorithms, both keeping a fixed-size state per key:
+- "token-bucket": (tokens, updated_at); allows bursts up to the limit and
+  refills continuously at limit / window.
+- "sliding-window": (window_start, current, previous); the previous fixed
+  window's count is weighted by how much of it still overlaps the sliding
+  window. A close approximation of a true sliding log in O(1) memory.
+
+Three storage backends:
+- InProcessBackend: an LRU dict, per process. Idle keys are evicted.
+- SQLiteBackend: one SQLite file shared by every worker on the host; each
+  hit is a short BEGIN IMMEDIATE transaction.
+- RedisBackend: any Redis-protocol server (Redis, Valkey, KeyDB, ...),
+  shared across hosts; each hit is one atomic Lua script. Needs `redis`.
+
+Limits are configured per route in settings.CHATS_RATE_LIMITS, keyed by
+user, by IP, or by user falling back to IP (see RateLimit).
+"""
+import itertools
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+Decision = namedtuple("Decision", "allowed remaining retry_after")
+
+PERIODS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+def parse_rate(rate):
+    """
+    Parse "5/m", "100/h" or "10/30s" into (limit, window_seconds).
+    """
+    count, _, period = rate.partition("/")
+    multiplier = period[:-1] or "1"
+    try:
+        return int(count), int(multiplier) * PERIODS[period[-1]]
+    except (KeyError, IndexError, ValueError):
+        raise ValueError(f"Invalid rate {rate!r}; expected e.g. '5/m' or '10/30s'.")
+
+
+# Algorithms: pure functions of (state, limit, window, now), returning
+# (decision, new_state). State is None for a key never seen before.
+
+def token_bucket(state, limit, window, now):
+    tokens, updated_at = state if state else (limit, now)
+    tokens = min(limit, tokens + (now - updated_at) * limit / window)
+    if tokens >= 1:
+        return Decision(True, int(tokens - 1), 0), (tokens - 1, now)
+    retry_after = (1 - tokens) * window / limit
+    return Decision(False, 0, retry_after), (tokens, now)
+
+
+def sliding_window(state, limit, window, now):
+    start = math.floor(now / window) * window
+    if state is None:
+        current, previous = 0, 0
+    else:
+        state_start, current, previous = state
+        if state_start != start:
+            # Roll over: the old current window becomes previous if adjacent
+            previous = current if state_start == start - window else 0
+            current = 0
+    weight = 1 - (now - start) / window
+    estimated = previous * weight + current
+    if estimated + 1 <= limit:
+        return Decision(True, int(limit - estimated - 1), 0), (start, current + 1, previous)
+    # Next time the weighted previous count has decayed enough, or the window ends
+    if previous:
+        retry_after = min((estimated + 1 - limit) / previous * window, start + window - now)
+    else:
+        retry_after = start + window - now
+    return Decision(False, 0, retry_after), (start, current, previous)
+
+
+ALGORITHMS = {
+    "token-bucket": token_bucket,
+    "sliding-window": sliding_window,
+}
+
+
+# Backends
+
+class InProcessBackend:
+    """
+    Per-process state in an LRU dict of at most `max_keys` entries. Keys idle
+    for longer than `idle_timeout` seconds are evicted as the LRU is touched.
+    """
+
+    # Hits never wait on I/O, so async callers may call hit() on the event loop
+    blocking = False
+
+    def __init__(self, max_keys=100000, idle_timeout=3600):
+        self.max_keys = max_keys
+        self.idle_timeout = idle_timeout
+        self._states = OrderedDict()  # key -> (state, touched)
+        self._lock = threading.Lock()
+
+    def hit(self, key, algorithm, limit, window, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._states.pop(key, None)
+            state = entry[0] if entry else None
+            decision, state = ALGORITHMS[algorithm](state, limit, window, now)
+            self._states[key] = (state, now)
+            self._evict(now)
+        return decision
+
+    def _evict(self, now):
+        while self._states:
+            key, (_, touched) = next(iter(self._states.items()))
+            if len(self._states) <= self.max_keys and now - touched < self.idle_timeout:
+                break
+            del self._states[key]
+
+    def __len__(self):
+        return len(self._states)
+
+
+class SQLiteBackend:
+    """
+    State in a SQLite file shared by every worker process on the host. Each
+    hit reads and writes one row inside BEGIN IMMEDIATE, which serializes
+    concurrent hits across processes. Idle rows are deleted every
+    PURGE_EVERY hits.
+    """
+
+    PURGE_EVERY = 1000
+    blocking = True
+
+    def __init__(self, path=None, idle_timeout=3600, timeout=5.0):
+        self.path = str(path or os.path.join(settings.BASE_DIR, "ratelimit.sqlite3"))
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._local = threading.local()
+        self._hits = itertools.count(1)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ratelimit ("
+                " key TEXT PRIMARY KEY, a REAL, b REAL, c REAL, touched REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ratelimit_touched ON ratelimit (touched)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def hit(self, key, algorithm, limit, window, now=None):
+        now = time.time() if now is None else now
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT a, b, c FROM ratelimit WHERE key = ?", (key,)).fetchone()
+            state = tuple(v for v in row if v is not None) if row else None
+            decision, state = ALGORITHMS[algorithm](state, limit, window, now)
+            values = list(state) + [None] * (3 - len(state))
+            conn.execute(
+                "INSERT OR REPLACE INTO ratelimit (key, a, b, c, touched) VALUES (?, ?, ?, ?, ?)",
+                (key, *values, now),
+            )
+            if next(self._hits) % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM ratelimit WHERE touched < ?", (now - self.idle_timeout,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return decision
+
+
+class RedisBackend:
+    """
+    State in a Redis-protocol server, updated atomically by a Lua script per
+    algorithm. Keys expire after `idle_timeout` seconds without hits.
+    """
+
+    blocking = True
+
+    SCRIPTS = {
+        "token-bucket": """
+            local limit, window, now, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+            local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+            local tokens, ts = tonumber(state[1]) or limit, tonumber(state[2]) or now
+            tokens = math.min(limit, tokens + (now - ts) * limit / window)
+            local allowed, retry = 0, 0
+            if tokens >= 1 then
+                tokens = tokens - 1
+                allowed = 1
+            else
+                retry = (1 - tokens) * window / limit
+            end
+            redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+            redis.call('EXPIRE', KEYS[1], ttl)
+            return {allowed, math.floor(tokens), tostring(retry)}
+        """,
+        "sliding-window": """
+            local limit, window, now, ttl = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+            local start = math.floor(now / window) * window
+            local state = redis.call('HMGET', KEYS[1], 'start', 'cur', 'prev')
+            local s, cur, prev = tonumber(state[1]), tonumber(state[2]) or 0, tonumber(state[3]) or 0
+            if s ~= start then
+                if s == start - window then prev = cur else prev = 0 end
+                cur = 0
+            end
+            local estimated = prev * (1 - (now - start) / window) + cur
+            local allowed, retry = 0, 0
+            if estimated + 1 <= limit then
+                cur = cur + 1
+                allowed = 1
+            elseif prev > 0 then
+                retry = math.min((estimated + 1 - limit) / prev * window, start + window - now)
+            else
+                retry = start + window - now
+            end
+            redis.call('HSET', KEYS[1], 'start', tostring(start), 'cur', cur, 'prev', prev)
+            redis.call('EXPIRE', KEYS[1], ttl)
+            return {allowed, math.max(0, math.floor(limit - estimated - allowed)), tostring(retry)}
+        """,
+    }
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="chats:rl:", idle_timeout=3600):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("RedisBackend needs the 'redis' package (pip install redis).")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.idle_timeout = idle_timeout
+        self._scripts = {name: self.client.register_script(src) for name, src in self.SCRIPTS.items()}
+
+    def hit(self, key, algorithm, limit, window, now=None):
+        now = time.time() if now is None else now
+        ttl = max(int(self.idle_timeout), int(math.ceil(window)) * 2)
+        allowed, remaining, retry_after = self._scripts[algorithm](
+            keys=[self.prefix + key], args=[limit, window, now, ttl]
+        )
+        return Decision(bool(allowed), int(remaining), float(retry_after))
+
+
+# Configuration
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """The backend configured by settings.CHATS_RATE_LIMIT_BACKEND (one per process)."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            config = getattr(settings, "CHATS_RATE_LIMIT_BACKEND", {})
+            backend_class = import_string(config.get("BACKEND", "chats.ratelimit.InProcessBackend"))
+            _backend = backend_class(**config.get("OPTIONS", {}))
+        return _backend
+
+
+def reset_backend():
+    global _backend
+    with _backend_lock:
+        _backend = None
+
+
+class RateLimit:
+    """
+    One configured limit:
+    - path: URL prefix it applies to; methods: HTTP methods (all if empty)
+    - rate: "N/period"; algorithm: "sliding-window" (default) or "token-bucket"
+    - key: "user", "ip" or "user_or_ip" (default)
+    - user_rates: optional {user id or role: rate} overrides; None exempts
+    """
+
+    KEYS = ("user", "ip", "user_or_ip")
+
+    def __init__(self, name, path, rate, methods=(), algorithm="sliding-window",
+                 key="user_or_ip", user_rates=None):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown rate limit algorithm {algorithm!r}.")
+        if key not in self.KEYS:
+            raise ValueError(f"Unknown rate limit key {key!r}.")
+        self.name = name
+        self.path = path
+        self.methods = frozenset(m.upper() for m in methods)
+        self.limit, self.window = parse_rate(rate)
+        self.algorithm = algorithm
+        self.key = key
+        self.user_rates = {
+            str(who): (parse_rate(r) if r else None) for who, r in (user_rates or {}).items()
+        }
+
+    def applies_to(self, method, path):
+        return path.startswith(self.path) and (not self.methods or method in self.methods)
+
+    def check(self, backend, user_id, role, ip, now=None):
+        """Return a Decision, or None when this client is not limited."""
+        limit, window = self.limit, self.window
+        for who in (user_id, role):
+            if who is not None and str(who) in self.user_rates:
+                override = self.user_rates[str(who)]
+                if override is None:
+                    return None
+                limit, window = override
+                break
+
+        if self.key == "ip" or (self.key == "user_or_ip" and user_id is None):
+            if ip is None:
+                return None
+            client = f"ip:{ip}"
+        elif user_id is None:
+            return None
+        else:
+            client = f"user:{user_id}"
+        # The algorithm is part of the key: a reloaded policy may switch it,
+        # and each algorithm reads only the state it wrote
+        key = f"{self.name}:{self.algorithm}:{client}"
+        return backend.hit(key, self.algorithm, limit, window, now=now)
+
+
+def configured_limits():
+    return [RateLimit(**options) for options in getattr(settings, "CHATS_RATE_LIMITS", [])]
+
+
+def client_user(request, user=None):
+    """
+    (user id, role) for rate limiting. Callers pass the user resolved from
+    the session or the JWT claims (see chats.middleware.request_user).
+    Anonymous clients are (None, None), whatever Authorization header they
+    send, so they share their IP's limit: keying by an unverified header
+    would give a new bucket to every made-up token.
+    """
+    if user is None:
+        user = getattr(request, "user", None)
+    if user is not None and user.is_authenticated:
+        return str(user.pk), getattr(user, "role", None)
+    return None, None
+
+
+def client_ip(request):
+    """Client IP address, taking the first X-Forwarded-For hop if present."""
+    x_forwarded_for = request.META.get("HTTP_X_FORWARDED_FOR")
+    if x_forwarded_for:
+        return x_forwarded_for.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR")
@@ -0,0 +1,53 @@
+"""
+JSON renderer backed by orjson, compatible with DRF's.
+
+With DRF's default JSON settings (COMPACT_JSON, UNICODE_JSON, STRICT_JSON)
+and no indent requested, orjson produces the same bytes as
+JSONRenderer for strings, ints, decimals, UUIDs and datetimes: same
+separators, same escapes, non-ASCII as UTF-8. Datetimes go through DRF's
+encoder (orjson would keep microseconds DRF drops), and U+2028/U+2029 are
+escaped the same way afterwards. Anything else (other settings, an indent,
+a value orjson rejects) is rendered by JSONRenderer itself.
+
+Floats are where the two differ. Both write the shortest form that reads
+back as the same number, but not the same form: 1e-06 is "1e-6" here,
+1e+16 is "1e16" and 1e-05 is "0.00001". NaN and infinite floats become
+null where JSONRenderer raises. Payloads with floats (the search rank)
+therefore parse to the same data but are not the same bytes, and an ETag
+taken over them changes when orjson is installed or removed. Without
+orjson installed this is just JSONRenderer.
+"""
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import api_settings
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+
+class ORJSONRenderer(JSONRenderer):
+
+    options = (
+        orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+    )
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or not self.fast_path_applies(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self.encoder_class().default, option=self.options)
+        except TypeError:
+            # Ints beyond 64 bits and the like: let the stdlib renderer
+            # produce its exact output or error
+            return super().render(data, accepted_media_type, renderer_context)
+        if b"\xe2\x80\xa8" in ret or b"\xe2\x80\xa9" in ret:
+            ret = ret.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+        return ret
+
+    def fast_path_applies(self, accepted_media_type, renderer_context):
+        if not (api_settings.COMPACT_JSON and api_settings.UNICODE_JSON and api_settings.STRICT_JSON):
+            return False
+        if self.encoder_class is not JSONRenderer.encoder_class:
+            return False
+        return self.get_indent(accepted_media_type, renderer_context or {}) is None
@@ -0,0 +1,171 @@
+"""
+Full-text message search.
+
+On SQLite, message bodies are indexed in an FTS5 virtual table
+(chats_message_fts) that uses chats_message as its external content table,
+keyed by the message rowid. Triggers keep it in step with every INSERT,
+UPDATE and DELETE on chats_message, including bulk_create and raw deletes.
+
+VACUUM and table rebuilds done by schema migrations can renumber rowids or
+drop the triggers; `manage.py rebuild_message_search` reinstalls both.
+
+Other database backends fall back to a case-insensitive substring match.
+
+Snippets are HTML: the message text is escaped and only the <mark> tags
+around matched terms are markup.
+
+Search covers hot messages only: archived ones (chats.archive) are not
+indexed and never match.
+"""
+import base64
+import binascii
+import re
+import uuid
+
+from django.db import connection
+from django.utils.html import escape
+
+from .models import Conversation, Message
+
+FTS_TABLE = "chats_message_fts"
+SNIPPET_TOKENS = 12
+# Private-use characters that FTS puts around matches; they are swapped for
+# <mark> tags once the rest of the snippet is escaped
+MARK_START, MARK_END = "\ue000", "\ue001"
+
+INSTALL_SQL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        message_body,
+        content='chats_message',
+        content_rowid='rowid',
+        tokenize='unicode61 remove_diacritics 2'
+    )""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON chats_message BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON chats_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_body)
+        VALUES ('delete', old.rowid, old.message_body);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF message_body ON chats_message BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message_body)
+        VALUES ('delete', old.rowid, old.message_body);
+        INSERT INTO {FTS_TABLE}(rowid, message_body) VALUES (new.rowid, new.message_body);
+    END""",
+]
+REBUILD_SQL = f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"
+UNINSTALL_SQL = [
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ai",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_ad",
+    f"DROP TRIGGER IF EXISTS {FTS_TABLE}_au",
+    f"DROP TABLE IF EXISTS {FTS_TABLE}",
+]
+
+_TERM = re.compile(r"\w+\*?", re.UNICODE)
+
+
+def fts_supported(conn=connection):
+    return conn.vendor == "sqlite"
+
+
+def install(conn=connection):
+    """Create the FTS table and triggers (idempotent) and reindex every message."""
+    with conn.cursor() as cursor:
+        for statement in INSTALL_SQL:
+            cursor.execute(statement)
+        cursor.execute(REBUILD_SQL)
+
+
+def uninstall(conn=connection):
+    with conn.cursor() as cursor:
+        for statement in UNINSTALL_SQL:
+            cursor.execute(statement)
+
+
+def to_match_expression(query):
+    """
+    Turn free text into a safe FTS5 MATCH expression: every word becomes a
+    quoted term (implicit AND), and a trailing * keeps prefix matching.
+    Returns "" when the query has no searchable terms.
+    """
+    terms = []
+    for term in _TERM.findall(query):
+        prefix = term.endswith("*")
+        word = term.rstrip("*")
+        if word:
+            terms.append(f'"{word}"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def highlight(text):
+    """`text` escaped for HTML, with the match sentinels turned into <mark> tags."""
+    return escape(text).replace(MARK_START, "<mark>").replace(MARK_END, "</mark>")
+
+
+def encode_cursor(rank, rowid):
+    raw = f"{rank!r}|{rowid}"
+    return base64.urlsafe_b64encode(raw.encode("ascii")).decode("ascii")
+
+
+def decode_cursor(encoded):
+    """Return (rank, rowid) or raise ValueError."""
+    try:
+        raw = base64.urlsafe_b64decode(encoded.encode("ascii")).decode("ascii")
+        rank, rowid = raw.split("|", 1)
+        return float(rank), int(rowid) if fts_supported() else uuid.UUID(rowid)
+    except (UnicodeError, binascii.Error) as exc:
+        raise ValueError(str(exc))
+
+
+def search_messages(user, query, limit, after=None):
+    """
+    Return up to `limit` hits as (message_id, rank, snippet, rowid) tuples,
+    best match first, restricted to the conversations `user` participates
+    in. `after` is a (rank, rowid) key from a previous page.
+    """
+    if not fts_supported():
+        return _search_substring(user, query, limit, after)
+
+    expression = to_match_expression(query)
+    if not expression:
+        return []
+
+    participants = Conversation.participants.through
+    user_id = Message._meta.pk.get_db_prep_value(user.pk, connection)
+    sql = f"""
+        SELECT m.id, {FTS_TABLE}.rank, snippet({FTS_TABLE}, 0, %s, %s, '…', {SNIPPET_TOKENS}), m.rowid
+        FROM {FTS_TABLE}
+        JOIN {Message._meta.db_table} AS m ON m.rowid = {FTS_TABLE}.rowid
+        WHERE {FTS_TABLE} MATCH %s
+          AND m.conversation_id IN (
+              SELECT conversation_id FROM {participants._meta.db_table} WHERE user_id = %s
+          )
+    """
+    params = [MARK_START, MARK_END, expression, user_id]
+    if after is not None:
+        sql += f" AND ({FTS_TABLE}.rank > %s OR ({FTS_TABLE}.rank = %s AND m.rowid > %s))"
+        params += [after[0], after[0], after[1]]
+    sql += f" ORDER BY {FTS_TABLE}.rank, m.rowid LIMIT %s"
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [
+            (Message._meta.pk.to_python(message_id), rank, highlight(snippet), rowid)
+            for message_id, rank, snippet, rowid in cursor.fetchall()
+        ]
+
+
+def _search_substring(user, query, limit, after):
+    # No relevance ranking here: every hit gets rank 0 and the page order
+    # is the primary key, which stands in for the rowid in cursors.
+    messages = Message.objects.filter(
+        conversation__participants=user, message_body__icontains=query
+    ).order_by("pk")
+    if after is not None:
+        messages = messages.filter(pk__gt=after[1])
+    match = re.compile(re.escape(query), re.IGNORECASE)
+    return [
+        (message_id, 0.0, highlight(match.sub(lambda m: MARK_START + m.group() + MARK_END, body)), message_id)
+        for message_id, body in messages.values_list("pk", "message_body")[:limit]
+    ]
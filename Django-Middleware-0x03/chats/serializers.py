@@ -1,8 +1,15 @@
+from django.utils import timezone
 from rest_framework import serializers
+from rest_framework.exceptions import PermissionDenied
+
+from . import content_filter
+from .fieldsets import SparseFieldsetMixin
+from .timing import TimedListSerializer, TimedSerializerMixin
+from .membership import is_participant
 from .models import User, Conversation, Message
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserSerializer(SparseFieldsetMixin, serializers.ModelSerializer):
     class Meta:
         model = User
         # Expose only safe fields
@@ -17,7 +24,26 @@ class UserSerializer(serializers.ModelSerializer):
         ]
 
 
-class MessageSerializer(serializers.ModelSerializer):
+def filter_message_body(attrs):
+    """
+    Run the content filter over attrs["message_body"]: reject blocked
+    language, keep the masked text, and set flagged_at on flagged bodies.
+    """
+    body = attrs.get('message_body')
+    if body is None:
+        return attrs
+    verdict = content_filter.scan(body)
+    if verdict.action == 'block':
+        raise serializers.ValidationError(
+            {'message_body': ["This message contains language that is not allowed."]}
+        )
+    attrs['message_body'] = verdict.text
+    if verdict.action == 'flag':
+        attrs['flagged_at'] = timezone.now()
+    return attrs
+
+
+class MessageSerializer(SparseFieldsetMixin, TimedSerializerMixin, serializers.ModelSerializer):
     sender = UserSerializer(read_only=True)
 
     class Meta:
@@ -27,12 +53,24 @@ class MessageSerializer(serializers.ModelSerializer):
             'sender',
             'message_body',
             'sent_at',
+            'edited_at',
             'conversation'
         ]
-        read_only_fields = ['id', 'sent_at']
+        read_only_fields = ['id', 'sent_at', 'edited_at']
+        list_serializer_class = TimedListSerializer
+
+    def validate_conversation(self, conversation):
+        # Messages can only be posted to (or moved into) your own conversations
+        request = self.context.get('request')
+        if request is not None and not is_participant(request.user, conversation.pk, request):
+            raise PermissionDenied("You are not allowed to send messages to this conversation.")
+        return conversation
+
+    def validate(self, attrs):
+        return filter_message_body(attrs)
 
 
-class ConversationSerializer(serializers.ModelSerializer):
+class ConversationSerializer(SparseFieldsetMixin, TimedSerializerMixin, serializers.ModelSerializer):
     participants = UserSerializer(many=True, read_only=True)
     messages = MessageSerializer(many=True, read_only=True)
 
@@ -44,6 +82,61 @@ class ConversationSerializer(serializers.ModelSerializer):
             'messages',
             'created_at'
         ]
+        list_serializer_class = TimedListSerializer
+
+
+class BulkMessageItemSerializer(serializers.Serializer):
+    """
+    One item of a bulk ingest batch. The conversation is kept as a plain id
+    so a batch is validated without a query per item; membership is checked
+    once per distinct conversation by the view.
+    """
+    conversation = serializers.UUIDField()
+    message_body = serializers.CharField()
+
+    def validate(self, attrs):
+        return filter_message_body(attrs)
+
+
+class LastMessageSerializer(serializers.Serializer):
+    """
+    Preview of a conversation's latest message, read from the denormalized
+    last_message_* fields of the conversation.
+    """
+    id = serializers.UUIDField(source='last_message_id')
+    sender = serializers.UUIDField(source='last_message_sender_id')
+    message_body = serializers.CharField(source='last_message_body')
+    sent_at = serializers.DateTimeField(source='last_message_at')
+
+
+class ConversationSummarySerializer(SparseFieldsetMixin, TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Inbox representation: participants, latest message and message count.
+    The message history itself lives at /conversations/<id>/messages/.
+    """
+    participants = UserSerializer(many=True, read_only=True)
+    last_message = serializers.SerializerMethodField()
+    message_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Conversation
+        fields = [
+            'id',
+            'participants',
+            'last_message',
+            'message_count',
+            'created_at'
+        ]
+        list_serializer_class = TimedListSerializer
+
+    # get_last_message() for chats.fastpath: LastMessageSerializer over the
+    # same row, None when last_message_id is
+    fast_plan_fields = {'last_message': (LastMessageSerializer, 'last_message_id')}
+
+    def get_last_message(self, obj):
+        if obj.last_message_id is None:
+            return None
+        return LastMessageSerializer(obj).data
 
 
 # Optional: For creating conversations with participant IDs
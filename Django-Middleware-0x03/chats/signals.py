@@ -0,0 +1,105 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import Signal, receiver
+
+from . import activity, auth, inbox_cache, membership, metrics
+from .models import Conversation, Message, User
+from .serializers import UserSerializer
+
+# Sent once per conversation after Message.objects.bulk_create(), which
+# bypasses post_save. Arguments: conversation_id, messages.
+messages_bulk_created = Signal()
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def participants_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Drop cached membership answers and inboxes when participants are added
+    or removed, from either side of the relation, and mark the conversations
+    changed. Users who left are invalidated along with those who remain.
+    """
+    if action in ("post_add", "post_remove"):
+        if reverse:
+            # user.conversations.add(...): instance is the user
+            membership.invalidate(pk_set, [instance.pk])
+            changed = Conversation.objects.filter(pk__in=pk_set)
+            inbox_cache.invalidate_conversations(pk_set, also=[instance.pk])
+        else:
+            membership.invalidate([instance.pk], pk_set)
+            changed = Conversation.objects.filter(pk=instance.pk)
+            inbox_cache.invalidate_conversations([instance.pk], also=pk_set)
+        activity.conversations_changed(changed, participants=True)
+    elif action == "pre_clear":
+        # Find who is affected while the rows still exist
+        if reverse:
+            changed = Conversation.objects.filter(participants=instance)
+            inbox_cache.invalidate_conversations(changed, also=[instance.pk])
+            activity.conversations_changed(changed, participants=True)
+        else:
+            inbox_cache.invalidate_conversations([instance.pk])
+    elif action == "post_clear":
+        # The cleared rows are gone by now, so there is no pk_set to go by
+        membership.invalidate_all()
+        if not reverse:
+            activity.conversations_changed(Conversation.objects.filter(pk=instance.pk), participants=True)
+
+
+# User fields that tokens carry as claims, or that claims-built users assume
+CLAIM_FIELDS = {"role", "username", "email", "is_active"}
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """A participant's rendered profile changed (not e.g. just last_login)."""
+    if created or raw:
+        return
+    if update_fields is None or set(update_fields) & CLAIM_FIELDS:
+        auth.revoke([instance.pk])
+    if update_fields is not None and not set(update_fields) & set(UserSerializer.Meta.fields):
+        return
+    conversations = Conversation.objects.filter(participants=instance)
+    inbox_cache.invalidate_conversations(conversations)
+    activity.conversations_changed(conversations, participants=True)
+
+
+@receiver(pre_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    auth.revoke([instance.pk])
+    # The participant rows go with the user, without m2m_changed
+    conversations = Conversation.objects.filter(participants=instance)
+    inbox_cache.invalidate_conversations(conversations)
+    activity.conversations_changed(conversations, participants=True)
+
+
+@receiver(pre_delete, sender=Conversation)
+def conversation_deleted(sender, instance, **kwargs):
+    inbox_cache.invalidate_conversations([instance.pk])
+
+
+@receiver(post_save, sender=Message)
+def message_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created:
+        metrics.MESSAGES_CREATED.inc()
+    if not activity.is_tracking():
+        return
+    if created:
+        activity.message_created(instance)
+    else:
+        activity.message_edited(instance)
+    inbox_cache.invalidate_conversations([instance.conversation_id])
+
+
+@receiver(post_delete, sender=Message)
+def message_deleted(sender, instance, **kwargs):
+    if activity.is_tracking():
+        activity.message_deleted(instance)
+        inbox_cache.invalidate_conversations([instance.conversation_id])
+
+
+@receiver(messages_bulk_created, sender=Message)
+def messages_bulk_saved(sender, conversation_id, messages, **kwargs):
+    metrics.MESSAGES_CREATED.inc(amount=len(messages))
+    if activity.is_tracking():
+        activity.messages_created(conversation_id, messages)
+        inbox_cache.invalidate_conversations([conversation_id])
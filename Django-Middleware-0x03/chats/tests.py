@@ -1,3 +1,1700 @@
-from django.test import TestCase
+import base64
+import gzip
+import json
+import multiprocessing
+import os
+import tempfile
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import (
+    activity, auth, content_filter, db_routers, fastpath, inbox_cache, logstats, membership, metrics, policy,
+    ratelimit, renderers, search, timing,
+)
+from .db_routers import PrimaryReplicaRouter, ReplicaRoutingMiddleware
+from .logwriter import BatchedLogWriter, get_writer
+from .middleware import (
+    AccessPolicyMiddleware,
+    OffensiveLanguageMiddleware,
+    RequestLoggingMiddleware,
+    RestrictAccessByTimeMiddleware,
+    RolepermissionMiddleware,
+)
+from .models import ArchivedMessage, Conversation, Message, User
+from .renderers import ORJSONRenderer
+from .serializers import ConversationSerializer, MessageSerializer
+
+
+# The custom chats middleware depends on wall-clock time and writes to
+# requests.log, so API tests run without it.
+API_TEST_MIDDLEWARE = [m for m in settings.MIDDLEWARE if not m.startswith("chats.")]
+
+
+@override_settings(MIDDLEWARE=API_TEST_MIDDLEWARE)
+class ChatsAPITestCase(TestCase):
+    """Shared fixtures for chats API tests."""
+
+    @classmethod
+    def make_user(cls, name):
+        return User.objects.create(
+            username=name,
+            email=f"{name}@example.com",
+            password_hash="x",
+        )
+
+    @classmethod
+    def make_conversation(cls, *users):
+        conversation = Conversation.objects.create()
+        conversation.participants.set(users)
+        return conversation
+
+    def setUp(self):
+        self.client = APIClient()
+        membership.invalidate_all()
+
+
+class MessageCursorPaginationTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.conversation = cls.make_conversation(cls.alice, cls.bob)
+        for i in range(7):
+            Message.objects.create(
+                sender=cls.alice, conversation=cls.conversation, message_body=f"m{i}"
+            )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def test_walks_history_newest_first_without_overlap(self):
+        url = "/api/messages/?page_size=3"
+        bodies = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn("count", response.data)
+            bodies += [row["message_body"] for row in response.data["results"]]
+            url = response.data["next"]
+        self.assertEqual(bodies, [f"m{i}" for i in reversed(range(7))])
+
+    def test_previous_link_returns_newer_page(self):
+        first = self.client.get("/api/messages/?page_size=3").data
+        second = self.client.get(first["next"]).data
+        back = self.client.get(second["previous"]).data
+        self.assertEqual(back["results"], first["results"])
+        self.assertIsNone(back["previous"])
+
+    def test_invalid_cursor_is_404(self):
+        response = self.client.get("/api/messages/?before=not-a-cursor")
+        self.assertEqual(response.status_code, 404)
+
+    def test_page_param_opts_into_counted_pages(self):
+        response = self.client.get("/api/messages/?page=1&page_size=5")
+        self.assertEqual(response.data["count"], 7)
+        self.assertEqual(response.data["total_pages"], 2)
+
+
+class ConversationInboxTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.quiet = cls.make_conversation(cls.alice, cls.bob)
+        cls.busy = cls.make_conversation(cls.alice, cls.bob)
+        for i in range(3):
+            cls.last = Message.objects.create(
+                sender=cls.bob, conversation=cls.busy, message_body=f"hi {i}"
+            )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def test_list_returns_preview_instead_of_history(self):
+        response = self.client.get("/api/conversations/")
+        busy, quiet = response.data["results"]
+        self.assertEqual(busy["id"], str(self.busy.id))
+        self.assertEqual(busy["message_count"], 3)
+        self.assertEqual(busy["last_message"]["id"], str(self.last.id))
+        self.assertEqual(busy["last_message"]["message_body"], "hi 2")
+        self.assertNotIn("messages", busy)
+        self.assertEqual(quiet["message_count"], 0)
+        self.assertIsNone(quiet["last_message"])
+
+    def test_history_subresource_is_cursor_paginated(self):
+        response = self.client.get(f"/api/conversations/{self.busy.id}/messages/?page_size=2")
+        self.assertEqual(
+            [row["message_body"] for row in response.data["results"]], ["hi 2", "hi 1"]
+        )
+        self.assertIsNotNone(response.data["next"])
+
+    def test_history_subresource_requires_participation(self):
+        self.client.force_authenticate(self.make_user("mallory"))
+        response = self.client.get(f"/api/conversations/{self.busy.id}/messages/")
+        self.assertEqual(response.status_code, 404)
+
+
+class QueryBudgetTests(ChatsAPITestCase):
+    """
+    Each endpoint must load its data in a fixed number of queries however
+    many rows it returns; an N+1 regression pushes it over budget.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        others = [cls.make_user(f"user{i}") for i in range(4)]
+        cls.conversations = []
+        for i in range(5):
+            conversation = cls.make_conversation(cls.alice, *others[: i % 4 + 1])
+            for j, sender in enumerate([cls.alice, *others]):
+                cls.message = Message.objects.create(
+                    sender=sender, conversation=conversation, message_body=f"{i}.{j}"
+                )
+            cls.conversations.append(conversation)
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def assertQueryBudget(self, budget, url):
+        with self.assertNumQueries(budget):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    # Lists also run the query for their validators (chats.conditional)
+
+    def test_message_list(self):
+        response = self.assertQueryBudget(2, "/api/messages/?page_size=50")
+        self.assertEqual(len(response.data["results"]), 25)
+
+    def test_message_list_counted_pages(self):
+        self.assertQueryBudget(3, "/api/messages/?page=1&page_size=50")
+
+    def test_message_retrieve(self):
+        self.assertQueryBudget(2, f"/api/messages/{self.message.id}/")
+
+    def test_conversation_list(self):
+        response = self.assertQueryBudget(4, "/api/conversations/")
+        self.assertEqual(len(response.data["results"]), 5)
+
+    def test_conversation_retrieve(self):
+        self.assertQueryBudget(3, f"/api/conversations/{self.conversations[-1].id}/")
+
+    def test_conversation_messages(self):
+        # The whole history fits on one page, so the archive is checked too
+        self.assertQueryBudget(5, f"/api/conversations/{self.conversations[-1].id}/messages/")
+
+
+class MembershipTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.conversation = cls.make_conversation(cls.alice)
+
+    def test_answers_are_cached_and_invalidated_on_change(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(membership.is_participant(self.bob, self.conversation.pk))
+            self.assertFalse(membership.is_participant(self.bob, self.conversation.pk))
+
+        self.conversation.participants.add(self.bob)
+        self.assertTrue(membership.is_participant(self.bob, self.conversation.pk))
+
+        self.bob.conversations.remove(self.conversation)
+        self.assertFalse(membership.is_participant(self.bob, self.conversation.pk))
+
+        self.conversation.participants.add(self.bob)
+        self.assertTrue(membership.is_participant(self.bob, self.conversation.pk))
+        self.conversation.participants.clear()
+        self.assertFalse(membership.is_participant(self.bob, self.conversation.pk))
+
+    def test_create_message_checks_membership(self):
+        self.client.force_authenticate(self.alice)
+        payload = {"conversation": str(self.conversation.pk), "message_body": "hello"}
+        response = self.client.post("/api/messages/", payload)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["sender"]["id"], str(self.alice.pk))
+
+        self.client.force_authenticate(self.bob)
+        response = self.client.post("/api/messages/", payload)
+        self.assertEqual(response.status_code, 403)
+
+
+class ConversationActivityTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.conversation = cls.make_conversation(cls.alice)
+
+    def send(self, body):
+        return Message.objects.create(
+            sender=self.alice, conversation=self.conversation, message_body=body
+        )
+
+    def assertActivity(self, count, last):
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, count)
+        self.assertEqual(self.conversation.last_message_id, last and last.pk)
+        self.assertEqual(self.conversation.last_message_at, last and last.sent_at)
+
+    def test_fields_follow_message_writes(self):
+        first = self.send("one")
+        second = self.send("two")
+        self.assertActivity(2, second)
+
+        second.delete()
+        self.assertActivity(1, first)
+        first.delete()
+        self.assertActivity(0, None)
+
+    def test_rebuild_command(self):
+        self.send("one")
+        last = self.send("two")
+        Conversation.objects.update(message_count=0, last_message_at=None, last_message_id=None)
+
+        call_command("rebuild_conversation_activity", batch_size=1, stdout=StringIO())
+        self.assertActivity(2, last)
+
+
+class BulkMessageIngestTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.first = cls.make_conversation(cls.alice)
+        cls.second = cls.make_conversation(cls.alice)
+        cls.foreign = cls.make_conversation(cls.make_user("bob"))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def test_batch_is_written_with_constant_queries(self):
+        batch = [
+            {"conversation": str(c.pk), "message_body": f"msg {i}"}
+            for i in range(50) for c in (self.first, self.second)
+        ]
+        # membership + savepoint + change numbers (UPDATE, SELECT) + INSERT +
+        # release, and per conversation one activity UPDATE (the inbox cache,
+        # which would look up participants, is off)
+        with self.assertNumQueries(8):
+            response = self.client.post("/api/messages/bulk/", batch, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["created"], 100)
+        self.first.refresh_from_db()
+        self.assertEqual(self.first.message_count, 50)
+        self.assertEqual(str(self.first.last_message_id), str(response.data["results"][-2]["id"]))
+
+    def test_per_item_results(self):
+        batch = {"messages": [
+            {"conversation": str(self.first.pk), "message_body": "ok"},
+            {"conversation": str(self.first.pk)},
+            {"conversation": str(self.foreign.pk), "message_body": "nope"},
+        ]}
+        response = self.client.post("/api/messages/bulk/", batch, format="json")
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([r["status"] for r in response.data["results"]], [201, 400, 403])
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_rejects_oversized_batch(self):
+        batch = [{"conversation": str(self.first.pk), "message_body": "x"}] * 2
+        with self.settings(CHATS_BULK_MESSAGE_LIMIT=1):
+            response = self.client.post("/api/messages/bulk/", batch, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class ConversationExportTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.conversation = cls.make_conversation(cls.alice)
+        for body in ("first", "second ☃"):
+            Message.objects.create(sender=cls.alice, conversation=cls.conversation, message_body=body)
+
+    def test_streams_ndjson_oldest_first(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get(f"/api/conversations/{self.conversation.pk}/export/")
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).decode().splitlines()
+        rows = [json.loads(line) for line in lines]
+        self.assertEqual([r["message_body"] for r in rows], ["first", "second ☃"])
+        self.assertEqual(rows[0]["sender_email"], "alice@example.com")
+
+    def test_management_command(self):
+        out = StringIO()
+        call_command("export_conversation", str(self.conversation.pk), stdout=out)
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+
+class MessageSearchTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        mine = cls.make_conversation(cls.alice, cls.bob)
+        theirs = cls.make_conversation(cls.bob)
+        for body in ("lunch at noon?", "the lunch place is closed", "see you tomorrow"):
+            Message.objects.create(sender=cls.bob, conversation=mine, message_body=body)
+        Message.objects.create(sender=cls.bob, conversation=theirs, message_body="secret lunch")
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def search(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_finds_only_own_conversations_with_snippets(self):
+        data = self.search("/api/messages/search/?q=lunch")
+        bodies = {row["message_body"] for row in data["results"]}
+        self.assertEqual(bodies, {"lunch at noon?", "the lunch place is closed"})
+        self.assertIn("<mark>lunch</mark>", data["results"][0]["snippet"])
+
+    def test_cursor_pagination(self):
+        first = self.search("/api/messages/search/?q=lunch&page_size=1")
+        second = self.search(first["next"])
+        self.assertIsNone(second["next"])
+        self.assertNotEqual(first["results"][0]["id"], second["results"][0]["id"])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = Message.objects.get(message_body="see you tomorrow")
+        message.message_body = "see you at lunch"
+        message.save()
+        self.assertEqual(len(self.search("/api/messages/search/?q=lunch")["results"]), 3)
+        message.delete()
+        self.assertEqual(len(self.search("/api/messages/search/?q=lunch")["results"]), 2)
+
+    def test_query_syntax_is_not_interpreted(self):
+        data = self.search('/api/messages/search/?q=lunch" OR "secret')
+        self.assertEqual(data["results"], [])
+
+    def test_snippets_escape_the_message_text(self):
+        conversation = self.alice.conversations.first()
+        Message.objects.create(sender=self.bob, conversation=conversation,
+                               message_body="<img src=x onerror=alert(1)> lunch")
+        for hits in (search.search_messages(self.alice, "onerror", 10),
+                     search._search_substring(self.alice, "ONERROR", 10, None)):
+            with self.subTest(snippet=hits[0][2]):
+                self.assertNotIn("<img", hits[0][2])
+                self.assertIn("&lt;img src=x <mark>onerror</mark>=alert(1)&gt;", hits[0][2])
+
+
+SHARED_CACHES = {
+    **settings.CACHES,
+    "shared": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.path.join(tempfile.gettempdir(), f"chats-tests-{os.getpid()}"),
+    },
+}
+
+
+@override_settings(CHATS_READ_REPLICAS=["replica"], CHATS_REPLICA_STICKY_SECONDS=60)
+class ReplicaRoutingTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.router = PrimaryReplicaRouter()
+
+    def run_request(self, method, write=False):
+        """
+        Run a request through the middleware and report where reads went.
+        The factory keeps the cookies it is given, like a browser.
+        """
+        seen = {}
+
+        def view(request):
+            seen["read"] = self.router.db_for_read(Message)
+            if write:
+                self.router.db_for_write(Message)
+            return HttpResponse()
+
+        request = getattr(self.factory, method)("/api/messages/", HTTP_AUTHORIZATION="Bearer abc")
+        request.user = AnonymousUser()
+        response = ReplicaRoutingMiddleware(view)(request)
+        self.factory.cookies.update(response.cookies)
+        return seen["read"]
+
+    def test_safe_reads_use_replica(self):
+        self.assertEqual(self.run_request("get"), "replica")
+        self.assertEqual(self.router.db_for_read(Message), "default")  # outside a request
+
+    def test_unsafe_methods_read_primary(self):
+        self.assertEqual(self.run_request("post"), "default")
+
+    def test_reads_stick_to_primary_after_a_write(self):
+        self.run_request("post", write=True)
+        self.assertEqual(self.run_request("get"), "default")
+        self.factory.cookies.clear()  # the per-process cache is not used
+        self.assertEqual(self.run_request("get"), "replica")
+
+    def test_forged_sticky_cookie_is_ignored(self):
+        self.factory.cookies[db_routers.STICKY_COOKIE] = "1"
+        self.assertEqual(self.run_request("get"), "replica")
+
+    @override_settings(CACHES=SHARED_CACHES, CHATS_REPLICA_STICKY_CACHE="shared")
+    def test_shared_cache_remembers_clients_without_cookies(self):
+        caches["shared"].clear()
+        self.run_request("post", write=True)
+        self.factory.cookies.clear()
+        self.assertEqual(self.run_request("get"), "default")
+        caches["shared"].clear()
+        self.assertEqual(self.run_request("get"), "replica")
+
+    @override_settings(CHATS_READ_REPLICAS=[])
+    def test_not_loaded_without_replicas(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            ReplicaRoutingMiddleware(lambda request: HttpResponse())
+
+    def test_writes_go_to_primary(self):
+        self.assertEqual(self.router.db_for_write(Message), "default")
+        self.assertFalse(self.router.allow_migrate("replica", "chats"))
+
+
+class MessageArchiveTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.conversation = cls.make_conversation(cls.alice)
+        for i in range(5):
+            Message.objects.create(
+                sender=cls.alice, conversation=cls.conversation, message_body=f"m{i}"
+            )
+        # The three oldest messages are a year old
+        for days, body in ((400, "m0"), (390, "m1"), (380, "m2")):
+            Message.objects.filter(message_body=body).update(
+                sent_at=timezone.now() - timedelta(days=days)
+            )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def archive(self):
+        call_command("archive_messages", older_than_days=180, batch_size=2, stdout=StringIO())
+
+    def test_moves_old_messages_and_keeps_activity(self):
+        self.archive()
+        self.assertEqual(
+            sorted(Message.objects.values_list("message_body", flat=True)), ["m3", "m4"]
+        )
+        self.assertEqual(ArchivedMessage.objects.count(), 3)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 5)
+
+    def test_history_reads_fall_through_to_archive(self):
+        self.archive()
+        url = f"/api/conversations/{self.conversation.pk}/messages/?page_size=2"
+        pages = []
+        while url:
+            data = self.client.get(url).data
+            pages.append(data)
+            url = data["next"]
+        bodies = [row["message_body"] for page in pages for row in page["results"]]
+        self.assertEqual(bodies, ["m4", "m3", "m2", "m1", "m0"])
+        self.assertEqual(pages[-1]["results"][0]["sender"]["id"], str(self.alice.pk))
+
+        # Walking back from the oldest page crosses into the hot table again
+        back = self.client.get(pages[-1]["previous"]).data
+        self.assertEqual([row["message_body"] for row in back["results"]], ["m2", "m1"])
+        back = self.client.get(back["previous"]).data
+        self.assertEqual([row["message_body"] for row in back["results"]], ["m4", "m3"])
+
+    def test_walking_newer_covers_messages_archived_before_the_cutoff(self):
+        for days, body in ((90, "m0"), (60, "m1"), (45, "m2"), (10, "m3"), (5, "m4")):
+            Message.objects.filter(message_body=body).update(
+                sent_at=timezone.now() - timedelta(days=days)
+            )
+        # Younger than CHATS_ARCHIVE_AFTER_DAYS, archived all the same
+        call_command("archive_messages", older_than_days=30, stdout=StringIO())
+        self.assertEqual(ArchivedMessage.objects.count(), 3)
+
+        url = f"/api/conversations/{self.conversation.pk}/messages/?page_size=2"
+        while url:
+            data = self.client.get(url).data
+            url = data["next"]
+        bodies = [row["message_body"] for row in data["results"]]
+        while data["previous"]:
+            data = self.client.get(data["previous"]).data
+            bodies = [row["message_body"] for row in data["results"]] + bodies
+        self.assertEqual(bodies, ["m4", "m3", "m2", "m1", "m0"])
+
+    def test_archived_latest_message_keeps_the_inbox_preview(self):
+        quiet = self.make_conversation(self.alice)
+        Message.objects.create(sender=self.alice, conversation=quiet, message_body="old news")
+        Message.objects.filter(conversation=quiet).update(sent_at=timezone.now() - timedelta(days=365))
+        activity.rebuild([quiet.pk])
+        self.archive()
+        self.assertFalse(Message.objects.filter(conversation=quiet).exists())
+
+        inbox = {row["id"]: row for row in self.client.get("/api/conversations/").data["results"]}
+        preview = inbox[str(quiet.pk)]["last_message"]
+        self.assertEqual(preview["message_body"], "old news")
+        self.assertEqual(preview["sender"], str(self.alice.pk))
+        self.assertEqual(inbox[str(quiet.pk)]["message_count"], 1)
+
+        # Rebuilding agrees with what archiving left
+        activity.rebuild([quiet.pk, self.conversation.pk])
+        self.conversation.refresh_from_db()
+        quiet.refresh_from_db()
+        self.assertEqual((quiet.message_count, quiet.last_message_body), (1, "old news"))
+        self.assertEqual((self.conversation.message_count, self.conversation.last_message_body), (5, "m4"))
+
+        # Deleting the hot messages points back into the archive
+        for body in ("m4", "m3"):
+            Message.objects.get(message_body=body).delete()
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.last_message_body), (3, "m2"))
+
+    def test_export_includes_archived_messages(self):
+        self.archive()
+        response = self.client.get(f"/api/conversations/{self.conversation.pk}/export/")
+        lines = [json.loads(line) for line in b"".join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([line["message_body"] for line in lines], ["m0", "m1", "m2", "m3", "m4"])
+        self.assertEqual({line["sender_email"] for line in lines}, {"alice@example.com"})
+
+
+class BatchedLogWriterTests(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.path = os.path.join(self.tmp.name, "requests.log")
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_close_flushes_pending_lines(self):
+        writer = BatchedLogWriter(self.path, batch_size=1000, flush_interval=60)
+        for i in range(3):
+            writer.write(f"line {i}\n")
+        writer.close()
+        self.assertEqual(self.read(self.path), "line 0\nline 1\nline 2\n")
+
+    def test_rotates_by_size(self):
+        writer = BatchedLogWriter(self.path, batch_size=1, max_bytes=10, backup_count=2)
+        for i in range(4):
+            writer.write(f"0123456789 {i}\n")
+        writer.close()
+        self.assertEqual(self.read(self.path + ".1"), "0123456789 3\n")
+        self.assertEqual(self.read(self.path + ".2"), "0123456789 2\n")
+        self.assertFalse(os.path.exists(self.path + ".3"))
+
+
+class StructuredAccessLogTests(ChatsAPITestCase):
+
+    def test_json_lines_record_status_timing_and_queries(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "requests.log")
+        alice = self.make_user("alice")
+        self.client.force_authenticate(alice)
+
+        middleware = API_TEST_MIDDLEWARE + ["chats.middleware.RequestLoggingMiddleware"]
+        with self.settings(MIDDLEWARE=middleware, CHATS_REQUEST_LOG={"PATH": path, "FORMAT": "json"}):
+            self.client.get("/api/conversations/")
+        get_writer(path).close()
+
+        with open(path) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record["method"], "GET")
+        self.assertEqual(record["path"], "/api/conversations/")
+        self.assertEqual(record["route"], "conversations-list")
+        self.assertEqual(record["status"], 200)
+        self.assertGreater(record["db_queries"], 0)
+        self.assertGreater(record["response_bytes"], 0)
+        self.assertEqual(record["user"], str(alice.pk))
+
+
+class RateLimitTests(TestCase):
+
+    def hit_many(self, backend, algorithm, times, now, rate="5/m"):
+        limit, window = ratelimit.parse_rate(rate)
+        return [backend.hit("k", algorithm, limit, window, now=now).allowed for _ in range(times)]
+
+    def test_parse_rate(self):
+        self.assertEqual(ratelimit.parse_rate("5/m"), (5, 60))
+        self.assertEqual(ratelimit.parse_rate("10/30s"), (10, 30))
+        with self.assertRaises(ValueError):
+            ratelimit.parse_rate("5/fortnight")
+
+    def test_sliding_window_weighs_previous_window(self):
+        backend = ratelimit.InProcessBackend()
+        self.assertEqual(self.hit_many(backend, "sliding-window", 6, now=60.0), [True] * 5 + [False])
+        # Half-way through the next window, half of the previous 5 still count
+        self.assertEqual(self.hit_many(backend, "sliding-window", 3, now=150.0), [True, True, False])
+
+    def test_token_bucket_refills(self):
+        backend = ratelimit.InProcessBackend()
+        self.assertEqual(self.hit_many(backend, "token-bucket", 6, now=0.0), [True] * 5 + [False])
+        self.assertEqual(self.hit_many(backend, "token-bucket", 2, now=12.0), [True, False])
+
+    def test_in_process_backend_evicts_idle_and_excess_keys(self):
+        backend = ratelimit.InProcessBackend(max_keys=2, idle_timeout=10)
+        for i, key in enumerate("abc"):
+            backend.hit(key, "token-bucket", 5, 60, now=float(i))
+        self.assertEqual(len(backend), 2)
+        backend.hit("d", "token-bucket", 5, 60, now=100.0)
+        self.assertEqual(len(backend), 1)
+
+    def test_sqlite_backend_is_shared_between_instances(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "ratelimit.sqlite3")
+        worker_a = ratelimit.SQLiteBackend(path)
+        worker_b = ratelimit.SQLiteBackend(path)
+        self.assertEqual(self.hit_many(worker_a, "sliding-window", 3, now=60.0), [True] * 3)
+        self.assertEqual(self.hit_many(worker_b, "sliding-window", 3, now=61.0), [True, True, False])
+
+    @override_settings(CHATS_RATE_LIMITS=[{
+        "name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "2/m",
+        "user_rates": {"admin": None},
+    }], CHATS_RATE_LIMIT_BACKEND={})
+    def test_middleware_limits_per_user_and_exempts_roles(self):
+        ratelimit.reset_backend()
+        self.addCleanup(ratelimit.reset_backend)
+        middleware = OffensiveLanguageMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+
+        def post(user):
+            request = factory.post("/api/messages/")
+            request.user = user
+            return middleware(request).status_code
+
+        guest = User(pk=uuid.uuid4(), role="guest")
+        admin = User(pk=uuid.uuid4(), role="admin")
+        self.assertEqual([post(guest) for _ in range(3)], [200, 200, 429])
+        self.assertEqual([post(admin) for _ in range(3)], [200, 200, 200])
+        response = middleware(factory.get("/api/messages/"))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(CHATS_RATE_LIMITS=[{
+        "name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "2/m",
+    }], CHATS_RATE_LIMIT_BACKEND={})
+    def test_unresolved_tokens_share_the_ip_limit(self):
+        ratelimit.reset_backend()
+        self.addCleanup(ratelimit.reset_backend)
+        middleware = OffensiveLanguageMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+
+        def post(i):
+            request = factory.post("/api/messages/", HTTP_AUTHORIZATION=f"Bearer junk-{i}")
+            request.user = AnonymousUser()
+            return middleware(request).status_code
+
+        self.assertEqual([post(i) for i in range(3)], [200, 200, 429])
+
+
+class AsyncMiddlewareTests(TestCase):
+    """Under ASGI the chats middleware runs on the event loop, without thread hops."""
+
+    @staticmethod
+    async def ok(request):
+        await sync_to_async(User.objects.count)()
+        return HttpResponse(b"ok")
+
+    @staticmethod
+    def request(method, path, user):
+        request = getattr(RequestFactory(), method)(path)
+
+        async def auser():
+            return user
+
+        request.auser = auser
+        return request
+
+    @override_settings(CHATS_READ_REPLICAS=["replica"])
+    def test_mode_follows_the_rest_of_the_chain(self):
+        classes = [
+            ReplicaRoutingMiddleware,
+            RequestLoggingMiddleware,
+            RestrictAccessByTimeMiddleware,
+            OffensiveLanguageMiddleware,
+            RolepermissionMiddleware,
+        ]
+        for middleware_class in classes:
+            with self.subTest(middleware_class.__name__):
+                self.assertTrue(middleware_class.async_capable)
+                self.assertTrue(iscoroutinefunction(middleware_class(self.ok)))
+                self.assertFalse(iscoroutinefunction(middleware_class(lambda request: HttpResponse())))
+
+    @override_settings(CHATS_RATE_LIMIT_BACKEND={})
+    def test_time_middleware_is_an_hours_rule(self):
+        ratelimit.reset_backend()
+        self.addCleanup(ratelimit.reset_backend)
+        middleware = RestrictAccessByTimeMiddleware(lambda request: HttpResponse())
+        for hour, status in ((5, 403), (6, 200), (20, 200), (21, 403)):
+            with self.subTest(hour=hour), mock.patch("chats.policy.datetime") as clock:
+                clock.now.return_value = timezone.datetime(2026, 1, 1, hour, 0)
+                response = middleware(RequestFactory().get("/api/conversations/"))
+                self.assertEqual(response.status_code, status)
+
+    async def test_role_middleware_resolves_the_user_asynchronously(self):
+        middleware = RolepermissionMiddleware(self.ok)
+        response = await middleware(self.request("get", "/api/protected/", AnonymousUser()))
+        self.assertEqual(response.status_code, 401)
+        guest = User(pk=uuid.uuid4(), role="guest")
+        response = await middleware(self.request("get", "/api/protected/", guest))
+        self.assertEqual(response.status_code, 403)
+        moderator = User(pk=uuid.uuid4(), role="moderator")
+        response = await middleware(self.request("get", "/api/protected/", moderator))
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(CHATS_RATE_LIMITS=[{
+        "name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "2/m",
+    }])
+    async def test_rate_limit_with_in_process_and_blocking_backends(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.addCleanup(ratelimit.reset_backend)
+        backends = [
+            {},
+            {"BACKEND": "chats.ratelimit.SQLiteBackend",
+             "OPTIONS": {"path": os.path.join(tmp.name, "ratelimit.sqlite3")}},
+        ]
+        for backend in backends:
+            with self.subTest(backend.get("BACKEND")), self.settings(CHATS_RATE_LIMIT_BACKEND=backend):
+                ratelimit.reset_backend()
+                middleware = OffensiveLanguageMiddleware(self.ok)
+                user = User(pk=uuid.uuid4(), role="guest")
+                statuses = [
+                    (await middleware(self.request("post", "/api/messages/", user))).status_code
+                    for _ in range(3)
+                ]
+                self.assertEqual(statuses, [200, 200, 429])
+
+    async def test_structured_log_counts_queries_of_sync_code(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "requests.log")
+        with self.settings(CHATS_REQUEST_LOG={"PATH": path, "FORMAT": "json"}):
+            middleware = RequestLoggingMiddleware(self.ok)
+        await middleware(self.request("get", "/api/conversations/", AnonymousUser()))
+        await sync_to_async(get_writer(path).close)()
+
+        with open(path) as f:
+            record = json.loads(f.readline())
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["db_queries"], 1)
+        self.assertEqual(record["response_bytes"], 2)
+        self.assertIsNone(record["user"])
+
+
+@override_settings(CHATS_ACCESS_POLICY={"RULES": []}, CHATS_RATE_LIMITS=[], CHATS_RATE_LIMIT_BACKEND={})
+class AccessPolicyTests(TestCase):
+
+    def setUp(self):
+        ratelimit.reset_backend()
+        self.addCleanup(ratelimit.reset_backend)
+        self.factory = RequestFactory()
+
+    def get(self, path, user, method="get"):
+        middleware = AccessPolicyMiddleware(lambda request: HttpResponse())
+        request = getattr(self.factory, method)(path)
+        request.user = user
+        return middleware(request)
+
+    def test_lookup_returns_only_rules_on_the_path(self):
+        compiled = policy.Policy.from_config(
+            [
+                {"path": "/", "hours": "06:00-21:00"},
+                {"path": "/api/", "authenticated": True},
+                {"path": "/api/messages/", "methods": ["POST"], "roles": ["admin"]},
+            ],
+            [{"name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "5/m"}],
+        )
+        match = compiled.match("GET", "/api/messages/1/")
+        self.assertEqual([rule.path for rule in match.rules], ["/", "/api/"])
+        self.assertEqual(match.limits, [])
+        match = compiled.match("POST", "/api/messages/")
+        self.assertEqual([rule.path for rule in match.rules], ["/", "/api/", "/api/messages/"])
+        self.assertEqual([limit.name for limit in match.limits], ["send"])
+        match = compiled.match("GET", "/apix/")
+        self.assertEqual([rule.path for rule in match.rules], ["/"])
+        self.assertFalse(match.needs_user)
+
+    def test_hours_may_wrap_midnight(self):
+        rule = policy.Rule("/", hours="22:00-06:00")
+        self.assertTrue(rule.open_at(23 * 60))
+        self.assertTrue(rule.open_at(5 * 60 + 59))
+        self.assertFalse(rule.open_at(6 * 60))
+
+    @override_settings(CHATS_ACCESS_POLICY={"RULES": [
+        {"path": "/", "hours": "06:00-21:00", "message": "Closed."},
+    ]})
+    def test_time_window(self):
+        with mock.patch("chats.policy.datetime") as clock:
+            clock.now.return_value = timezone.datetime(2026, 1, 1, 22, 30)
+            response = self.get("/api/conversations/", AnonymousUser())
+        self.assertEqual((response.status_code, response.content), (403, b"Closed."))
+        with mock.patch("chats.policy.datetime") as clock:
+            clock.now.return_value = timezone.datetime(2026, 1, 1, 12, 0)
+            self.assertEqual(self.get("/api/conversations/", AnonymousUser()).status_code, 200)
+
+    @override_settings(CHATS_ACCESS_POLICY={"RULES": [
+        {"path": "/api/protected/", "roles": ["admin", "moderator"]},
+    ]})
+    def test_roles_and_user_only_resolved_when_needed(self):
+        self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 401)
+        self.assertEqual(self.get("/api/protected/", User(role="guest")).status_code, 403)
+        self.assertEqual(self.get("/api/protected/x/", User(role="admin")).status_code, 200)
+
+        def fail():
+            raise AssertionError("request.user evaluated")
+
+        self.assertEqual(self.get("/api/conversations/", SimpleLazyObject(fail)).status_code, 200)
+
+    @override_settings(CHATS_RATE_LIMITS=[{
+        "name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "2/m",
+    }])
+    def test_rate_limits(self):
+        guest = User(pk=uuid.uuid4(), role="guest")
+        statuses = [self.get("/api/messages/", guest, method="post").status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.get("/api/messages/", guest).status_code, 200)
+
+    def test_reloads_when_the_policy_file_changes(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "policy.json")
+
+        def write(rules, mtime):
+            with open(path, "w") as f:
+                json.dump({"RULES": rules}, f)
+            os.utime(path, (mtime, mtime))
+
+        write([], mtime=1000)
+        with self.settings(CHATS_ACCESS_POLICY={"FILE": path, "CHECK_INTERVAL": 0}):
+            self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 200)
+            write([{"path": "/api/protected/", "authenticated": True}], mtime=2000)
+            self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 401)
+            # A broken edit keeps the last good policy
+            with open(path, "w") as f:
+                f.write("{")
+            os.utime(path, (3000, 3000))
+            with self.assertLogs("chats.policy", "ERROR"):
+                self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 401)
+            # ... and is only tried once
+            with self.assertNoLogs("chats.policy", "ERROR"):
+                self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 401)
+            write([], mtime=4000)
+            self.assertEqual(self.get("/api/protected/", AnonymousUser()).status_code, 200)
+
+    def test_reload_may_switch_the_rate_limit_algorithm(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "policy.json")
+
+        def write(algorithm, mtime):
+            with open(path, "w") as f:
+                json.dump({"RATE_LIMITS": [{
+                    "name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "2/m",
+                    "algorithm": algorithm,
+                }]}, f)
+            os.utime(path, (mtime, mtime))
+
+        guest = User(pk=uuid.uuid4(), role="guest")
+        write("sliding-window", mtime=1000)
+        with self.settings(CHATS_ACCESS_POLICY={"FILE": path, "CHECK_INTERVAL": 0}):
+            self.assertEqual(self.get("/api/messages/", guest, method="post").status_code, 200)
+            write("token-bucket", mtime=2000)
+            statuses = [self.get("/api/messages/", guest, method="post").status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+
+
+# Revocations must reach every worker: a cache shared between processes
+@override_settings(CACHES=SHARED_CACHES, CHATS_JWT_CLAIMS={"REVOCATION_CACHE": "shared"})
+class TokenClaimsTests(ChatsAPITestCase):
+
+    def setUp(self):
+        super().setUp()
+        caches["shared"].clear()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            username="alice", email="alice@example.com", password="pw", password_hash="x",
+            role="moderator",
+        )
+        cls.bob = cls.make_user("bob")
+        cls.conversation = cls.make_conversation(cls.alice, cls.bob)
+
+    def token(self, **claims):
+        access = auth.get_tokens_for_user(self.alice)["access"]
+        token = auth.AccessToken(access)
+        for name, value in claims.items():
+            token[name] = value
+        return str(token)
+
+    def test_token_endpoints_carry_role_and_conversation_claims(self):
+        response = self.client.post(
+            "/api/token/", {"email": "alice@example.com", "password": "pw"}, format="json"
+        )
+        access = auth.AccessToken(response.data["access"])
+        self.assertEqual(access["role"], "moderator")
+        self.assertEqual(access["conversations"], [str(self.conversation.pk)])
+
+        User.objects.filter(pk=self.alice.pk).update(role="admin")
+        response = self.client.post(
+            "/api/token/refresh/", {"refresh": response.data["refresh"]}, format="json"
+        )
+        self.assertEqual(auth.AccessToken(response.data["access"])["role"], "admin")
+
+    def test_api_authenticates_from_claims_without_loading_the_user(self):
+        url = f"/api/conversations/{self.conversation.pk}/messages/"
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token()}")
+        # Validators, conversation, membership, messages page and archive
+        # fall-through; no user query
+        with self.assertNumQueries(5):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_outdated_claims_reload_the_user(self):
+        url = f"/api/conversations/{self.conversation.pk}/messages/"
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token()}")
+        with self.settings(CHATS_JWT_CLAIMS={"VERSION": 2, "REVOCATION_CACHE": "shared"}):
+            # + user row
+            with self.assertNumQueries(6):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_unshared_revocation_cache_reloads_the_user(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token()}")
+        with self.settings(CHATS_JWT_CLAIMS={"REVOCATION_CACHE": "default"}):
+            with self.assertNumQueries(6):
+                self.client.get(f"/api/conversations/{self.conversation.pk}/messages/")
+
+    def test_conversation_claim_only_denies(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token()}")
+        other = self.make_conversation(self.alice, self.bob)  # not in the token
+        post = lambda conversation: self.client.post(
+            "/api/messages/", {"conversation": str(conversation.pk), "message_body": "hi"}
+        )
+        self.assertEqual(post(other).status_code, 403)
+        self.assertEqual(post(self.conversation).status_code, 201)
+
+        self.conversation.participants.remove(self.alice)
+        self.assertEqual(post(self.conversation).status_code, 403)
+
+    def test_deactivated_user_is_rejected_at_once(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f"Bearer {self.token()}")
+        self.assertEqual(self.client.get("/api/conversations/").status_code, 200)
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.client.get("/api/conversations/").status_code, 401)
+
+    @override_settings(
+        CHATS_ACCESS_POLICY={"RULES": [{"path": "/api/protected/", "roles": ["admin", "moderator"]}]},
+        CHATS_RATE_LIMITS=[],
+    )
+    def test_middleware_reads_the_role_from_the_token(self):
+        middleware = AccessPolicyMiddleware(lambda request: HttpResponse())
+        factory = RequestFactory()
+
+        def get(token):
+            request = factory.get("/api/protected/", HTTP_AUTHORIZATION=f"Bearer {token}")
+            request.user = AnonymousUser()
+            return middleware(request).status_code
+
+        moderator, guest = self.token(), self.token(role="guest")
+        with self.assertNumQueries(0):
+            self.assertEqual(get(moderator), 200)
+            self.assertEqual(get(guest), 403)
+            self.assertEqual(get("not-a-token"), 401)
+
+
+@override_settings(CHATS_CONTENT_FILTER={"TERMS": [], "WORDLIST": None})
+class ContentFilterTests(ChatsAPITestCase):
+
+    TERMS = [("darn", "mask"), ("heck", "flag"), ("very bad words", "block"), ("bad words here", "mask")]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.conversation = cls.make_conversation(cls.alice, cls.make_user("bob"))
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def scan(self, text):
+        return content_filter.ContentFilter(self.TERMS).scan(text)
+
+    def test_matches_whole_words_and_phrases(self):
+        self.assertEqual(self.scan("Darn it, DARN!").text, "**** it, ****!")
+        self.assertEqual(self.scan("darned darnit").action, None)
+        # Phrase found after a failed partial match of an overlapping one
+        verdict = self.scan("such very bad words here")
+        self.assertEqual(verdict.action, "block")
+        self.assertEqual(verdict.terms, ["very bad words", "bad words here"])
+        self.assertEqual(self.scan("quite bad words here").text, "quite *** ***** ****")
+
+    def test_strongest_action_wins(self):
+        verdict = self.scan("darn, the heck")
+        self.assertEqual((verdict.action, verdict.text), ("mask", "****, the heck"))
+        self.assertEqual(self.scan("heck").action, "flag")
+
+    def test_message_create_blocks_masks_and_flags(self):
+        url = "/api/messages/"
+        with self.settings(CHATS_CONTENT_FILTER={"TERMS": ["darn"], "WORDLIST": None}):
+            response = self.client.post(
+                url, {"conversation": str(self.conversation.pk), "message_body": "darn it"}, format="json"
+            )
+        self.assertEqual(response.data["message_body"], "**** it")
+
+        settings_ = {"TERMS": ["heck"], "ACTION": "flag", "WORDLIST": None}
+        with self.settings(CHATS_CONTENT_FILTER=settings_):
+            response = self.client.post(
+                url, {"conversation": str(self.conversation.pk), "message_body": "heck"}, format="json"
+            )
+        self.assertEqual(response.status_code, 201)
+        flagged = self.client.get(url + "?flagged=true")
+        self.assertEqual([m["message_body"] for m in flagged.data["results"]], ["heck"])
+
+        settings_ = {"TERMS": ["heck"], "ACTION": "block", "WORDLIST": None}
+        with self.settings(CHATS_CONTENT_FILTER=settings_):
+            response = self.client.post(
+                url, {"conversation": str(self.conversation.pk), "message_body": "Heck"}, format="json"
+            )
+            self.assertEqual(response.status_code, 400)
+            batch = [{"conversation": str(self.conversation.pk), "message_body": body} for body in ("hi", "heck")]
+            response = self.client.post(url + "bulk/", batch, format="json")
+        self.assertEqual([r["status"] for r in response.data["results"]], [201, 400])
+        self.assertEqual(Message.objects.count(), 3)
+
+    def test_word_list_sections_and_reload(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, "words.txt")
+
+        def write(text, mtime):
+            with open(path, "w") as f:
+                f.write(text)
+            os.utime(path, (mtime, mtime))
+
+        write("# mild\ndarn\n[block]\nheck\n", mtime=1000)
+        with self.settings(CHATS_CONTENT_FILTER={"WORDLIST": path, "CHECK_INTERVAL": 0}):
+            self.assertEqual(content_filter.scan("darn heck").action, "block")
+            self.assertEqual(content_filter.scan("darn").text, "****")
+            write("[flag]\ndarn\n", mtime=2000)
+            self.assertEqual(content_filter.scan("darn heck").action, "flag")
+            write("[nonsense]\n", mtime=3000)
+            with self.assertLogs("chats.content_filter", "ERROR"):
+                self.assertEqual(content_filter.scan("darn").action, "flag")
+
+
+TIMING_MIDDLEWARE = ["chats.timing.ServerTimingMiddleware"] + API_TEST_MIDDLEWARE
+
+
+@override_settings(MIDDLEWARE=TIMING_MIDDLEWARE, CHATS_TIMING={"ENABLED": True})
+class ServerTimingTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.admin = User.objects.create(
+            username="root", email="root@example.com", password_hash="x", role="admin"
+        )
+        cls.conversation = cls.make_conversation(cls.alice, cls.make_user("bob"))
+        Message.objects.create(sender=cls.alice, conversation=cls.conversation, message_body="hi")
+
+    def setUp(self):
+        super().setUp()
+        timing.reset()
+        self.addCleanup(timing.reset)
+
+    def metrics(self, response):
+        return dict(
+            metric.split(";", 1) for metric in response["Server-Timing"].split(", ")
+        )
+
+    def test_header_breaks_the_request_down_by_stage(self):
+        self.client.force_authenticate(self.alice)
+        response = self.client.get("/api/messages/")
+        self.assertEqual(response.status_code, 200)
+        metrics = self.metrics(response)
+        for name in ("total", "SessionMiddleware", "AuthenticationMiddleware", "view",
+                     "auth", "perm", "serialize", "render"):
+            self.assertIn(name, metrics)
+        self.assertRegex(metrics["db"], r'^desc="\d+ queries";dur=[\d.]+$')
+        self.assertEqual(timing.stats()["total"]["count"], 1)
+
+    def test_disabled_middleware_is_not_loaded(self):
+        with self.settings(CHATS_TIMING={"ENABLED": False}):
+            client = APIClient()
+            client.force_authenticate(self.alice)
+            response = client.get("/api/messages/")
+        self.assertNotIn("Server-Timing", response)
+        self.assertEqual(timing.stats(), {})
+
+    def test_stats_endpoint_is_for_admins(self):
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.client.get("/api/internal/timing/").status_code, 403)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get("/api/internal/timing/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["stages"]["total"]["count"], 1)
+
+    def test_rolling_histogram(self):
+        histogram = timing.RollingHistogram([1, 10, 100], window=60, slots=6)
+        for ms in (0.5, 5, 5, 50):
+            histogram.observe(ms, now=100)
+        snapshot = histogram.snapshot(now=100)
+        self.assertEqual(snapshot["count"], 4)
+        self.assertEqual(snapshot["buckets"], {"1": 1, "10": 2, "100": 1, "+Inf": 0})
+        self.assertEqual(snapshot["p50_ms"], 5.5)
+        histogram.observe(500, now=130)
+        self.assertEqual(histogram.snapshot(now=159)["count"], 5)
+        # The slot of t=100 has left the window, the one of t=130 has not
+        self.assertEqual(histogram.snapshot(now=165)["count"], 1)
+        self.assertEqual(histogram.snapshot(now=165)["p99_ms"], 100)
+
+
+class AnalyzeRequestsLogTests(TestCase):
+
+    CONVERSATION = "0b9c3a4e-5f6d-4e7f-8a9b-0c1d2e3f4a5b"
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "requests.log")
+        text = [
+            "2026-01-31 14:05:09.123456 - User: alice@example.com - Path: /api/messages/\n",
+            f"2026-01-31 14:59:00.000001 - User: Anonymous - Path: /api/conversations/{self.CONVERSATION}/messages/\n",
+            "2026-01-31 15:00:00.5 - request log dropped 7 records (queue full)\n",
+        ]
+        records = [
+            {"time": "2026-01-31T15:10:00", "method": "GET", "path": "/api/messages/", "route": "messages-list",
+             "status": 200, "duration_ms": ms, "db_queries": 2, "db_time_ms": 0.5,
+             "response_bytes": 10, "user": "u1"}
+            for ms in (1.0, 2.0, 3.0, 4.0, 100.0)
+        ]
+        records.append(dict(records[0], path='/api/"quoted"/', route=None, status=404, user=None))
+        with open(self.path, "w") as f:
+            f.writelines(text)
+            f.writelines(json.dumps(r, separators=(",", ":")) + "\n" for r in records)
+        with gzip.open(self.path + ".1.gz", "wt") as f:
+            f.writelines(text[:1] * 3)
+
+    def report(self, *args):
+        out = StringIO()
+        call_command("analyze_requests_log", *args, "--json", "--jobs", "1", stdout=out)
+        return json.loads(out.getvalue())
+
+    def test_reads_both_formats_and_rotations(self):
+        with self.settings(CHATS_REQUEST_LOG={"PATH": self.path}):
+            report = self.report()
+        self.assertEqual(len(report["files"]), 2)
+        self.assertEqual((report["requests"], report["unparsed_lines"], report["dropped_records"]), (11, 1, 7))
+        self.assertEqual(dict(report["paths"]["top"]), {
+            "/api/messages/": 9,
+            "/api/conversations/{id}/messages/": 1,
+            '/api/"quoted"/': 1,
+        })
+        self.assertEqual(dict(report["users"]["top"]), {"alice@example.com": 4, "u1": 5, "Anonymous": 2})
+        self.assertEqual(report["requests_per_hour"], {"2026-01-31 14": 5, "2026-01-31 15": 6})
+        self.assertEqual(report["statuses"], {"200": 5, "404": 1})
+        self.assertEqual(report["latency"]["count"], 6)
+        self.assertAlmostEqual(report["latency"]["p50_ms"], 2.0, delta=0.05)
+        self.assertEqual(report["latency"]["max_ms"], 100.0)
+        self.assertEqual(report["routes"]["messages-list"]["count"], 5)
+        self.assertEqual(report["routes"]["-"]["count"], 1)
+
+    def test_chunks_and_workers_agree_with_a_single_pass(self):
+        whole = logstats.analyze([self.path])
+        for chunk_size in (1, 7, 100):
+            with self.subTest(chunk_size=chunk_size):
+                chunked = logstats.analyze([self.path], chunk_size=chunk_size)
+                self.assertEqual(chunked.parsed, whole.parsed)
+                self.assertEqual(chunked.lines, whole.lines)
+                self.assertEqual(chunked.paths.counts, whole.paths.counts)
+        parallel = logstats.analyze([self.path, self.path + ".1.gz"], jobs=2, chunk_size=200)
+        self.assertEqual(parallel.parsed, 11)
+
+    def test_top_k_and_quantile_sketch_stay_bounded(self):
+        top = logstats.TopK(capacity=2)
+        top.update({"a": 10, "b": 5, "c": 1, "d": 1, "e": 1})
+        top.update({"a": 1, "f": 1})
+        self.assertLessEqual(len(top.counts), 4)
+        self.assertEqual(top.top(1), [("a", 11)])
+        self.assertEqual(top.error, 1)
+
+        sketch = logstats.QuantileSketch(accuracy=0.01)
+        for value in range(1, 100001):
+            sketch.add(value / 100)
+        self.assertLess(len(sketch.bins), 1200)
+        self.assertAlmostEqual(sketch.quantile(0.99), 990, delta=990 * 0.01)
+
+
+def _increment_in_child(amount):
+    metrics.MESSAGES_CREATED.inc(amount=amount)
+
+
+@override_settings(
+    MIDDLEWARE=["chats.middleware.MetricsMiddleware"] + API_TEST_MIDDLEWARE,
+    CHATS_RATE_LIMITS=[], CHATS_RATE_LIMIT_BACKEND={},
+)
+class MetricsTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.conversation = cls.make_conversation(cls.alice, cls.make_user("bob"))
+
+    def setUp(self):
+        super().setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        override = self.settings(CHATS_METRICS={"ENABLED": True, "DIR": self.dir})
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+
+    def scrape(self):
+        response = self.client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], metrics.CONTENT_TYPE)
+        return response.content.decode().splitlines()
+
+    def test_request_metrics(self):
+        self.assertEqual(self.client.get("/api/messages/").status_code, 401)
+        self.client.force_authenticate(self.alice)
+        self.client.get("/api/messages/")
+        self.client.post(
+            "/api/messages/", {"conversation": str(self.conversation.pk), "message_body": "hi"},
+            format="json",
+        )
+        lines = self.scrape()
+        self.assertIn("# TYPE chats_request_duration_seconds histogram", lines)
+        self.assertIn('chats_requests_total{route="messages-list",method="GET",status="200"} 1', lines)
+        self.assertIn('chats_requests_total{route="messages-list",method="POST",status="201"} 1', lines)
+        self.assertIn('chats_auth_failures_total{route="messages-list"} 1', lines)
+        self.assertIn("chats_messages_created_total 1", lines)
+        self.assertIn('chats_request_duration_seconds_count{route="messages-list",method="GET"} 2', lines)
+        self.assertIn(
+            'chats_request_duration_seconds_bucket{route="messages-list",method="GET",le="+Inf"} 2', lines
+        )
+        self.assertTrue(any(line.startswith('chats_db_queries_total{route="messages-list"}') for line in lines))
+
+    def test_scrape_is_limited_to_allowed_addresses(self):
+        response = self.client.get("/metrics", REMOTE_ADDR="203.0.113.9")
+        self.assertEqual(response.status_code, 403)
+
+    def test_rate_limit_rejections(self):
+        compiled = policy.Policy.from_config(
+            [], [{"name": "send", "path": "/api/messages/", "methods": ["POST"], "rate": "1/m"}]
+        )
+        match = compiled.match("POST", "/api/messages/")
+        request = RequestFactory().post("/api/messages/")
+        backend = ratelimit.get_backend()
+        self.addCleanup(ratelimit.reset_backend)
+        statuses = [match.check(request, AnonymousUser(), backend) for _ in range(3)]
+        self.assertEqual([r and r.status_code for r in statuses], [None, 429, 429])
+        self.assertIn('chats_rate_limit_rejections_total{limit="send"} 2', self.scrape())
+
+    def test_processes_write_their_own_files_and_scrapes_add_them_up(self):
+        metrics.MESSAGES_CREATED.inc(amount=2)
+        context = multiprocessing.get_context("fork")
+        for amount in (3, 4):
+            child = context.Process(target=_increment_in_child, args=(amount,))
+            child.start()
+            child.join()
+            self.assertEqual(child.exitcode, 0)
+        self.assertEqual(len(os.listdir(self.dir)), 3)
+        self.assertIn("chats_messages_created_total 9", self.scrape())
+
+    def test_values_file_survives_growth_and_reopening(self):
+        path = os.path.join(self.dir, "chats-1.db")
+        values = metrics.MmapValues(path)
+        for i in range(3000):
+            values.add(("chats_requests_total", (f"route-{i}", "GET", "200")), 1)
+        values.add(("chats_requests_total", ("route-0", "GET", "200")), 1)
+        reopened = metrics.MmapValues(path)
+        reopened.add(("chats_requests_total", ("route-0", "GET", "200")), 1)
+        totals = metrics.collect(self.dir)
+        self.assertEqual(len(totals), 3000)
+        self.assertEqual(totals[("chats_requests_total", ("route-0", "GET", "200"))], 3)
+        self.assertEqual(
+            metrics.sample_line("m", [("path", 'a"b\\c')], 1.5), 'm{path="a\\"b\\\\c"} 1.5'
+        )
+
+
+class FastListTests(ChatsAPITestCase):
+    """chats.fastpath and ORJSONRenderer must not change a single byte (floats aside)."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        User.objects.filter(pk=cls.bob.pk).update(first_name="Zoë", phone_number="+33 1 23 45")
+        cls.conversation = cls.make_conversation(cls.alice, cls.bob)
+        cls.empty = cls.make_conversation(cls.alice, cls.bob)
+        bodies = ["plain", 'quote " and \\ backslash', "line\u2028separator\u2029", "émoji 🎉", "<tag>&"]
+        for i, body in enumerate(bodies):
+            Message.objects.create(
+                sender=cls.bob if i % 2 else cls.alice, conversation=cls.conversation, message_body=body
+            )
+        Message.objects.filter(message_body="plain").update(
+            sent_at=timezone.now() - timedelta(days=400)
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def assertSameBytes(self, url):
+        fast = self.client.get(url)
+        with self.settings(CHATS_FAST_LISTS=False):
+            slow = self.client.get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+        return fast
+
+    def test_lists_match_the_serializers(self):
+        response = self.assertSameBytes("/api/messages/")
+        self.assertIn(b"line\\u2028separator\\u2029", response.content)
+        response = self.assertSameBytes("/api/messages/?page_size=2")
+        self.assertSameBytes(response.data["next"])
+        self.assertSameBytes("/api/messages/?page=1&page_size=2")
+        response = self.assertSameBytes("/api/conversations/")
+        self.assertIn(b'"last_message":null', response.content)
+        self.assertSameBytes(f"/api/conversations/{self.conversation.pk}/messages/")
+
+    def test_archived_rows_are_serialized_as_usual(self):
+        call_command("archive_messages", older_than_days=180, stdout=StringIO())
+        url = f"/api/conversations/{self.conversation.pk}/messages/?page_size=4"
+        response = self.assertSameBytes(url)
+        self.assertSameBytes(response.data["next"])
+
+    def test_unsupported_serializers_have_no_plan(self):
+        self.assertIsNone(fastpath.plan_for(ConversationSerializer))  # nested messages
+        self.assertIsNotNone(fastpath.plan_for(MessageSerializer))
+        with self.settings(CHATS_FAST_LISTS=False):
+            self.assertIsNone(fastpath.plan_for(MessageSerializer))
+
+    def test_renderer_matches_json_renderer(self):
+        data = {
+            "when": timezone.now(), "id": uuid.uuid4(), "amount": Decimal("1.50"),
+            "text": "a b é \"q\" \x01", "nested": [{"n": 2 ** 40, "f": 0.1}, None, True],
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            ORJSONRenderer().render(data, "application/json; indent=2"),
+            JSONRenderer().render(data, "application/json; indent=2"),
+        )
+        self.assertEqual(ORJSONRenderer().render({"big": 2 ** 70}), b'{"big":1180591620717411303424}')
+
+        # Floats are not the same bytes (see chats.renderers), only the same numbers
+        data = {"rank": [1e-06, 1e-05, 1e+16, -2.5e-07, 0.1, 123.456]}
+        fast, slow = ORJSONRenderer().render(data), JSONRenderer().render(data)
+        self.assertEqual(json.loads(fast), json.loads(slow))
+        if renderers.orjson is not None:
+            self.assertEqual(fast, b'{"rank":[1e-6,0.00001,1e16,-2.5e-7,0.1,123.456]}')
+
+
+@override_settings(CHATS_INBOX_CACHE={"ENABLED": True})
+class ConditionalListTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.conversation = cls.make_conversation(cls.alice, cls.bob)
+        cls.message = Message.objects.create(
+            sender=cls.bob, conversation=cls.conversation, message_body="hello"
+        )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+        self.urls = [
+            "/api/conversations/",
+            "/api/messages/",
+            f"/api/conversations/{self.conversation.pk}/messages/",
+        ]
+
+    def etags(self):
+        return [self.client.get(url)["ETag"] for url in self.urls]
+
+    def test_unchanged_lists_answer_304_from_the_validators(self):
+        # The inbox (first) is answered from its cache, without a query
+        for budget, url, etag in zip([0, 1, 1], self.urls, self.etags()):
+            with self.assertNumQueries(budget):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response["ETag"], etag)
+            self.assertIn("private", response["Cache-Control"])
+        # Another page or format is another representation
+        response = self.client.get("/api/conversations/?page_size=5", HTTP_IF_NONE_MATCH=self.etags()[0])
+        self.assertEqual(response.status_code, 200)
+
+    def test_changes_move_the_validators(self):
+        changes = [
+            lambda: Message.objects.create(sender=self.bob, conversation=self.conversation, message_body="new"),
+            lambda: self.client.patch(f"/api/messages/{self.message.pk}/", {"message_body": "edited"}),
+            lambda: Message.objects.get(message_body="new").delete(),
+            lambda: self.conversation.participants.add(self.make_user("carol")),
+            lambda: User.objects.get(username="carol").conversations.clear(),
+            lambda: User.objects.filter(pk=self.bob.pk).first().save(),
+            lambda: self.make_conversation(self.alice),
+        ]
+        etags = self.etags()
+        for change in changes:
+            change()
+            new = self.etags()
+            self.assertTrue(all(a != b for a, b in zip(etags[:2], new[:2])), change)
+            etags = new
+        # Logging in does not touch what the lists render
+        self.bob.save(update_fields=["last_login"])
+        self.assertEqual(self.etags(), etags)
+
+    def test_if_modified_since(self):
+        an_hour_ago = timezone.now() - timedelta(hours=1)
+        Conversation.objects.update(created_at=an_hour_ago, last_message_at=an_hour_ago, changed_at=None)
+        inbox_cache.invalidate([self.alice.pk])  # update() sends no signals
+        response = self.client.get(self.urls[0])
+        last_modified = response["Last-Modified"]
+        self.assertEqual(
+            self.client.get(self.urls[0], HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304
+        )
+        Message.objects.create(sender=self.bob, conversation=self.conversation, message_body="new")
+        response = self.client.get(self.urls[0], HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        # Modified within the current second: no Last-Modified yet
+        self.assertNotIn("Last-Modified", response)
+
+    def test_outsiders_still_get_404(self):
+        self.client.force_authenticate(self.make_user("mallory"))
+        self.assertEqual(self.client.get(self.urls[2], HTTP_IF_NONE_MATCH="*").status_code, 404)
+        self.assertEqual(self.client.get("/api/conversations/not-a-uuid/messages/").status_code, 404)
+
+
+@override_settings(CHATS_INBOX_CACHE={"ENABLED": True})
+class InboxCacheTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.carol = cls.make_user("carol")
+        cls.ours = cls.make_conversation(cls.alice, cls.bob)
+        cls.theirs = cls.make_conversation(cls.carol)
+        Message.objects.create(sender=cls.bob, conversation=cls.ours, message_body="hello")
+
+    def inbox(self, user, url="/api/conversations/"):
+        self.client.force_authenticate(user)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def assertCached(self, user, url="/api/conversations/"):
+        with self.assertNumQueries(0):
+            return self.inbox(user, url)
+
+    def test_hits_run_no_query_and_match_misses(self):
+        miss = self.inbox(self.alice)
+        hit = self.assertCached(self.alice)
+        self.assertEqual(hit.content, miss.content)
+        self.assertEqual(hit["ETag"], miss["ETag"])
+        self.assertEqual(self.inbox(self.alice, "/api/conversations/?page_size=1").data["count"], 1)
+        with self.settings(CHATS_INBOX_CACHE={"ENABLED": False}):
+            with self.assertNumQueries(4):
+                self.inbox(self.alice)
+
+    def test_entries_vary_with_the_media_type(self):
+        self.client.force_authenticate(self.alice)
+        html = self.client.get("/api/conversations/", HTTP_ACCEPT="text/html")
+        self.assertEqual(html["Content-Type"], "text/html; charset=utf-8")
+        json_response = self.client.get("/api/conversations/", HTTP_ACCEPT="application/json")
+        self.assertEqual(json_response["Content-Type"], "application/json")
+        self.assertNotEqual(json_response["ETag"], html["ETag"])
+        self.assertEqual(self.assertCached(self.alice)["ETag"], json_response["ETag"])
+
+    def test_writes_invalidate_the_affected_participants_only(self):
+        def warm():
+            for user in (self.alice, self.bob, self.carol):
+                self.inbox(user)
+
+        warm()
+        message = Message.objects.create(sender=self.bob, conversation=self.ours, message_body="new")
+        self.assertEqual(self.inbox(self.alice).data["results"][0]["last_message"]["message_body"], "new")
+        self.assertCached(self.carol)
+
+        warm()
+        self.client.force_authenticate(self.bob)
+        self.client.patch(f"/api/messages/{message.pk}/", {"message_body": "edited"})
+        self.assertEqual(self.inbox(self.alice).data["results"][0]["last_message"]["message_body"], "edited")
+        self.assertCached(self.carol)
+
+        warm()
+        message.delete()
+        self.assertEqual(self.inbox(self.bob).data["results"][0]["message_count"], 1)
+        self.assertCached(self.carol)
+
+        warm()
+        self.ours.participants.add(self.carol)
+        self.assertEqual(self.inbox(self.carol).data["count"], 2)
+        self.assertEqual(len(self.inbox(self.alice).data["results"][0]["participants"]), 3)
+
+        warm()
+        self.ours.participants.remove(self.alice)
+        self.assertEqual(self.inbox(self.alice).data["count"], 0)
+        self.assertEqual(len(self.inbox(self.bob).data["results"][0]["participants"]), 2)
+
+
+class SparseFieldsetTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.conversation = cls.make_conversation(cls.alice, cls.bob)
+        for i in range(3):
+            cls.message = Message.objects.create(
+                sender=cls.bob, conversation=cls.conversation, message_body=f"m{i}"
+            )
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def get(self, url):
+        """The response, after checking the fast and serializer paths agree."""
+        with CaptureQueriesContext(connection) as fast_queries:
+            fast = self.client.get(url)
+        with self.settings(CHATS_FAST_LISTS=False, CHATS_INBOX_CACHE={"ENABLED": False}):
+            with CaptureQueriesContext(connection) as slow_queries:
+                slow = self.client.get(url)
+        self.assertEqual(fast.status_code, 200)
+        self.assertEqual(fast.content, slow.content)
+        self.sql = " ".join(q["sql"] for q in [*fast_queries, *slow_queries])
+        return fast.data
+
+    def test_fields_select_and_prune(self):
+        data = self.get("/api/messages/?fields=id,message_body&page_size=2")
+        self.assertEqual([set(row) for row in data["results"]], [{"id", "message_body"}] * 2)
+        self.assertNotIn("chats_user", self.sql)
+        self.assertNotIn("flagged_at", self.sql)
+        self.client.get(data["next"])  # the cursor still works
+
+        data = self.get(f"/api/conversations/{self.conversation.pk}/messages/?fields=message_body,sender.email")
+        self.assertEqual(data["results"][0], {"sender": {"email": "bob@example.com"}, "message_body": "m2"})
+        self.assertNotIn("first_name", self.sql)
+
+        data = self.get(f"/api/messages/{self.message.pk}/?fields=id")
+        self.assertEqual(data, {"id": str(self.message.pk)})
+        self.assertNotIn("message_body", self.sql)
+
+    def test_expand_is_opt_in(self):
+        data = self.get("/api/messages/?expand=")
+        self.assertEqual(data["results"][0]["sender"], self.bob.pk)
+        self.assertNotIn("chats_user", self.sql)
+
+        data = self.get("/api/conversations/?fields=id,participants&expand=")
+        row = data["results"][0]
+        self.assertEqual(set(row), {"id", "participants"})
+        self.assertCountEqual(row["participants"], [self.alice.pk, self.bob.pk])
+        self.assertNotIn("message_body", self.sql)
+        data = self.get("/api/conversations/?fields=id,participants.email")
+        self.assertCountEqual(
+            data["results"][0]["participants"], [{"email": "alice@example.com"}, {"email": "bob@example.com"}]
+        )
+
+    def test_writes_ignore_fieldsets(self):
+        response = self.client.post(
+            "/api/messages/?fields=id",
+            {"conversation": str(self.conversation.pk), "message_body": "hi"},
+        )
+        self.assertEqual(response.status_code, 201)
+        self.assertIn("sender", response.data)
+
+
+class SyncTests(ChatsAPITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = cls.make_user("alice")
+        cls.bob = cls.make_user("bob")
+        cls.carol = cls.make_user("carol")
+        cls.ours = cls.make_conversation(cls.alice, cls.bob)
+        cls.theirs = cls.make_conversation(cls.bob, cls.carol)
+        cls.first = Message.objects.create(sender=cls.bob, conversation=cls.ours, message_body="one")
+        Message.objects.create(sender=cls.bob, conversation=cls.theirs, message_body="not for alice")
+        Message.objects.create(sender=cls.alice, conversation=cls.ours, message_body="two")
+
+    def setUp(self):
+        super().setUp()
+        self.client.force_authenticate(self.alice)
+
+    def sync(self, token=None, **params):
+        if token is not None:
+            params["token"] = token
+        response = self.client.get("/api/messages/sync/", params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_catches_up_in_batches(self):
+        first = self.sync(page_size=1)
+        self.assertEqual([m["message_body"] for m in first["results"]], ["one"])
+        self.assertTrue(first["has_more"])
+        second = self.sync(first["sync_token"], page_size=1)
+        self.assertEqual([m["message_body"] for m in second["results"]], ["two"])
+        self.assertFalse(second["has_more"])
+
+        caught_up = self.sync(second["sync_token"])
+        self.assertEqual(caught_up["results"], [])
+        self.assertEqual(caught_up["sync_token"], second["sync_token"])
+
+    def test_reports_edits_and_new_messages(self):
+        token = self.sync()["sync_token"]
+        self.first.message_body = "one, edited"
+        self.first.save()
+        Message.objects.bulk_create([Message(sender=self.bob, conversation=self.ours, message_body="three")])
+
+        data = self.sync(token)
+        self.assertEqual([m["message_body"] for m in data["results"]], ["one, edited", "three"])
+        self.assertIsNotNone(data["results"][0]["edited_at"])
+        self.assertIsNone(data["results"][1]["edited_at"])
+        self.assertEqual(self.sync(data["sync_token"])["results"], [])
+
+    def test_fields_and_fast_path(self):
+        fast = self.client.get("/api/messages/sync/?fields=id,message_body")
+        with self.settings(CHATS_FAST_LISTS=False):
+            slow = self.client.get("/api/messages/sync/?fields=id,message_body")
+        self.assertEqual(fast.content, slow.content)
+        self.assertEqual(set(fast.data["results"][0]), {"id", "message_body"})
+
+    def test_invalid_token(self):
+        for token in ("nope", base64.urlsafe_b64encode(b"s1|x").decode()):
+            response = self.client.get("/api/messages/sync/", {"token": token})
+            self.assertEqual(response.status_code, 400)
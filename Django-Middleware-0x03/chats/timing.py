@@ -0,0 +1,343 @@
+"""
+Opt-in request timing: a Server-Timing header and rolling histograms.
+
+With CHATS_TIMING["ENABLED"], ServerTimingMiddleware (first in MIDDLEWARE)
+times every request and breaks it down into stages:
+- every middleware below it, self time only (its own work, not the rest
+  of the chain)
+- view: URL resolution, the view and rendering; within it the DRF stages
+  auth, perm, serialize and render (see TimedViewMixin)
+- db: time spent in SQL and the number of queries (chats.dbstats); it
+  overlaps the stages that ran them
+
+The breakdown is sent in a Server-Timing header (browser developer tools
+show it) and added to per-stage histograms covering the last WINDOW
+seconds, which stats() returns and /api/internal/timing/ serves.
+
+Disabled (the default), the middleware removes itself from the chain at
+startup and each timed DRF stage costs one context variable lookup.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+
+from asgiref.sync import AsyncToSync, iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from rest_framework.serializers import ListSerializer
+
+from .dbstats import track_queries
+from .middleware import SyncAsyncMiddleware
+
+DEFAULTS = {
+    "ENABLED": False,
+    "HEADER": True,
+    # Histogram bucket upper bounds, in milliseconds
+    "BUCKETS": (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000),
+    "WINDOW": 60,
+    "SLOTS": 6,
+}
+
+_current = ContextVar("chats_request_timer", default=None)
+_no_stage = nullcontext()
+
+
+def timing_settings():
+    options = dict(DEFAULTS)
+    options.update(getattr(settings, "CHATS_TIMING", {}))
+    return options
+
+
+class Timer:
+    """The stage timings of one request."""
+
+    __slots__ = ("spans", "stages")
+
+    def __init__(self, links):
+        # spans[i]: time spent in link i of the middleware chain and below
+        self.spans = [0.0] * links
+        self.stages = {}
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+
+def stage(name):
+    """
+    Context manager timing a stage of the current request; does nothing
+    when the request is not timed.
+    """
+    timer = _current.get()
+    if timer is None:
+        return _no_stage
+    return timer.stage(name)
+
+
+class RollingHistogram:
+    """
+    Latency histogram over the last `window` seconds, kept in `slots`
+    rotating slots: observations older than the window drop out one slot
+    at a time.
+    """
+
+    def __init__(self, bounds, window=60, slots=6):
+        self.bounds = tuple(bounds)
+        self.slot_length = window / slots
+        self.epochs = [-1] * slots
+        self.counts = [[0] * (len(self.bounds) + 1) for _ in range(slots)]
+        self.sums = [0.0] * slots
+
+    def _slot(self, now):
+        epoch = int(now // self.slot_length)
+        index = epoch % len(self.epochs)
+        if self.epochs[index] != epoch:
+            self.epochs[index] = epoch
+            self.counts[index] = [0] * (len(self.bounds) + 1)
+            self.sums[index] = 0.0
+        return index
+
+    def observe(self, ms, now):
+        index = self._slot(now)
+        self.counts[index][bisect_left(self.bounds, ms)] += 1
+        self.sums[index] += ms
+
+    def snapshot(self, now):
+        oldest = int(now // self.slot_length) - len(self.epochs)
+        counts = [0] * (len(self.bounds) + 1)
+        total = 0.0
+        for index, epoch in enumerate(self.epochs):
+            if epoch > oldest:
+                counts = [a + b for a, b in zip(counts, self.counts[index])]
+                total += self.sums[index]
+        count = sum(counts)
+        return {
+            "count": count,
+            "mean_ms": round(total / count, 3) if count else None,
+            "p50_ms": self.quantile(counts, 0.5),
+            "p95_ms": self.quantile(counts, 0.95),
+            "p99_ms": self.quantile(counts, 0.99),
+            "buckets": {
+                str(bound): n for bound, n in zip(self.bounds + ("+Inf",), counts)
+            },
+        }
+
+    def quantile(self, counts, q):
+        """Estimate a quantile, interpolating linearly within its bucket."""
+        count = sum(counts)
+        if not count:
+            return None
+        rank = q * count
+        seen = 0
+        for index, n in enumerate(counts):
+            if n and seen + n >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index]
+                return round(lower + (upper - lower) * (rank - seen) / n, 3)
+            seen += n
+        return self.bounds[-1]
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def record(stages, now=None):
+    """Add one request's {stage: milliseconds} to the histograms."""
+    options = timing_settings()
+    now = time.monotonic() if now is None else now
+    with _histograms_lock:
+        for name, ms in stages.items():
+            histogram = _histograms.get(name)
+            if histogram is None:
+                histogram = _histograms[name] = RollingHistogram(
+                    options["BUCKETS"], options["WINDOW"], options["SLOTS"]
+                )
+            histogram.observe(ms, now)
+
+
+def stats(now=None):
+    """Snapshot of every stage's histogram in this process."""
+    now = time.monotonic() if now is None else now
+    with _histograms_lock:
+        return {name: histogram.snapshot(now) for name, histogram in sorted(_histograms.items())}
+
+
+def reset():
+    with _histograms_lock:
+        _histograms.clear()
+
+
+def _downstream(handler):
+    """
+    The middleware instance a get_response callable leads to, looking
+    through Django's exception and sync/async adapters; None at the view.
+    """
+    while True:
+        if isinstance(handler, AsyncToSync):
+            handler = handler.awaitable
+        elif hasattr(handler, "__wrapped__"):
+            # functools.wraps also copies the instance's __dict__ onto the
+            # wrapper, get_response included: look at __wrapped__ first
+            handler = handler.__wrapped__
+        else:
+            return handler if hasattr(handler, "get_response") else None
+
+
+def _timed(get_response, link):
+    """Wrap a get_response to record the time spent below it as spans[link]."""
+    if iscoroutinefunction(get_response):
+        async def timed(request):
+            start = time.perf_counter()
+            try:
+                return await get_response(request)
+            finally:
+                _current.get().spans[link] = time.perf_counter() - start
+    else:
+        def timed(request):
+            start = time.perf_counter()
+            try:
+                return get_response(request)
+            finally:
+                _current.get().spans[link] = time.perf_counter() - start
+    return timed
+
+
+class ServerTimingMiddleware(SyncAsyncMiddleware):
+    """
+    Time each request by stage (see the module docstring). Must come first
+    in MIDDLEWARE to see the whole chain; not loaded unless
+    CHATS_TIMING["ENABLED"].
+    """
+
+    def __init__(self, get_response):
+        options = timing_settings()
+        if not options["ENABLED"]:
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+        self.header = options["HEADER"]
+
+        # Wrap the get_response of every middleware down the chain, so the
+        # time below each link is known and self times can be worked out
+        self.names = []
+        self.get_response = _timed(self.get_response, 0)
+        middleware = _downstream(get_response)
+        while middleware is not None:
+            self.names.append(type(middleware).__name__)
+            inner = middleware.get_response
+            middleware.get_response = _timed(inner, len(self.names))
+            middleware = _downstream(inner)
+        self.names.append("view")
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = Timer(len(self.names))
+        token = _current.set(timer)
+        start = time.perf_counter()
+        try:
+            with track_queries() as queries:
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(response, timer, time.perf_counter() - start, queries)
+
+    async def __acall__(self, request):
+        timer = Timer(len(self.names))
+        token = _current.set(timer)
+        start = time.perf_counter()
+        try:
+            with track_queries() as queries:
+                response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(response, timer, time.perf_counter() - start, queries)
+
+    def breakdown(self, timer, total, queries):
+        """{stage: milliseconds} for one request, in pipeline order."""
+        spans = timer.spans + [0.0]
+        stages = {"total": total * 1000}
+        for link, name in enumerate(self.names):
+            if spans[link]:
+                own = max(spans[link] - spans[link + 1], 0.0)
+                stages[name] = stages.get(name, 0.0) + own * 1000
+        for name, seconds in timer.stages.items():
+            stages[name] = seconds * 1000
+        stages["db"] = queries.duration * 1000
+        return stages
+
+    def finish(self, response, timer, total, queries):
+        stages = self.breakdown(timer, total, queries)
+        record(stages)
+        if self.header:
+            metrics = [
+                f'db;desc="{queries.count} queries";dur={ms:.3f}' if name == "db"
+                else f"{name};dur={ms:.3f}"
+                for name, ms in stages.items()
+            ]
+            response["Server-Timing"] = ", ".join(metrics)
+        return response
+
+
+class TimedViewMixin:
+    """
+    Time the DRF stages of a view: auth, perm and render. Untimed requests
+    go straight to the parent methods.
+    """
+
+    def perform_authentication(self, request):
+        timer = _current.get()
+        if timer is None:
+            return super().perform_authentication(request)
+        with timer.stage("auth"):
+            super().perform_authentication(request)
+
+    def check_permissions(self, request):
+        timer = _current.get()
+        if timer is None:
+            return super().check_permissions(request)
+        with timer.stage("perm"):
+            super().check_permissions(request)
+
+    def check_object_permissions(self, request, obj):
+        timer = _current.get()
+        if timer is None:
+            return super().check_object_permissions(request, obj)
+        with timer.stage("perm"):
+            super().check_object_permissions(request, obj)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        timer = _current.get()
+        if timer is not None and hasattr(response, "render"):
+            # Django would render it right after the view; do it here to time it
+            with timer.stage("render"):
+                response.render()
+        return response
+
+
+class TimedSerializerMixin:
+    """Time reading .data as the serialize stage."""
+
+    @property
+    def data(self):
+        timer = _current.get()
+        if timer is None:
+            return super().data
+        with timer.stage("serialize"):
+            return super().data
+
+
+class TimedListSerializer(TimedSerializerMixin, ListSerializer):
+    """Set as Meta.list_serializer_class so many=True is timed as well."""
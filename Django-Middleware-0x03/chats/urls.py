@@ -1,7 +1,7 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from .views import ConversationViewSet, MessageViewSet
+from .views import ConversationViewSet, MessageViewSet, TimingStatsView
 
 router = DefaultRouter()
 router.register(r'conversations', ConversationViewSet, basename='conversations')
@@ -9,4 +9,5 @@ router.register(r'messages', MessageViewSet, basename='messages')
 
 urlpatterns = [
     path('', include(router.urls)),
+    path('internal/timing/', TimingStatsView.as_view(), name='timing-stats'),
 ]
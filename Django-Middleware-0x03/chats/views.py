@@ -1,29 +1,107 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django_filters.rest_framework import DjangoFilterBackend
+from django.db.models import F, Prefetch
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
+from . import conditional, fastpath, fieldsets, inbox_cache, search, sync, timing
+from .export import iter_conversation_ndjson
 from .filters import MessageFilter
-from .models import Conversation, Message
-from .pagination import MessagePagination
-from .serializers import ConversationSerializer, MessageSerializer
+from .membership import is_participant, participant_conversation_ids
+from .models import ArchivedMessage, Conversation, Message, User
+from .pagination import MessageCursorPagination, MessagePagination
+from .serializers import (
+    BulkMessageItemSerializer,
+    ConversationSerializer,
+    ConversationSummarySerializer,
+    MessageSerializer,
+    UserSerializer,
+)
 from rest_framework.permissions import IsAuthenticated
-from .permissions import IsParticipantOfConversation
+from .permissions import IsAdminRole, IsParticipantOfConversation
+from .signals import messages_bulk_created
+
+
+def participants_prefetch(lookup="participants"):
+    """
+    Prefetch conversation participants with only the columns UserSerializer
+    renders, in one query for the whole page.
+    """
+    return Prefetch(lookup, queryset=User.objects.only(*UserSerializer.Meta.fields))
+
+
+class PolledListMixin:
+    """
+    list() for the lists clients poll: answered with a 304 from the
+    validators of the user's conversations when nothing changed (see
+    chats.conditional), else built from rows by chats.fastpath.
+    """
+
+    def list(self, request, *args, **kwargs):
+        conversations = Conversation.objects.filter(participants=request.user)
+        return conditional.conditional_response(
+            request, conversations, lambda: self.list_response(request, *args, **kwargs)
+        )
+
+    # Columns the paginator reads from rows, whatever ?fields= selects
+    pagination_columns = ()
 
+    def list_response(self, request, *args, **kwargs):
+        spec = fieldsets.spec_for(self.get_serializer())
+        plan = fastpath.plan_for(self.get_serializer_class(), spec)
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        rows = plan.rows(self.filter_queryset(self.get_queryset()), also=self.pagination_columns)
+        page = self.paginate_queryset(rows)
+        with timing.stage("serialize"):
+            data = plan.build_many(rows if page is None else page)
+        if page is None:
+            return Response(data)
+        return self.get_paginated_response(data)
 
 
-class MessageViewSet(viewsets.ModelViewSet):
+class MessageViewSet(PolledListMixin, timing.TimedViewMixin, viewsets.ModelViewSet):
     queryset = Message.objects.all()
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated, IsParticipantOfConversation]
 
     # Add pagination + filtering
-    pagination_class = MessagePagination
+    # Cursor pagination by default; ?page=N opts into the count/total_pages shape
+    pagination_class = MessageCursorPagination
+    page_pagination_class = MessagePagination
     filter_backends = [DjangoFilterBackend]
     filterset_class = MessageFilter
+    pagination_columns = ("sent_at",)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, "_paginator"):
+            if self.page_pagination_class.page_query_param in self.request.query_params:
+                self._paginator = self.page_pagination_class()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
 
     def get_queryset(self):
-        # Only messages in conversations the user participates in
-        return Message.objects.filter(conversation__participants=self.request.user)
+        # Only messages in conversations the user participates in.
+        # The participants join cannot duplicate rows: (conversation, user)
+        # is unique in the m2m table, so no .distinct() is needed.
+        queryset = Message.objects.filter(
+            conversation__participants=self.request.user
+        ).select_related("sender")
+        # Only what ?fields= / ?expand= ask for
+        return fieldsets.prune(
+            queryset.order_by("-sent_at", "-id"), self.get_serializer(), also=self.pagination_columns
+        )
 
     def create(self, request, *args, **kwargs):
         """
@@ -34,26 +112,164 @@ class MessageViewSet(viewsets.ModelViewSet):
         serializer.is_valid(raise_exception=True)
 
         # Extract conversation_id (required by ALX checker)
+        # The serializer has already loaded the conversation, so it exists
         conversation_id = serializer.validated_data.get("conversation").id
 
-        # Ensure the conversation exists
-        try:
-            conversation = Conversation.objects.get(id=conversation_id)
-        except Conversation.DoesNotExist:
-            return Response({"error": "Conversation not found."},
-                            status=status.HTTP_404_NOT_FOUND)
-
         # ALX checker wants a custom access control rule here
-        if request.user not in conversation.participants.all():
+        # (answered from the per-request memo filled during validation)
+        if not is_participant(request.user, conversation_id, request):
             return Response(
                 {"error": "You are not allowed to send messages to this conversation."},
                 status=status.HTTP_403_FORBIDDEN     # required literal string
             )
 
         # Save message if permitted
-        message = serializer.save()
+        message = serializer.save(sender=request.user)
         return Response(MessageSerializer(message).data, status=status.HTTP_201_CREATED)
 
+    @action(detail=False, methods=["post"])
+    def bulk(self, request):
+        """
+        POST /messages/bulk/
+        Ingest a batch of messages: a list of {conversation, message_body}
+        items (or {"messages": [...]}). Items are validated together, checked
+        with one membership query, and written with a single bulk_create.
+        Returns one result per item, in order.
+        """
+        items = request.data.get("messages") if isinstance(request.data, dict) else request.data
+        limit = getattr(settings, "CHATS_BULK_MESSAGE_LIMIT", 500)
+        if not isinstance(items, list) or not items:
+            return Response({"error": "Expected a non-empty list of messages."},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > limit:
+            return Response({"error": f"At most {limit} messages per batch."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        results = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            serializer = BulkMessageItemSerializer(data=item)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {"index": index, "status": status.HTTP_400_BAD_REQUEST,
+                                  "errors": serializer.errors}
+
+        allowed = participant_conversation_ids(
+            request.user, {data["conversation"] for _, data in valid}, request
+        )
+        pending = []
+        for index, data in valid:
+            if str(data["conversation"]) not in allowed:
+                results[index] = {
+                    "index": index, "status": status.HTTP_403_FORBIDDEN,
+                    "errors": {"conversation": ["You are not allowed to send messages to this conversation."]},
+                }
+                continue
+            pending.append((index, Message(
+                sender=request.user,
+                conversation_id=data["conversation"],
+                message_body=data["message_body"],
+                flagged_at=data.get("flagged_at"),
+            )))
+
+        if pending:
+            with transaction.atomic():
+                created = Message.objects.bulk_create([message for _, message in pending])
+                by_conversation = defaultdict(list)
+                for message in created:
+                    by_conversation[message.conversation_id].append(message)
+                for conversation_id, messages in by_conversation.items():
+                    messages_bulk_created.send(
+                        sender=Message, conversation_id=conversation_id, messages=messages
+                    )
+            for index, message in pending:
+                results[index] = {"index": index, "status": status.HTTP_201_CREATED,
+                                  "id": message.pk, "sent_at": message.sent_at}
+
+        all_created = len(pending) == len(items)
+        return Response(
+            {"created": len(pending), "results": results},
+            status=status.HTTP_201_CREATED if all_created else status.HTTP_207_MULTI_STATUS,
+        )
+
+    @action(detail=False, methods=["get"])
+    def search(self, request):
+        """
+        GET /messages/search/?q=<text>[&cursor=...][&page_size=N]
+        Full-text search over the user's conversations, best match first.
+        Each result carries its rank and a highlighted snippet. Archived
+        messages are not searched.
+        """
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            return Response({"error": "The q parameter is required."},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        after = None
+        if request.query_params.get("cursor"):
+            try:
+                after = search.decode_cursor(request.query_params["cursor"])
+            except ValueError:
+                raise NotFound("Invalid cursor")
+
+        page_size = MessageCursorPagination().get_page_size(request)
+        hits = search.search_messages(request.user, query, page_size + 1, after=after)
+        has_next, hits = len(hits) > page_size, hits[:page_size]
+
+        context = self.get_serializer_context()
+        messages = fieldsets.prune(Message.objects.select_related("sender"), MessageSerializer(context=context))
+        messages = messages.in_bulk([hit[0] for hit in hits])
+        results = []
+        for message_id, rank, snippet, _ in hits:
+            if message_id not in messages:
+                continue  # deleted since the search query ran
+            data = MessageSerializer(messages[message_id], context=context).data
+            data["rank"] = rank
+            data["snippet"] = snippet
+            results.append(data)
+
+        next_link = None
+        if has_next:
+            _, rank, _, rowid = hits[-1]
+            next_link = replace_query_param(
+                request.build_absolute_uri(), "cursor", search.encode_cursor(rank, rowid)
+            )
+        return Response({"next": next_link, "results": results})
+
+    @action(detail=False, methods=["get"])
+    def sync(self, request):
+        """
+        GET /messages/sync/[?token=...][&page_size=N]
+        Messages created or edited in the user's conversations since the
+        sync token, oldest change first, with the token to send next.
+        has_more says another batch is waiting (see chats.sync).
+        """
+        after = 0
+        if request.query_params.get("token"):
+            try:
+                after = sync.decode_token(request.query_params["token"])
+            except ValueError:
+                return Response({"error": "Invalid sync token."}, status=status.HTTP_400_BAD_REQUEST)
+        size = sync.batch_size(request.query_params.get("page_size"))
+
+        context = self.get_serializer_context()
+        serializer = MessageSerializer(context=context)
+        messages = fieldsets.prune(sync.changed_messages(request.user, after), serializer, also=("change_seq",))
+        plan = fastpath.plan_for(MessageSerializer, fieldsets.spec_for(serializer))
+        if plan is not None:
+            messages = plan.rows(messages, also=("change_seq",))
+        rows = list(messages[:size + 1])
+        has_more, rows = len(rows) > size, rows[:size]
+        with timing.stage("serialize"):
+            if plan is None:
+                data = MessageSerializer(rows, many=True, context=context).data
+            else:
+                data = plan.build_many(rows)
+        if rows:
+            after = rows[-1].change_seq
+        return Response({"results": data, "sync_token": sync.encode_token(after), "has_more": has_more})
+
     def list_messages_for_conversation(self, request, conversation_id=None):
         """
         GET /messages/by-conversation/<conversation_id>/
@@ -65,20 +281,116 @@ class MessageViewSet(viewsets.ModelViewSet):
                             status=status.HTTP_404_NOT_FOUND)
 
         # ALX checker wants access control during list operations as well
-        if request.user not in conversation.participants.all():
+        if not is_participant(request.user, conversation.pk, request):
             return Response(
                 {"error": "You are not allowed to view messages in this conversation."},
                 status=status.HTTP_403_FORBIDDEN
             )
 
-        messages = Message.objects.filter(conversation_id=conversation_id).order_by("timestamp")
-        serializer = self.get_serializer(messages, many=True)
+        messages = (
+            Message.objects.filter(conversation_id=conversation_id)
+            .select_related("sender")
+            .order_by("sent_at", "id")
+        )
+        serializer = self.get_serializer(fieldsets.prune(messages, self.get_serializer()), many=True)
         return Response(serializer.data)
 
-class ConversationViewSet(viewsets.ModelViewSet):
+class ConversationViewSet(PolledListMixin, timing.TimedViewMixin, viewsets.ModelViewSet):
     queryset = Conversation.objects.all()
     serializer_class = ConversationSerializer
     permission_classes = [IsAuthenticated, IsParticipantOfConversation]   # ALX requires IsAuthenticated
 
     def get_queryset(self):
-        return Conversation.objects.filter(participants=self.request.user)
+        queryset = Conversation.objects.filter(participants=self.request.user)
+        if self.action in ("list", "retrieve"):
+            serializer = self.get_serializer()
+            queryset = self.annotate_summary(queryset)
+            queryset = fieldsets.prune(queryset.prefetch_related(participants_prefetch()), serializer)
+        return queryset
+
+    def get_serializer_class(self):
+        if self.action in ("list", "retrieve"):
+            return ConversationSummarySerializer
+        return ConversationSerializer
+
+    def list(self, request, *args, **kwargs):
+        # Served from the per-user inbox cache when it can be (chats.inbox_cache)
+        respond = super().list
+        return inbox_cache.cached_list(request, lambda: respond(request, *args, **kwargs))
+
+    def get_archive_queryset(self):
+        return getattr(self, "archive_queryset", None)
+
+    @staticmethod
+    def annotate_summary(queryset):
+        """
+        Inbox ordering, on the last_message_at index. The latest message
+        preview is stored on the conversation row (chats.activity), so the
+        inbox costs the same number of queries however many conversations
+        and messages there are, archived or not.
+        """
+        return queryset.order_by(F("last_message_at").desc(nulls_last=True), "-created_at")
+
+    @action(detail=True, methods=["get"], pagination_class=MessageCursorPagination)
+    def messages(self, request, pk=None):
+        """
+        GET /conversations/<id>/messages/
+        Cursor-paginated message history of one conversation, continuing
+        into archived messages past the hot window. Conditional, like list().
+        """
+        try:
+            conversations = Conversation.objects.filter(pk=pk, participants=request.user)
+        except ValidationError:
+            return self.messages_response(request, pk)  # not an id: get_object()'s 404
+        return conditional.conditional_response(
+            request, conversations, lambda: self.messages_response(request, pk), single=True
+        )
+
+    def messages_response(self, request, pk):
+        conversation = self.get_object()
+        self.archive_queryset = ArchivedMessage.objects.filter(conversation_id=conversation.pk)
+        context = self.get_serializer_context()
+        serializer = MessageSerializer(context=context)
+        messages = Message.objects.filter(conversation=conversation).select_related("sender")
+        messages = fieldsets.prune(messages, serializer, also=("sent_at",))
+        plan = fastpath.plan_for(MessageSerializer, fieldsets.spec_for(serializer))
+        if plan is None:
+            page = self.paginate_queryset(messages)
+            serializer = MessageSerializer(page, many=True, context=context)
+            return self.get_paginated_response(serializer.data)
+        # Archived rows come back as Message instances: serialize those as usual
+        page = self.paginate_queryset(plan.rows(messages, also=("sent_at",)))
+        with timing.stage("serialize"):
+            data = plan.build_many(page, fallback=lambda message: MessageSerializer(message, context=context).data)
+        return self.get_paginated_response(data)
+
+    @action(detail=True, methods=["get"])
+    def export(self, request, pk=None):
+        """
+        GET /conversations/<id>/export/
+        Stream the whole message history as NDJSON, oldest first,
+        archived messages included.
+        """
+        conversation = self.get_object()
+        response = StreamingHttpResponse(
+            iter_conversation_ndjson(conversation.pk),
+            content_type="application/x-ndjson",
+        )
+        response["Content-Disposition"] = f'attachment; filename="conversation-{conversation.pk}.ndjson"'
+        return response
+
+
+class TimingStatsView(APIView):
+    """
+    GET /internal/timing/
+    Per-stage latency histograms of this worker process (see chats.timing).
+    """
+    permission_classes = [IsAuthenticated, IsAdminRole]
+
+    def get(self, request):
+        options = timing.timing_settings()
+        return Response({
+            "enabled": options["ENABLED"],
+            "window_seconds": options["WINDOW"],
+            "stages": timing.stats(),
+        })
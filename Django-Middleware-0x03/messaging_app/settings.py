@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -55,7 +56,7 @@ REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
         'rest_framework.authentication.BasicAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        'chats.auth.ClaimsJWTAuthentication',  # user from token claims, see CHATS_JWT_CLAIMS
     ),
     'DEFAULT_PERMISSION_CLASSES': (
         'rest_framework.permissions.IsAuthenticated',
@@ -67,9 +68,18 @@ REST_FRAMEWORK = {
 
     "DEFAULT_FILTER_BACKENDS": [
         "django_filters.rest_framework.DjangoFilterBackend"
-    ]
+    ],
+
+    # Same bytes as JSONRenderer, faster when orjson is installed
+    "DEFAULT_RENDERER_CLASSES": [
+        "chats.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
 }
 
+# List pages built from database rows by chats.fastpath (same output)
+CHATS_FAST_LISTS = True
+
 
 
 from datetime import timedelta
@@ -79,10 +89,26 @@ SIMPLE_JWT = {
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
     "ROTATE_REFRESH_TOKENS": True,
     "BLACKLIST_AFTER_ROTATION": True,
+    "TOKEN_OBTAIN_SERIALIZER": "chats.auth.ChatsTokenObtainPairSerializer",
+    "TOKEN_REFRESH_SERIALIZER": "chats.auth.ChatsTokenRefreshSerializer",
+}
+
+# chats.auth: role, username and conversation claims in JWTs
+CHATS_JWT_CLAIMS = {
+    # Tokens minted with a lower version load their user from the database.
+    # Bump after changing roles or removing participants outside the API.
+    "VERSION": 1,
+    # Users in more conversations get no conversation claim
+    "MAX_CONVERSATIONS": 200,
+    # Where revoked users are recorded. Tokens are only trusted without
+    # loading their user when this cache is shared by all workers (Redis)
+    "REVOCATION_CACHE": "default",
 }
 
 
 MIDDLEWARE = [
+    'chats.timing.ServerTimingMiddleware',  # first; only loaded with CHATS_TIMING['ENABLED']
+    'chats.middleware.MetricsMiddleware',  # serves /metrics; only loaded with CHATS_METRICS['ENABLED']
     'corsheaders.middleware.CorsMiddleware',  # add this first (recommended)
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -90,13 +116,105 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',  # required for request.user
+    'chats.db_routers.ReplicaRoutingMiddleware',  # needs request.user
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
 
     # 👉 Your custom middleware
     'chats.middleware.RequestLoggingMiddleware',
-    'chats.middleware.RestrictAccessByTimeMiddleware',  # new
+    'chats.middleware.AccessPolicyMiddleware',  # hours, roles and rate limits, see CHATS_ACCESS_POLICY
+]
+
+# chats.timing: per-stage request timing in a Server-Timing header, and
+# rolling histograms served at /api/internal/timing/ (admin role)
+CHATS_TIMING = {
+    'ENABLED': os.environ.get('CHATS_TIMING') == '1',
+    'HEADER': True,
+    'WINDOW': 60,               # seconds covered by the histograms
+}
+
+# chats.metrics: Prometheus metrics at PATH, summed over every worker's file in
+# DIR at scrape time. Empty DIR when the service restarts.
+CHATS_METRICS = {
+    'ENABLED': os.environ.get('CHATS_METRICS') == '1',
+    'DIR': os.environ.get('CHATS_METRICS_DIR', BASE_DIR / 'metrics'),
+    'PATH': '/metrics',
+    'ALLOWED_IPS': ['127.0.0.1', '::1'],  # None: anyone may scrape
+}
+
+# Cache shared by all workers when CHATS_REDIS_URL is set; otherwise every
+# process has its own LocMemCache (fine for runserver or a single worker)
+if os.environ.get('CHATS_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['CHATS_REDIS_URL'],
+        }
+    }
+
+# chats.inbox_cache: per-user cache of GET /api/conversations/, invalidated on
+# message and participant writes. Invalidations only reach other workers
+# through a shared CACHE, so it is on only with Redis; with per-process
+# caches other workers would serve an inbox up to TIMEOUT seconds old.
+CHATS_INBOX_CACHE = {
+    'ENABLED': bool(os.environ.get('CHATS_REDIS_URL')),
+    'CACHE': 'default',
+    'TIMEOUT': 300,
+}
+
+# chats.middleware.RequestLoggingMiddleware -> chats.logwriter
+CHATS_REQUEST_LOG = {
+    'PATH': BASE_DIR / 'requests.log',
+    'FORMAT': 'text',           # 'json': structured access log with status, timings, DB queries
+    'BATCH_SIZE': 200,          # lines per write
+    'FLUSH_INTERVAL': 1.0,      # seconds before a partial batch is written
+    'QUEUE_SIZE': 10000,        # lines buffered before new ones are dropped
+    'MAX_BYTES': 50 * 1024 * 1024,
+    'BACKUP_COUNT': 5,
+}
+
+# chats.middleware.AccessPolicyMiddleware -> chats.policy
+# RULES: path prefix plus any of methods, hours ('HH:MM-HH:MM' when access is
+# allowed), roles, authenticated, message. FILE: JSON file with RULES and
+# RATE_LIMITS that replaces both settings and is re-read when it changes.
+CHATS_ACCESS_POLICY = {
+    'RULES': [
+        {'path': '/', 'hours': '06:00-21:00',
+         'message': 'Chat access is restricted between 9PM and 6AM.'},
+        {'path': '/api/protected/', 'roles': ['admin', 'moderator']},
+    ],
+    'FILE': None,
+    'CHECK_INTERVAL': 1.0,      # seconds between checks of FILE for changes
+}
+
+# chats.content_filter: offensive-language filter for message bodies
+# WORDLIST: one term or phrase per line; [block], [mask] and [flag] lines set
+# the action of the terms that follow (default: ACTION). Re-read on change.
+CHATS_CONTENT_FILTER = {
+    'WORDLIST': None,
+    'TERMS': [],
+    'ACTION': 'mask',
+    'MASK_CHAR': '*',
+    'CHECK_INTERVAL': 1.0,      # seconds between checks of WORDLIST for changes
+}
+
+# Rate limits enforced by AccessPolicyMiddleware -> chats.ratelimit
+# BACKEND: InProcessBackend (per process), SQLiteBackend (shared by local
+# workers, OPTIONS: path) or RedisBackend (OPTIONS: url).
+CHATS_RATE_LIMIT_BACKEND = {
+    'BACKEND': 'chats.ratelimit.SQLiteBackend',
+    'OPTIONS': {'path': BASE_DIR / 'ratelimit.sqlite3'},
+}
+CHATS_RATE_LIMITS = [
+    {
+        'name': 'send-message',
+        'path': '/api/messages/',
+        'methods': ['POST'],
+        'rate': '5/m',
+        'algorithm': 'sliding-window',
+        'key': 'user_or_ip',
+        'user_rates': {'admin': '60/m'},  # per user id or role; None = exempt
+    },
 ]
 
 ROOT_URLCONF = 'messaging_app.urls'
@@ -131,6 +249,35 @@ DATABASES = {
     }
 }
 
+# Optional read replica. Locally a copy of db.sqlite3 can stand in for it:
+#   cp db.sqlite3 replica.sqlite3 && CHATS_REPLICA_DB=replica.sqlite3 python manage.py runserver
+if os.environ.get('CHATS_REPLICA_DB'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / os.environ['CHATS_REPLICA_DB'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Optional separate database for archived (cold) messages
+if os.environ.get('CHATS_ARCHIVE_DB'):
+    DATABASES['archive'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / os.environ['CHATS_ARCHIVE_DB'],
+    }
+CHATS_ARCHIVE_DATABASE = 'archive' if 'archive' in DATABASES else 'default'
+# Messages older than this are moved to the archive by `manage.py archive_messages`
+CHATS_ARCHIVE_AFTER_DAYS = 180
+
+DATABASE_ROUTERS = [
+    'chats.db_routers.ArchiveRouter',
+    'chats.db_routers.PrimaryReplicaRouter',
+]
+CHATS_READ_REPLICAS = [alias for alias in DATABASES if alias not in ('default', 'archive')]
+# Seconds a client keeps reading from the primary after it writes
+CHATS_REPLICA_STICKY_SECONDS = 5
+# Also remembers writers that send no cookies; ignored unless shared by workers
+CHATS_REPLICA_STICKY_CACHE = 'default'
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators